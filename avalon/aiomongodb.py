@@ -0,0 +1,219 @@
+"""Awaitable access to the database, for use with asyncio
+
+Calls are made by `AvalonMongoDB` in a pool of threads, such that Session
+handling, schema validation, caches and retries are shared with
+synchronous code.
+
+Requires Python 3.5 or above, and is imported of its own accord rather
+than by `avalon.api`, as importing asyncio slows down that of the api.
+
+Example:
+    >>> from avalon.aiomongodb import AsyncAvalonMongoDB  # doctest: +SKIP
+
+"""
+
+import asyncio
+import collections
+import functools
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+from .mongodb import AvalonMongoDB
+
+# Maximum number of calls made at once, per AsyncAvalonMongoDB
+CONCURRENCY = 16
+
+
+def _call(dbcon, name, args, kwargs):
+    # Attributes are looked up in a thread too, as collection
+    # attributes may install and thereby connect on first access
+    return getattr(dbcon, name)(*args, **kwargs)
+
+
+def _awaitable(name, doc=None):
+    """Return coroutine function calling method `name` of AvalonMongoDB"""
+    async def method(self, *args, **kwargs):
+        return await self._run(_call, self.dbcon, name, args, kwargs)
+
+    method.__name__ = name
+    method.__doc__ = doc or getattr(AvalonMongoDB, name).__doc__
+    return method
+
+
+class AsyncCursor(object):
+    """Iterate results of `find()` or `aggregate()` with `async for`
+
+    Results are fetched in batches of `batch_size`, the next batch being
+    fetched in the background whilst the current one is iterated.
+
+    Example:
+        >>> async def names(dbcon):  # doctest: +SKIP
+        ...     async for asset in dbcon.find({"type": "asset"}):
+        ...         print(asset["name"])
+
+    """
+
+    def __init__(self, owner, name, args, kwargs, batch_size=100):
+        self.batch_size = batch_size
+
+        self._owner = owner
+        self._name = name
+        self._args = args
+        self._kwargs = kwargs
+
+        self._cursor = None
+        self._buffer = collections.deque()
+        self._pending = None
+        self._exhausted = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._buffer:
+            if self._exhausted:
+                raise StopAsyncIteration
+
+            if self._pending is None:
+                self._pending = self._owner._schedule(self._fetch)
+
+            batch = await self._pending
+            self._pending = None
+            if len(batch) < self.batch_size:
+                self._exhausted = True
+            else:
+                self._pending = self._owner._schedule(self._fetch)
+
+            self._buffer.extend(batch)
+
+        return self._buffer.popleft()
+
+    async def to_list(self, length=None):
+        """Return remaining results, or at most `length` of them"""
+        results = []
+        async for document in self:
+            results.append(document)
+            if length is not None and len(results) >= length:
+                break
+        return results
+
+    async def close(self):
+        """Stop fetching results and free the cursor on the server"""
+        self._exhausted = True
+        self._buffer.clear()
+        if self._pending is not None:
+            await asyncio.wait([self._pending])
+            self._pending = None
+
+        close = getattr(self._cursor, "close", None)
+        if close is not None:
+            await self._owner._run(close)
+
+    def _fetch(self):
+        if self._cursor is None:
+            self._cursor = iter(_call(
+                self._owner.dbcon, self._name, self._args, self._kwargs
+            ))
+        return list(itertools.islice(self._cursor, self.batch_size))
+
+
+class AsyncAvalonMongoDB(object):
+    """Awaitable facade over `AvalonMongoDB`
+
+    Methods of `AvalonMongoDB`, along with those of the collection of the
+    active project, are awaitable, except for `find()` and `aggregate()`
+    which return an `AsyncCursor`.
+
+    Arguments:
+        session (dict, optional): Session of the wrapped AvalonMongoDB
+        auto_install (bool, optional): Install on first use
+        concurrency (int, optional): Maximum number of calls made at once
+        dbcon (AvalonMongoDB, optional): Wrap this object rather than
+            create one from `session`
+
+    Example:
+        >>> async def main():  # doctest: +SKIP
+        ...     dbcon = AsyncAvalonMongoDB({"AVALON_PROJECT": "hulk"})
+        ...     await dbcon.install()
+        ...     asset, subsets = await asyncio.gather(
+        ...         dbcon.find_one({"type": "asset", "name": "Bruce"}),
+        ...         dbcon.find({"type": "subset"}).to_list(),
+        ...     )
+
+    """
+
+    def __init__(self, session=None, auto_install=True,
+                 concurrency=CONCURRENCY, dbcon=None):
+        if dbcon is None:
+            dbcon = AvalonMongoDB(session, auto_install)
+
+        self.dbcon = dbcon
+        self.concurrency = concurrency
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    @property
+    def Session(self):
+        return self.dbcon.Session
+
+    @property
+    def id(self):
+        return self.dbcon.id
+
+    def __getattr__(self, attr_name):
+        if attr_name.startswith("_") or attr_name == "dbcon":
+            raise AttributeError(attr_name)
+
+        async def method(*args, **kwargs):
+            return await self._run(_call, self.dbcon, attr_name, args, kwargs)
+
+        method.__name__ = attr_name
+        return method
+
+    install = _awaitable("install")
+    uninstall = _awaitable("uninstall")
+    active_project = _awaitable("active_project")
+    project_names = _awaitable("project_names")
+
+    find_one = _awaitable("find_one", "Return document matching filter")
+    distinct = _awaitable("distinct", "Return distinct values of key")
+    insert_one = _awaitable("insert_one", "Validate and insert a document")
+    insert_many = _awaitable("insert_many", "Validate and insert documents")
+    update_one = _awaitable("update_one")
+    update_many = _awaitable("update_many")
+    replace_one = _awaitable("replace_one")
+    parenthood = _awaitable("parenthood")
+    parenthoods = _awaitable("parenthoods")
+    get_representation_contexts = _awaitable("get_representation_contexts")
+    migrate = _awaitable("migrate")
+
+    async def projects(self, projection=None, only_active=True):
+        """Return list of project documents, see `AvalonMongoDB.projects()`"""
+        return await self._run(
+            lambda: list(self.dbcon.projects(projection, only_active))
+        )
+
+    def find(self, *args, **kwargs):
+        """Return `AsyncCursor` of documents, see `Collection.find()`"""
+        return self._cursor("find", args, kwargs)
+
+    def aggregate(self, *args, **kwargs):
+        """Return `AsyncCursor` of results of an aggregation pipeline"""
+        return self._cursor("aggregate", args, kwargs)
+
+    def close(self):
+        """Stop the threads making calls, once pending calls are made"""
+        self._executor.shutdown(wait=False)
+
+    def _cursor(self, name, args, kwargs):
+        batch_size = kwargs.get("batch_size") or 100
+        return AsyncCursor(self, name, args, kwargs, batch_size)
+
+    def _schedule(self, func, *args, **kwargs):
+        """Return future of `func` called in a thread"""
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs)
+        )
+
+    async def _run(self, func, *args, **kwargs):
+        return await self._schedule(func, *args, **kwargs)
@@ -4,11 +4,13 @@ import os
 import sys
 import errno
 import shutil
+import time
 import logging
 import tempfile
+import threading
 import contextlib
+import collections
 
-import requests
 from . import schema, Session
 from .mongodb import AvalonMongoDB, session_data_from_environment
 
@@ -22,6 +24,8 @@ __all__ = [
     "uninstall",
     "projects",
     "locate",
+    "locate_many",
+    "invalidate_locate",
     "insert_one",
     "find",
     "find_one",
@@ -31,7 +35,9 @@ __all__ = [
     "distinct",
     "drop",
     "delete_many",
+    "bulk",
     "parenthood",
+    "get_representation_contexts",
 ]
 
 self = sys.modules[__name__]
@@ -44,9 +50,32 @@ self._database = None
 self._sentry_client = None
 self._sentry_logging_handler = None
 
+# Resolved paths of `locate()` with the time they expire, if ever,
+# least recently used first
+self._locate_cache = collections.OrderedDict()
+self._locate_lock = threading.Lock()
+
 log = logging.getLogger(__name__)
 PY2 = sys.version_info[0] == 2
 
+HIERARCHY = ("project", "asset", "subset", "version", "representation")
+
+# Maximum number of paths remembered by `locate()`
+LOCATE_CACHE_SIZE = 10000
+
+# Seconds for which missing paths and paths to latest versions are
+# remembered, such that publishes of other processes show up
+LOCATE_TTL = 10.0
+
+
+def _reset_locks():
+    """Replace locks possibly held by other threads of a parent process"""
+    self._locate_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_locks)
+
 
 def install():
     """Establish a persistent connection to the database"""
@@ -139,6 +168,11 @@ def projects():
 def locate(path):
     """Traverse a hierarchy from top-to-bottom
 
+    The path is resolved in a single aggregation and both found and
+    missing paths are cached, see `invalidate_locate()`. Missing paths
+    and paths to latest versions are resolved anew after `LOCATE_TTL`
+    seconds.
+
     Example:
         representation = locate(["hulk", "Bruce", "modelDefault", 1, "ma"])
 
@@ -146,56 +180,233 @@ def locate(path):
         representation (ObjectId)
 
     """
-
-    components = zip(
-        ("project", "asset", "subset", "version", "representation"),
-        path
-    )
+    if not path:
+        return None
+
+    key = (active_project(), tuple(path))
+    found, value = _locate_cache_get(key)
+    if found:
+        return value
+
+    components = list(zip(HIERARCHY, path))
+    project_type, project_name = components[0]
+
+    pipeline = [
+        {"$match": {
+            "type": project_type,
+            "name": project_name,
+            "parent": None
+        }},
+        {"$limit": 1},
+    ]
+
+    if len(components) > 1:
+        # Only descend into documents named by the path
+        restrict = []
+        for type_, name in components[1:]:
+            if type_ == "version" and name in (None, -1):
+                restrict.append({"type": type_})
+            else:
+                restrict.append({"type": type_, "name": name})
+
+        pipeline += [
+            {"$graphLookup": {
+                "from": key[0],
+                "startWith": "$_id",
+                "connectFromField": "_id",
+                "connectToField": "parent",
+                "as": "_descendants",
+                "maxDepth": len(components) - 2,
+                "restrictSearchWithMatch": {"$or": restrict},
+            }},
+            {"$project": {
+                "_descendants._id": 1,
+                "_descendants.type": 1,
+                "_descendants.name": 1,
+                "_descendants.parent": 1,
+            }},
+        ]
 
     parent = None
-    for type_, name in components:
-        latest = (type_ == "version") and name in (None, -1)
+    for project in aggregate(pipeline):
+        parent = project["_id"]
+        children = dict()
+        for document in project.get("_descendants", []):
+            key_ = (document.get("parent"), document.get("type"))
+            children.setdefault(key_, []).append(document)
+
+        for type_, name in components[1:]:
+            candidates = children.get((parent, type_), [])
+            if type_ == "version" and name in (None, -1):
+                candidates = sorted(
+                    candidates, key=lambda doc: doc["name"], reverse=True
+                )
+            else:
+                candidates = [doc for doc in candidates if doc["name"] == name]
+
+            if not candidates:
+                parent = None
+                break
+
+            parent = candidates[0]["_id"]
+
+    _locate_cache_set(key, parent)
+    return parent
+
+
+def locate_many(paths):
+    """Traverse many hierarchies at once, see `locate()`
+
+    Each level of the hierarchy is resolved in one query for all paths,
+    such that common prefixes are only looked up once.
+
+    Arguments:
+        paths (list): Paths as passed to `locate()`
+
+    Returns:
+        list: ObjectId or None per path
+
+    """
+    project = active_project()
+    results = [None] * len(paths)
+    resolved = {(): None}
+
+    pending = []
+    for index, path in enumerate(paths):
+        found, value = _locate_cache_get((project, tuple(path)))
+        if found:
+            results[index] = value
+        else:
+            pending.append(index)
+
+    for depth, type_ in enumerate(HIERARCHY):
+        # Unique prefixes of this length whose parent was found
+        lookups = set()
+        for index in pending:
+            path = tuple(paths[index])
+            if len(path) <= depth or path[:depth] not in resolved:
+                continue
+            if depth and resolved[path[:depth]] is None:
+                continue
+            lookups.add(path[:depth + 1])
+
+        found = dict()
+        latest = [
+            prefix for prefix in lookups
+            if type_ == "version" and prefix[-1] in (None, -1)
+        ]
+        named = [prefix for prefix in lookups if prefix not in latest]
+
+        if named:
+            parents = set(resolved[prefix[:-1]] for prefix in named)
+            names = set(prefix[-1] for prefix in named)
+            query_filter = {
+                "type": type_,
+                "parent": {"$in": list(parents)},
+                "name": {"$in": list(names)},
+            }
+            if depth == 0:
+                query_filter["parent"] = None
+
+            documents = self._connection_object.find_cached(
+                query_filter, projection={"parent": 1, "name": 1}
+            )
+            for document in documents:
+                found.setdefault(
+                    (document.get("parent"), document["name"]),
+                    document["_id"]
+                )
+
+        if latest:
+            parents = list(set(resolved[prefix[:-1]] for prefix in latest))
+            for document in aggregate([
+                {"$match": {"type": type_, "parent": {"$in": parents}}},
+                {"$sort": {"name": -1}},
+                {"$group": {"_id": "$parent", "version": {"$first": "$_id"}}},
+            ]):
+                found[(document["_id"], None)] = document["version"]
+
+        for prefix in lookups:
+            parent = resolved[prefix[:-1]]
+            name = None if prefix in latest else prefix[-1]
+            resolved[prefix] = found.get((parent, name))
+
+    for index in pending:
+        path = tuple(paths[index])
+        value = None
+        for depth in range(1, min(len(path), len(HIERARCHY)) + 1):
+            value = resolved.get(path[:depth])
+            if value is None:
+                break
+
+        results[index] = value
+        _locate_cache_set((project, path), value)
+
+    return results
+
+
+def invalidate_locate(latest_only=False):
+    """Forget paths previously resolved by `locate()` and `locate_many()`
+
+    Arguments:
+        latest_only (bool, optional): Only forget paths to latest versions
+            and paths that were not found, e.g. after publishing.
+
+    """
+    with self._locate_lock:
+        if not latest_only:
+            self._locate_cache.clear()
+            return
+
+        for key, (value, expires) in list(self._locate_cache.items()):
+            if expires is not None:
+                self._locate_cache.pop(key)
+
 
+def _locate_cache_get(key):
+    with self._locate_lock:
         try:
-            if latest:
-                parent = find_one(
-                    filter={
-                        "type": type_,
-                        "parent": parent
-                    },
-                    projection={"_id": 1},
-                    sort=[("name", -1)]
-                )["_id"]
-            else:
-                parent = find_one(
-                    filter={
-                        "type": type_,
-                        "name": name,
-                        "parent": parent
-                    },
-                    projection={"_id": 1},
-                )["_id"]
+            value, expires = self._locate_cache.pop(key)
+        except (KeyError, TypeError):
+            return False, None
+
+        if expires is not None and expires < time.time():
+            return False, None
+
+        # Most recently used last
+        self._locate_cache[key] = (value, expires)
+        return True, value
+
 
+def _locate_cache_set(key, value):
+    # Missing paths may be published, and latest versions superseded
+    path = key[1]
+    expires = None
+    if value is None or len(path) > 3 and path[3] in (None, -1):
+        expires = time.time() + LOCATE_TTL
+
+    with self._locate_lock:
+        try:
+            self._locate_cache[key] = (value, expires)
         except TypeError:
-            return None
+            return
 
-    return parent
+        while len(self._locate_cache) > LOCATE_CACHE_SIZE:
+            self._locate_cache.popitem(last=False)
 
 
 def insert_one(item, *args, **kwargs):
-    assert isinstance(item, dict), "item must be of type <dict>"
-    schema.validate(item)
-    return self._connection_object.insert_one(item, *args, **kwargs)
+    # Validated by the connection object
+    result = self._connection_object.insert_one(item, *args, **kwargs)
+    invalidate_locate(latest_only=True)
+    return result
 
 
 def insert_many(items, *args, **kwargs):
-    # check if all items are valid
-    assert isinstance(items, list), "`items` must be of type <list>"
-    for item in items:
-        assert isinstance(item, dict), "`item` must be of type <dict>"
-        schema.validate(item)
-
-    return self._connection_object.insert_many(items, *args, **kwargs)
+    # Validated by the connection object, all items in one pass
+    result = self._connection_object.insert_many(items, *args, **kwargs)
+    invalidate_locate(latest_only=True)
+    return result
 
 
 def find(*args, **kwargs):
@@ -210,21 +421,36 @@ def find_one(filter, *args, **kwargs):
 
 def save(*args, **kwargs):
     """Deprecated, please use `replace_one`"""
-    return self._connection_object.save(*args, **kwargs)
+    try:
+        return self._connection_object.save(*args, **kwargs)
+    finally:
+        invalidate_locate()
 
 
 def replace_one(filter, replacement, *args, **kwargs):
-    return self._connection_object.replace_one(
-        filter, replacement, *args, **kwargs
-    )
+    try:
+        return self._connection_object.replace_one(
+            filter, replacement, *args, **kwargs
+        )
+    finally:
+        # Documents may have been renamed or moved
+        invalidate_locate()
 
 
 def update_one(*args, **kwargs):
-    return self._connection_object.update_one(*args, **kwargs)
+    try:
+        return self._connection_object.update_one(*args, **kwargs)
+    finally:
+        invalidate_locate()
 
 
 def update_many(filter, update, *args, **kwargs):
-    return self._connection_object.update_many(filter, update, *args, **kwargs)
+    try:
+        return self._connection_object.update_many(
+            filter, update, *args, **kwargs
+        )
+    finally:
+        invalidate_locate()
 
 
 def distinct(*args, **kwargs):
@@ -236,31 +462,37 @@ def aggregate(*args, **kwargs):
 
 
 def drop(*args, **kwargs):
-    return self._connection_object.drop(*args, **kwargs)
+    try:
+        return self._connection_object.drop(*args, **kwargs)
+    finally:
+        invalidate_locate()
 
 
 def delete_many(*args, **kwargs):
-    return self._connection_object.delete_many(*args, **kwargs)
-
-
-def parenthood(document):
-    assert document is not None, "This is a bug"
+    try:
+        return self._connection_object.delete_many(*args, **kwargs)
+    finally:
+        invalidate_locate()
 
-    parents = list()
 
-    while document.get("parent") is not None:
-        document = find_one({"_id": document["parent"]})
+@contextlib.contextmanager
+def bulk(*args, **kwargs):
+    """Queue writes within this block, see `AvalonMongoDB.bulk()`"""
+    try:
+        with self._connection_object.bulk(*args, **kwargs) as writer:
+            yield writer
+    finally:
+        invalidate_locate()
 
-        if document is None:
-            break
 
-        if document.get("type") == "hero_version":
-            _document = self.find_one({"_id": document["version_id"]})
-            document["data"] = _document["data"]
+def parenthood(document):
+    return self._connection_object.parenthood(document)
 
-        parents.append(document)
 
-    return parents
+def get_representation_contexts(representation_ids):
+    return self._connection_object.get_representation_contexts(
+        representation_ids
+    )
 
 
 @contextlib.contextmanager
@@ -285,6 +517,9 @@ def download(src, dst):
 
     """
 
+    # Imported on first use, as it is slow to import and rarely used
+    import requests
+
     try:
         response = requests.get(
             src,
@@ -1,10 +1,24 @@
 import os
+import re
+import importlib
+import copy
 import time
+import random
+import numbers
+import hashlib
+import itertools
 import functools
+import contextlib
+import threading
+import collections
 import logging
+import six
+import bson
+import weakref
 import pymongo
-import ctypes
 from uuid import uuid4
+from multiprocessing.pool import ThreadPool
+from six.moves.urllib.parse import urlsplit, urlunsplit, quote
 
 from avalon import schema
 
@@ -31,11 +45,265 @@ def requires_install(func):
     return decorated
 
 
+class CircuitOpenError(pymongo.errors.ConnectionFailure):
+    """Raised without contacting the database while the circuit is open"""
+
+
+# Retry policy of `auto_reconnect`, see `set_retry_policy()`
+_retry = {
+    "attempts": 10,
+    "backoff": 0.1,
+    "max_backoff": 5.0,
+    "deadline": 30.0,
+}
+
+_reconnect_stats = {
+    "retries": 0,
+    "recovered": 0,
+    "failed": 0,
+    "unsafe": 0,
+    "rejected": 0,
+    "opened": 0,
+    "closed": 0,
+}
+_reconnect_lock = threading.Lock()
+
+# Session keys of the retry policy, by option
+_RETRY_SESSION_KEYS = (
+    ("AVALON_RETRY_ATTEMPTS", "attempts", int),
+    ("AVALON_RETRY_BACKOFF", "backoff", float),
+    ("AVALON_RETRY_DEADLINE", "deadline", float),
+    ("AVALON_BREAKER_THRESHOLD", "breaker_threshold", int),
+    ("AVALON_BREAKER_RESET", "breaker_reset", float),
+)
+
+# Writes which have the same effect when applied twice
+_IDEMPOTENT_WRITES = ("delete_many", "drop")
+
+# Writes of a single document which have the same effect when applied
+# twice to the same document, i.e. when given a filter by `_id`. Other
+# filters may match another document once the first was written.
+_IDEMPOTENT_BY_ID = ("replace_one", "delete_one")
+
+# Update operators with the same effect when applied twice, which makes
+# updates filtered by `_id`, without upsert, harmless to repeat
+_IDEMPOTENT_OPERATORS = (
+    "$set", "$unset", "$setOnInsert", "$addToSet", "$pull", "$min", "$max"
+)
+
+# Renamed in pymongo 3.12, the former name is gone as of pymongo 4
+_NotPrimaryError = getattr(pymongo.errors, "NotPrimaryError", None)
+if _NotPrimaryError is None:
+    _NotPrimaryError = pymongo.errors.NotMasterError
+
+# Errors raised before a write could have been applied
+_UNSENT_ERRORS = (
+    pymongo.errors.ServerSelectionTimeoutError,
+    _NotPrimaryError,
+)
+
+
+class _CircuitBreaker(object):
+    """Fail fast once `threshold` operations in a row lost connection
+
+    After `reset` seconds a single trial operation is let through,
+    which closes the circuit on success and opens it again on failure.
+
+    """
+
+    def __init__(self, threshold=3, reset=30.0):
+        self.threshold = threshold
+        self.reset = reset
+
+        self._failures = 0
+        self._opened = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self._opened is None:
+            return "closed"
+        return "half-open" if self._trial else "open"
+
+    def allow(self):
+        with self._lock:
+            if self._opened is None:
+                return True
+
+            if not self._trial and time.time() - self._opened >= self.reset:
+                self._trial = True
+                return True
+
+            return False
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._trial = False
+            if self._opened is not None:
+                self._opened = None
+                _count_reconnect("closed")
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial:
+                # Trial failed, remain open
+                self._opened = time.time()
+                self._trial = False
+
+            elif self._opened is None and self._failures >= self.threshold:
+                self._opened = time.time()
+                _count_reconnect("opened")
+
+    def release(self):
+        """End trial of an operation which failed for another reason"""
+        with self._lock:
+            self._trial = False
+
+
+_breaker = _CircuitBreaker()
+
+
+def _reset_locks():
+    """Replace locks possibly held by other threads of a parent process"""
+    global _reconnect_lock
+    _reconnect_lock = threading.Lock()
+    _breaker._lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_locks)
+
+
+def set_retry_policy(attempts=None, backoff=None, max_backoff=None,
+                     deadline=None, breaker_threshold=None,
+                     breaker_reset=None):
+    """Set how operations are retried on loss of connection, per process
+
+    Arguments:
+        attempts (int, optional): Maximum number of attempts
+        backoff (float, optional): Seconds to wait at most before the
+            first retry, doubled with each retry
+        max_backoff (float, optional): Seconds to wait at most per retry
+        deadline (float, optional): Seconds after which to give up
+        breaker_threshold (int, optional): Operations which gave up in a
+            row before failing fast with `CircuitOpenError`
+        breaker_reset (float, optional): Seconds to fail fast for
+
+    """
+    for key, value in (("attempts", attempts),
+                       ("backoff", backoff),
+                       ("max_backoff", max_backoff),
+                       ("deadline", deadline)):
+        if value is not None:
+            _retry[key] = value
+
+    if breaker_threshold is not None:
+        _breaker.threshold = breaker_threshold
+    if breaker_reset is not None:
+        _breaker.reset = breaker_reset
+
+
+def get_retry_policy():
+    policy = dict(_retry)
+    policy["breaker_threshold"] = _breaker.threshold
+    policy["breaker_reset"] = _breaker.reset
+    return policy
+
+
+def retry_policy_from_session(session):
+    """Return arguments to `set_retry_policy()` given in `session`"""
+    options = {}
+    for key, option, type_ in _RETRY_SESSION_KEYS:
+        value = session.get(key)
+        if value:
+            options[option] = type_(value)
+    return options
+
+
+def reconnect_stats():
+    """Return counts of retries and circuit breaker events
+
+    Returns:
+        dict: Number of "retries" made, operations "recovered" by a retry,
+            operations which "failed" after retrying, writes not retried
+            as "unsafe", operations "rejected" while the circuit was open,
+            times the circuit was "opened" and "closed", along with the
+            current "state" of the circuit
+
+    """
+    with _reconnect_lock:
+        stats = dict(_reconnect_stats)
+    stats["state"] = _breaker.state
+    return stats
+
+
+def reset_reconnect_stats():
+    with _reconnect_lock:
+        for key in _reconnect_stats:
+            _reconnect_stats[key] = 0
+
+
+def _count_reconnect(key):
+    with _reconnect_lock:
+        _reconnect_stats[key] += 1
+
+
+def _is_retryable(name, args, kwargs, error):
+    """Return whether operation `name` is harmless to repeat after `error`
+
+    Reads are always repeated, whereas writes which may have been applied
+    before the connection was lost are only repeated if idempotent.
+
+    """
+    if name not in _WRITE_METHODS or name in _IDEMPOTENT_WRITES:
+        return True
+
+    if isinstance(error, _UNSENT_ERRORS):
+        return True
+
+    if name in _IDEMPOTENT_BY_ID:
+        query_filter = kwargs.get("filter", args[0] if args else None)
+        return _is_id_filter(query_filter)
+
+    # Upserts applied once would insert another document when repeated
+    if name in ("update_one", "update_many"):
+        query_filter = kwargs.get("filter", args[0] if args else None)
+        update = kwargs.get("update", args[1] if len(args) > 1 else None)
+        upsert = kwargs.get("upsert", args[2] if len(args) > 2 else False)
+        if upsert or not _is_id_filter(query_filter):
+            return False
+        return isinstance(update, dict) and all(
+            key in _IDEMPOTENT_OPERATORS for key in update
+        )
+
+    return False
+
+
+def _is_id_filter(query_filter):
+    """Return whether `query_filter` matches by `_id` equality only"""
+    if not isinstance(query_filter, dict) or "_id" not in query_filter:
+        return False
+
+    value = query_filter["_id"]
+    if isinstance(value, dict):
+        return list(value) == ["$eq"]
+    return True
+
+
 def auto_reconnect(func):
-    """Handling auto reconnect in 3 retry times"""
-    retry_times = 3
-    reconnect_msg = "Reconnecting..."
+    """Retry `func` on loss of connection, as per `set_retry_policy()`
+
+    Retries wait for a random time of up to an exponentially growing
+    backoff, such that many processes losing connection at once do not
+    reconnect in lockstep. While the process-wide circuit is open,
+    operations fail fast with `CircuitOpenError`.
+
+    """
     func_obj = getattr(func, "__self__", None)
+    offset = 0 if func_obj is not None else 1
 
     @functools.wraps(func)
     def decorated(*args, **kwargs):
@@ -44,21 +312,154 @@ def auto_reconnect(func):
         else:
             _obj = args[0]
 
-        for retry in range(1, retry_times + 1):
+        start = time.time()
+        attempt = 0
+        while True:
+            if not _breaker.allow():
+                _count_reconnect("rejected")
+                raise CircuitOpenError(
+                    "Database unreachable, retrying in at most %.0fs"
+                    % _breaker.reset
+                )
+
             try:
-                return func(*args, **kwargs)
-            except pymongo.errors.AutoReconnect:
-                if hasattr(_obj, "log"):
-                    _obj.log.warning(reconnect_msg)
-                else:
-                    print(reconnect_msg)
+                result = func(*args, **kwargs)
+
+            except pymongo.errors.AutoReconnect as e:
+                attempt += 1
+                delay = random.uniform(0, min(
+                    _retry["max_backoff"],
+                    _retry["backoff"] * 2 ** (attempt - 1)
+                ))
+                remaining = _retry["deadline"] - (time.time() - start)
+
+                if not _is_retryable(func.__name__, args[offset:], kwargs, e):
+                    _count_reconnect("unsafe")
+                elif attempt < _retry["attempts"] and delay < remaining:
+                    _count_reconnect("retries")
+                    message = "Reconnecting in %.2fs..." % delay
+                    if hasattr(_obj, "log"):
+                        _obj.log.warning(message)
+                    else:
+                        print(message)
+
+                    time.sleep(delay)
+                    continue
+
+                _breaker.failure()
+                _count_reconnect("failed")
+                raise
+
+            except Exception:
+                _breaker.release()
+                raise
+
+            _breaker.success()
+            if attempt:
+                _count_reconnect("recovered")
+            return result
 
-                if retry >= retry_times:
-                    raise
-                time.sleep(0.1)
     return decorated
 
 
+# Maximum number of project collections queried at once
+PROJECTS_CONCURRENCY = 8
+
+# Suffix of the collection of counters and pointers of each project
+META_SUFFIX = ".meta"
+
+
+def _is_active(project):
+    data = project.get("data")
+    if not isinstance(data, dict):
+        return True
+    return "active" not in data or data["active"] is True
+
+
+def _may_match_project(query_filter):
+    """Return whether `query_filter` may match a project document"""
+    if query_filter is None:
+        return True
+    type_ = query_filter.get("type")
+    return not isinstance(type_, six.string_types) or type_ == "project"
+
+
+def _is_plain_projection(projection):
+    """Return whether `projection` only includes or excludes fields"""
+    if isinstance(projection, (list, tuple)):
+        projection = dict((key, 1) for key in projection)
+
+    if not isinstance(projection, dict):
+        return False
+
+    values = set()
+    for key, value in projection.items():
+        if key.startswith("$") or ".$" in key:
+            return False
+        if value not in (0, 1):
+            return False
+        if key != "_id":
+            values.add(bool(value))
+
+    return len(values) < 2
+
+
+def _apply_projection(document, projection):
+    """Return copy of `document` with plain `projection` applied"""
+    if isinstance(projection, (list, tuple)):
+        projection = dict((key, 1) for key in projection)
+
+    fields = dict(
+        (key, value) for key, value in projection.items() if key != "_id"
+    )
+    result = {}
+    if "_id" in document and projection.get("_id", True):
+        result["_id"] = document["_id"]
+
+    if fields and all(fields.values()):
+        for key in fields:
+            _include_path(document, result, key.split("."))
+    else:
+        for key, value in document.items():
+            if key != "_id":
+                result[key] = copy.deepcopy(value)
+        for key in fields:
+            _exclude_path(result, key.split("."))
+
+    return result
+
+
+def _include_path(source, target, parts):
+    key = parts[0]
+    if key not in source:
+        return
+
+    value = source[key]
+    if len(parts) == 1:
+        target[key] = copy.deepcopy(value)
+
+    elif isinstance(value, dict):
+        _include_path(value, target.setdefault(key, {}), parts[1:])
+
+    elif isinstance(value, list):
+        items = [item for item in value if isinstance(item, dict)]
+        projected = target.setdefault(key, [{} for _ in items])
+        for item, result in zip(items, projected):
+            _include_path(item, result, parts[1:])
+
+
+def _exclude_path(target, parts):
+    value = target
+    for part in parts[:-1]:
+        value = value.get(part) if isinstance(value, dict) else None
+
+    if isinstance(value, dict):
+        value.pop(parts[-1], None)
+    elif isinstance(value, list):
+        for item in value:
+            _exclude_path(item, parts[-1:])
+
+
 SESSION_CONTEXT_KEYS = (
     # Root directory of projects on disk
     "AVALON_PROJECTS",
@@ -137,7 +538,24 @@ def session_data_from_environment(context_keys=False):
         ("AVALON_INSTANCE_ID", "avalon.instance"),
 
         # Enable debugging
-        ("AVALON_DEBUG", None)
+        ("AVALON_DEBUG", None),
+
+        # Validation of documents written to the database,
+        # one of "strict", "sample:<rate>" or "off"
+        ("AVALON_VALIDATION", None),
+
+        # Retries on loss of connection, see `set_retry_policy()`
+        ("AVALON_RETRY_ATTEMPTS", None),
+        ("AVALON_RETRY_BACKOFF", None),
+        ("AVALON_RETRY_DEADLINE", None),
+        ("AVALON_BREAKER_THRESHOLD", None),
+        ("AVALON_BREAKER_RESET", None),
+
+        # Maintain pointers to latest versions, see `latest_version_ids()`
+        ("AVALON_LATEST_POINTERS", None),
+
+        # Advance counters past inserted versions, see `reserve_versions()`
+        ("AVALON_VERSION_COUNTERS", None)
     ):
         value = os.environ.get(key) or default_value
         if value is not None:
@@ -146,262 +564,2385 @@ def session_data_from_environment(context_keys=False):
     return session_data
 
 
-class AvalonMongoConnection:
-    _mongo_client = None
-    _is_installed = False
-    _databases = {}
-    log = logging.getLogger("AvalonMongoConnection")
+# Options of the connection to MongoDB by environment variable,
+# as (URI option, type). These are read from the environment only,
+# as the client is shared by every AvalonMongoDB of a process.
+MONGO_OPTIONS = (
+    # Milliseconds to wait for a server to become available
+    ("AVALON_TIMEOUT", "serverSelectionTimeoutMS", int),
 
-    @classmethod
-    def register_database(cls, dbcon):
-        if dbcon.id in cls._databases:
-            return
+    # Maximum and minimum number of connections per server
+    ("AVALON_MONGO_MAX_POOL_SIZE", "maxPoolSize", int),
+    ("AVALON_MONGO_MIN_POOL_SIZE", "minPoolSize", int),
 
-        cls._databases[dbcon.id] = {
-            "object": dbcon,
-            "installed": False
-        }
+    # Milliseconds after which idle connections are closed
+    ("AVALON_MONGO_MAX_IDLE_TIME", "maxIdleTimeMS", int),
 
-    @classmethod
-    def database(cls):
-        return cls._mongo_client[str(os.environ["AVALON_DB"])]
+    # Milliseconds to wait for a response before giving up
+    ("AVALON_MONGO_SOCKET_TIMEOUT", "socketTimeoutMS", int),
 
-    @classmethod
-    def mongo_client(cls):
-        return cls._mongo_client
+    # Comma-separated wire compressors in order of preference,
+    # e.g. "zstd,zlib", where "zstd" and "snappy" require their
+    # respective packages, and level of zlib from -1 to 9
+    ("AVALON_MONGO_COMPRESSORS", "compressors", str),
+    ("AVALON_MONGO_ZLIB_LEVEL", "zlibCompressionLevel", int),
 
-    @classmethod
-    def install(cls, dbcon):
-        if not cls._is_installed or cls._mongo_client is None:
-            cls._mongo_client = cls.create_connection()
-            cls._is_installed = True
+    # E.g. "primaryPreferred" or "nearest" to read from secondaries
+    ("AVALON_MONGO_READ_PREFERENCE", "readPreference", str),
+)
 
-        cls.register_database(dbcon)
-        cls._databases[dbcon.id]["installed"] = True
 
-        cls.check_db_existence()
+def mongo_options(environ=None):
+    """Return options of the connection to MongoDB set in `environ`
 
-    @classmethod
-    def is_installed(cls, dbcon):
-        info = cls._databases.get(dbcon.id)
-        if not info:
-            return False
-        return cls._databases[dbcon.id]["installed"]
+    Options are not read from the Session of `AvalonMongoDB`, as one
+    client is shared by all of them, see `MONGO_OPTIONS`.
 
-    @classmethod
-    def _uninstall(cls):
-        try:
-            cls._mongo_client.close()
-        except AttributeError:
-            pass
-        cls._is_installed = False
-        cls._mongo_client = None
+    Arguments:
+        environ (dict, optional): Defaults to `os.environ`
 
-    @classmethod
-    def uninstall(cls, dbcon, force=False):
-        if force:
-            for key in cls._databases:
-                cls._databases[key]["object"].uninstall()
-            cls._uninstall()
-            return
+    Returns:
+        dict: URI options by name, see `MONGO_OPTIONS`
 
-        cls._databases[dbcon.id]["installed"] = False
+    Example:
+        >>> mongo_options({"AVALON_MONGO_MAX_POOL_SIZE": "10"})
+        {'maxPoolSize': 10}
 
-        cls.check_db_existence()
+    """
+    if environ is None:
+        environ = os.environ
 
-        any_is_installed = False
-        for key in cls._databases:
-            if cls._databases[key]["installed"]:
-                any_is_installed = True
-                break
+    options = {}
+    for key, option, type_ in MONGO_OPTIONS:
+        value = environ.get(key)
+        if value:
+            try:
+                options[option] = type_(value)
+            except ValueError:
+                raise ValueError("Invalid value of %s: %r" % (key, value))
 
-        if not any_is_installed:
-            cls._uninstall()
+    return options
 
-    @classmethod
-    def check_db_existence(cls):
-        items_to_pop = set()
-        for db_id, info in cls._databases.items():
-            obj = info["object"]
-            # TODO check if should check for 1 or more
-            cls.log.info(ctypes.c_long.from_address(id(obj)).value)
-            if ctypes.c_long.from_address(id(obj)).value == 1:
-                items_to_pop.add(db_id)
 
-        for db_id in items_to_pop:
-            cls._databases.pop(db_id, None)
+def mongo_url_with_options(url, options):
+    """Return `url` with `options` replacing those of the same name
 
-    @classmethod
-    def create_connection(cls):
-        from openpype.lib import OpenPypeMongoConnection
+    Other options of `url` are left as-is, as options may be repeated,
+    e.g. readPreferenceTags, or hold characters which are not decoded,
+    e.g. authMechanismProperties.
 
-        mongo_url = os.environ["AVALON_MONGO"]
+    Example:
+        >>> mongo_url_with_options(
+        ...     "mongodb://localhost:27017/?maxPoolSize=5&w=1",
+        ...     {"maxPoolSize": 10}
+        ... )
+        'mongodb://localhost:27017/?w=1&maxPoolSize=10'
 
-        mongo_client = OpenPypeMongoConnection.create_connection(mongo_url)
+    """
+    if not options:
+        return url
 
-        return mongo_client
+    parts = urlsplit(url)
 
+    # Options are separated by either of "&" or ";", never both
+    separator = "&"
+    if ";" in parts.query and "&" not in parts.query:
+        separator = ";"
+
+    # Names of options are case-insensitive
+    replaced = set(option.lower() for option in options)
+    query = [
+        segment for segment in parts.query.split(separator)
+        if segment and segment.split("=", 1)[0].lower() not in replaced
+    ]
+    query.extend(
+        "%s=%s" % (option, quote(str(value), safe=","))
+        for option, value in options.items()
+    )
+
+    # A path is required in front of options
+    return urlunsplit(parts._replace(
+        path=parts.path or "/",
+        query=separator.join(query)
+    ))
+
+
+def create_client(url):
+    """Return client of `url`, the client factory named "pymongo"
+
+    Creates clients without importing openpype, see `client_factory()`.
+
+    Certificate authorities et al. are given as options of `url`,
+    e.g. "mongodb://host/?tls=true&tlsCAFile=/path/to/ca.pem"
+
+    """
+    return pymongo.MongoClient(url)
+
+
+def _create_openpype_client(url):
+    from openpype.lib import OpenPypeMongoConnection
+    return OpenPypeMongoConnection.create_connection(url)
+
+
+# Callables returning a client given a URL, by name
+_client_factories = {
+    "pymongo": create_client,
+    "openpype": _create_openpype_client,
+}
+
+
+def register_client_factory(name, factory):
+    """Make `factory` available as AVALON_MONGO_FACTORY `name`
+
+    Arguments:
+        name (str): Name of factory
+        factory (callable): Called with URL of MongoDB, returning a client
+
+    """
+    _client_factories[name] = factory
+
+
+def client_factory(name=None):
+    """Return client factory of `name`
+
+    Arguments:
+        name (str, optional): Name of a registered factory, e.g.
+            "pymongo", or "package.module:function" to be imported.
+            Defaults to "openpype"
+
+    """
+    name = name or "openpype"
+    try:
+        return _client_factories[name]
+    except KeyError:
+        pass
+
+    if ":" not in name:
+        raise KeyError("No client factory named '%s'" % name)
 
-class AvalonMongoDB:
-    def __init__(self, session=None, auto_install=True):
-        self._id = uuid4()
-        self._database = None
-        self.auto_install = auto_install
+    module_name, attr_name = name.split(":", 1)
+    factory = getattr(importlib.import_module(module_name), attr_name)
+    register_client_factory(name, factory)
+    return factory
+
+
+# Collection methods which modify documents
+_WRITE_METHODS = (
+    "insert",
+    "insert_one",
+    "insert_many",
+    "update",
+    "update_one",
+    "update_many",
+    "replace_one",
+    "save",
+    "remove",
+    "delete_one",
+    "delete_many",
+    "find_one_and_update",
+    "find_one_and_replace",
+    "find_one_and_delete",
+    "find_and_modify",
+    "bulk_write",
+    "drop",
+)
 
-        if session is None:
-            session = session_data_from_environment(context_keys=False)
 
-        self.Session = session
+class _DocumentCache(object):
+    """Identity map of documents by `_id` and by type, parent and name
 
-        self.log = logging.getLogger(self.__class__.__name__)
+    Entries are evicted once older than `ttl` seconds, and least recently
+    used entries are evicted once the approximate BSON size of all entries
+    exceeds `max_bytes`.
 
-    def __getattr__(self, attr_name):
-        attr = None
-        if not self.is_installed() and self.auto_install:
-            self.install()
+    """
 
-        if not self.is_installed():
-            raise IOError(
-                "'{}.{}()' requires to run install() first".format(
-                    self.__class__.__name__, attr_name
-                )
-            )
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
 
-        project_name = self.active_project()
-        if project_name is None:
-            raise ValueError(
-                "Value of 'Session[\"AVALON_PROJECT\"]' is not set."
-            )
+        # (project, _id) -> (expiry, size, name key, document)
+        self._entries = collections.OrderedDict()
+        self._names = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
 
-        collection = self._database[project_name]
-        not_set = object()
-        attr = getattr(collection, attr_name, not_set)
+    @staticmethod
+    def key(query_filter):
+        """Return key of `query_filter` if it identifies one document"""
+        if not isinstance(query_filter, dict):
+            return None
 
-        if attr is not_set:
-            # Raise attribute error
-            raise AttributeError(
-                "{} has no attribute '{}'.".format(
-                    collection.__class__.__name__, attr_name
-                )
+        values = list(query_filter.values())
+        if any(isinstance(value, (dict, list)) for value in values):
+            return None
+
+        if list(query_filter) == ["_id"]:
+            return query_filter["_id"]
+
+        if sorted(query_filter) == ["name", "parent", "type"]:
+            return (
+                query_filter["type"],
+                query_filter["parent"],
+                query_filter["name"],
             )
 
-        # Decorate function
-        if callable(attr):
-            attr = auto_reconnect(attr)
-        return attr
+    def get(self, project_name, key):
+        with self._lock:
+            if isinstance(key, tuple):
+                key = self._names.get((project_name, key))
+            entry = self._entries.get((project_name, key))
 
-    @property
-    def mongo_client(self):
-        AvalonMongoConnection.mongo_client()
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self._pop((project_name, key))
+                self._stats["misses"] += 1
+                return None
 
-    @property
-    def id(self):
-        return self._id
+            self._entries.pop((project_name, key))
+            self._entries[(project_name, key)] = entry
+            self._stats["hits"] += 1
+            return copy.deepcopy(entry[3])
 
-    @property
-    def database(self):
-        if not self.is_installed() and self.auto_install:
-            self.install()
+    def set(self, project_name, document):
+        try:
+            size = len(bson.BSON.encode(document))
+        except (bson.errors.BSONError, TypeError):
+            return
 
-        if self.is_installed():
-            return self._database
+        if size > self.max_bytes:
+            return
 
-        raise IOError(
-            "'{}.database' requires to run install() first".format(
-                self.__class__.__name__
+        name_key = None
+        if "type" in document and "name" in document:
+            name_key = (
+                project_name,
+                (document["type"], document.get("parent"), document["name"])
             )
-        )
 
-    def is_installed(self):
-        return AvalonMongoConnection.is_installed(self)
+        key = (project_name, document["_id"])
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (
+                time.time() + self.ttl,
+                size,
+                name_key,
+                copy.deepcopy(document)
+            )
+            self._bytes += size
+            if name_key is not None:
+                self._names[name_key] = document["_id"]
+
+            while self._bytes > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+
+    def invalidate(self, project_name, query_filter=None):
+        """Forget document matching `query_filter`, or all of project"""
+        key = self.key(query_filter)
+        with self._lock:
+            if key is not None and not isinstance(key, tuple):
+                self._pop((project_name, key))
+                return
+
+            for entry_key in list(self._entries):
+                if entry_key[0] == project_name:
+                    self._pop(entry_key)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+            return stats
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
 
-    def install(self):
-        """Establish a persistent connection to the database"""
-        if self.is_installed():
+        self._bytes -= entry[1]
+        if self._names.get(entry[2]) == key[1]:
+            self._names.pop(entry[2])
+
+
+class _ResultCache(object):
+    """Query results by query, valid for one generation of their collection
+
+    Results are stored BSON encoded, such that each hit is decoded into
+    new objects which callers are free to modify.
+
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        # key -> (generation, expiry, data)
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key, generation):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                if entry[0] == generation and entry[1] >= time.time():
+                    self._entries[key] = entry
+                else:
+                    self._bytes -= len(entry[2])
+                    entry = None
+
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+
+            self._stats["hits"] += 1
+
+        return bson.BSON(entry[2]).decode()["result"]
+
+    def set(self, key, generation, result):
+        try:
+            data = bson.BSON.encode({"result": result})
+        except (bson.errors.BSONError, TypeError):
             return
 
-        AvalonMongoConnection.install(self)
+        if len(data) > self.max_bytes:
+            return
 
-        self._database = AvalonMongoConnection.database()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= len(entry[2])
 
-    def uninstall(self):
-        """Close any connection to the database"""
-        AvalonMongoConnection.uninstall(self)
-        self._database = None
+            self._entries[key] = (generation, time.time() + self.ttl, data)
+            self._bytes += len(data)
 
-    @requires_install
-    def active_project(self):
-        """Return the name of the active project"""
-        return self.Session["AVALON_PROJECT"]
+            while self._bytes > self.max_bytes:
+                entry = self._entries.popitem(last=False)[1]
+                self._bytes -= len(entry[2])
+                self._stats["evictions"] += 1
 
-    @requires_install
-    @auto_reconnect
-    def projects(self, projection=None, only_active=True):
-        """Iter project documents
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+            return stats
 
-        Args:
-            projection (optional): MongoDB query projection operation
-            only_active (optional): Skip inactive projects, default True.
 
-        Returns:
-            Project documents iterator
+class _Future(object):
+    """Result of a lookup shared by all threads waiting for it"""
 
-        """
-        query_filter = {"type": "project"}
-        if only_active:
-            query_filter.update({
-                "$or": [
-                    {"data.active": {"$exists": 0}},
-                    {"data.active": True},
-                ]
-            })
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._error = None
 
-        for project_name in self._database.collection_names():
-            if project_name in ("system.indexes",):
-                continue
+    def set(self, result=None, error=None):
+        self._result = result
+        self._error = error
+        self._event.set()
 
-            # Each collection will have exactly one project document
+    def result(self):
+        self._event.wait()
+        if self._error is not None:
+            raise self._error
+        return self._result
 
-            doc = self._database[project_name].find_one(
-                query_filter, projection=projection
-            )
-            if doc is not None:
-                yield doc
 
-    @auto_reconnect
-    def insert_one(self, item, *args, **kwargs):
-        assert isinstance(item, dict), "item must be of type <dict>"
-        schema.validate(item)
-        return self._database[self.active_project()].insert_one(
-            item, *args, **kwargs
-        )
+class _IdBatcher(object):
+    """Merge lookups of documents by `_id` into one query per window
 
-    @auto_reconnect
-    def insert_many(self, items, *args, **kwargs):
-        # check if all items are valid
-        assert isinstance(items, list), "`items` must be of type <list>"
-        for item in items:
-            assert isinstance(item, dict), "`item` must be of type <dict>"
-            schema.validate(item)
+    The first lookup of a window waits `window` seconds for lookups from
+    other threads, then finds all of them with a single `$in` query.
+    Lookups of an `_id` already being queried wait for that query rather
+    than issue another. Lookups made whilst no other thread is looking
+    up documents are queried at once, as there is nothing to wait for.
 
-        return self._database[self.active_project()].insert_many(
-            items, *args, **kwargs
-        )
+    Arguments:
+        window (float): Seconds to wait for further lookups
+        memoize (bool, optional): Keep found documents until `clear()`
 
-    def parenthood(self, document):
-        assert document is not None, "This is a bug"
+    """
 
-        parents = list()
+    def __init__(self, window, memoize=False):
+        self.window = window
+        self.memoize = memoize
 
-        while document.get("parent") is not None:
-            document = self.find_one({"_id": document["parent"]})
-            if document is None:
-                break
+        self._lock = threading.Lock()
+        self._futures = {}  # (project, _id) -> _Future
+        self._open = {}  # project -> [_id, ...] waiting to be queried
+        self._memo = {}
+        self._stats = {"lookups": 0, "queries": 0}
+        self._callers = 0  # Threads within `load()`
+
+    def load(self, project_name, _id, find):
+        """Return copy of document with `_id`, or None
+
+        Arguments:
+            project_name (str): Name of collection
+            _id (ObjectId): Identifier of document
+            find (callable): `find()` of collection of project
+
+        """
+        key = (project_name, _id)
+        leader = False
+        with self._lock:
+            self._stats["lookups"] += 1
+            self._callers += 1
+            concurrent = self._callers > 1
+            future = self._memo.get(key) or self._futures.get(key)
+            if future is None:
+                future = self._futures[key] = _Future()
+                batch = self._open.get(project_name)
+                if batch is None:
+                    batch = self._open[project_name] = []
+                    leader = True
+                batch.append(_id)
+
+        try:
+            if leader:
+                self._query(project_name, find, wait=concurrent)
+
+            return copy.deepcopy(future.result())
+        finally:
+            with self._lock:
+                self._callers -= 1
+
+    def clear(self):
+        """Forget memoized documents, e.g. after a write"""
+        with self._lock:
+            self._memo.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
 
-            if document.get("type") == "hero_version":
-                _document = self.find_one({"_id": document["version_id"]})
-                document["data"] = _document["data"]
+    def _query(self, project_name, find, wait=True):
+        if wait and self.window:
+            time.sleep(self.window)
 
-            parents.append(document)
+        with self._lock:
+            ids = self._open.pop(project_name)
+            self._stats["queries"] += 1
 
-        return parents
+        documents = {}
+        error = None
+        try:
+            for document in find({"_id": {"$in": ids}}):
+                documents[document["_id"]] = document
+        except Exception as e:
+            error = e
+
+        with self._lock:
+            for _id in ids:
+                future = self._futures.pop((project_name, _id))
+                future.set(documents.get(_id), error)
+
+                # Misses are not kept, as inserts do not clear the memo
+                if self.memoize and _id in documents:
+                    self._memo[(project_name, _id)] = future
+
+
+class BulkWriter(object):
+    """Queue of writes, validated and sent in batches with `bulk_write()`
+
+    Batches are sent once `max_operations` writes or `max_bytes` of BSON
+    are queued, and on `flush()`. In ordered mode, writes queued after
+    one which failed are skipped, as per `bulk_write(ordered=True)`.
+
+    See `AvalonMongoDB.bulk()`.
+
+    """
+
+    def __init__(self, dbcon, ordered=False, max_operations=1000,
+                 max_bytes=8 * 1024 ** 2):
+        self.dbcon = dbcon
+        self.ordered = ordered
+        self.max_operations = max_operations
+        self.max_bytes = max_bytes
+
+        self.result = {
+            "inserted": 0,
+            "matched": 0,
+            "modified": 0,
+            "deleted": 0,
+            "upserted": 0,
+            "skipped": 0,
+            "upserted_ids": {},
+            "errors": [],
+        }
+
+        # Queued (index, operation, name) and BSON size thereof
+        self._queue = []
+        self._bytes = 0
+        self._count = 0
+        self._failed = False
+        self._project_inserted = False
+
+        # Inserted versions by index, see `AvalonMongoDB.latest_version_ids`
+        self._versions = {}
+
+    def insert_one(self, document):
+        """Queue insert of `document`, validated as per the policy"""
+        assert isinstance(document, dict), "document must be of type <dict>"
+        schema.check(document)
+        if document.get("type") == "project":
+            self._project_inserted = True
+
+        if document.get("type") == "version":
+            # Queued by `_add()` under the next index, flushed or not
+            self._versions[self._count] = document
+        return self._add(pymongo.InsertOne(document), document)
+
+    def replace_one(self, filter, replacement, upsert=False):
+        """Queue replacement, validated as per `AvalonMongoDB.replace_one()`"""
+        assert isinstance(replacement, dict), (
+            "replacement must be of type <dict>"
+        )
+        replacement = self.dbcon._check_replacement(filter, replacement)
+        return self._add(
+            pymongo.ReplaceOne(filter, replacement, upsert=upsert),
+            {"q": filter, "u": replacement}
+        )
+
+    def update_one(self, filter, update, upsert=False, schema_name=None):
+        """Queue update, validated as per `AvalonMongoDB.update_one()`"""
+        self.dbcon._validate_update(filter, update, schema_name)
+        return self._add(
+            pymongo.UpdateOne(filter, update, upsert=upsert),
+            {"q": filter, "u": update}
+        )
+
+    def update_many(self, filter, update, upsert=False, schema_name=None):
+        self.dbcon._validate_update(filter, update, schema_name)
+        return self._add(
+            pymongo.UpdateMany(filter, update, upsert=upsert),
+            {"q": filter, "u": update}
+        )
+
+    def delete_one(self, filter):
+        return self._add(pymongo.DeleteOne(filter), filter)
+
+    def delete_many(self, filter):
+        return self._add(pymongo.DeleteMany(filter), filter)
+
+    def flush(self):
+        """Send queued writes, returning aggregated `result`
+
+        Writes remain queued when sending them fails other than by
+        errors of individual writes, e.g. on losing the connection.
+
+        """
+        queue = self._queue
+        if not queue:
+            return self.result
+
+        if self._failed:
+            self._queue, self._bytes = [], 0
+            self.result["skipped"] += len(queue)
+            return self.result
+
+        indices = [index for index, operation in queue]
+        try:
+            details = self.dbcon.__getattr__("bulk_write")(
+                [operation for index, operation in queue],
+                ordered=self.ordered
+            ).bulk_api_result
+        except pymongo.errors.BulkWriteError as e:
+            details = e.details
+            if self.ordered:
+                self._failed = True
+
+        self._queue, self._bytes = [], 0
+        self._aggregate(details, indices)
+
+        inserted = [
+            index for index in indices if index in self._versions
+        ]
+        if inserted:
+            failed = set(error["index"] for error in self.result["errors"])
+            errors = details.get("writeErrors")
+            if self.ordered and errors:
+                # Writes after the first error were skipped
+                failed.update(indices[errors[0]["index"]:])
+            self.dbcon._versions_inserted([
+                self._versions.pop(index) for index in inserted
+                if index not in failed
+            ])
+
+        if self._project_inserted:
+            self._project_inserted = False
+            self.dbcon.invalidate_projects()
+
+        return self.result
+
+    def _add(self, operation, data):
+        """Queue `operation`, returning its index"""
+        try:
+            size = len(bson.BSON.encode(data))
+        except (bson.errors.BSONError, TypeError):
+            size = 0
+
+        if self._queue and self._bytes + size > self.max_bytes:
+            self.flush()
+
+        index = self._count
+        self._count += 1
+        self._queue.append((index, operation))
+        self._bytes += size
+
+        if len(self._queue) >= self.max_operations:
+            self.flush()
+
+        return index
+
+    def _aggregate(self, details, indices):
+        result = self.result
+        result["inserted"] += details.get("nInserted", 0)
+        result["matched"] += details.get("nMatched", 0)
+        result["modified"] += details.get("nModified", 0)
+        result["deleted"] += details.get("nRemoved", 0)
+        result["upserted"] += details.get("nUpserted", 0)
+
+        for upserted in details.get("upserted", []):
+            result["upserted_ids"][indices[upserted["index"]]] = (
+                upserted["_id"]
+            )
+
+        errors = details.get("writeErrors", [])
+        for error in errors:
+            result["errors"].append({
+                "index": indices[error["index"]],
+                "code": error.get("code"),
+                "message": error.get("errmsg"),
+            })
+
+        for error in details.get("writeConcernErrors", []):
+            result["errors"].append({
+                "index": None,
+                "code": error.get("code"),
+                "message": error.get("errmsg"),
+            })
+
+        # Ordered writes stop at the first error
+        if self.ordered and errors:
+            result["skipped"] += len(indices) - errors[0]["index"] - 1
+
+
+def _derived_id(parent_id, name):
+    """Return identifier of auxiliary document `name` of `parent_id`
+
+    Identifiers are derived from the parent, such that concurrent attempts
+    at creating the same document collide rather than create duplicates.
+
+    """
+    digest = hashlib.sha1(
+        ("counter:%s:%s" % (name, parent_id)).encode("utf-8")
+    ).digest()
+    return bson.ObjectId(digest[:12])
+
+
+def _aggregation_target(pipeline):
+    """Return (database, collection) written by `pipeline`, if any
+
+    The database is None when that of the aggregated collection.
+
+    """
+    for stage in pipeline or []:
+        if not isinstance(stage, dict):
+            continue
+
+        target = stage.get("$out")
+        if target is None:
+            target = stage.get("$merge")
+            if isinstance(target, dict):
+                target = target.get("into")
+        if target is None:
+            continue
+
+        if isinstance(target, dict):
+            return target.get("db"), target.get("coll")
+        return None, target
+
+    return None
+
+
+def _query_key(value):
+    """Return comparable key of filter, projection or sort
+
+    Top-level keys of filters and projections match in any order,
+    whereas embedded documents only match in the same order of keys.
+
+    """
+    if isinstance(value, dict):
+        return repr(sorted(value.items(), key=lambda item: item[0]))
+    if isinstance(value, (list, tuple)) and all(
+        isinstance(item, six.string_types) for item in value
+    ):
+        return repr(sorted(value))
+    return repr(value)
+
+
+class AvalonMongoConnection:
+    _mongo_client = None
+    _is_installed = False
+    _projects = {}
+
+    # Weak references to registered AvalonMongoDB objects by id,
+    # and ids of those installed
+    _databases = {}
+    _installed = set()
+    _lock = threading.RLock()
+
+    # Process of `_mongo_client`, and ids of objects installed in
+    # the parent process yet to be installed in this one
+    _pid = os.getpid()
+    _forked = set()
+
+    _generations = {}
+    _generations_lock = threading.Lock()
+    log = logging.getLogger("AvalonMongoConnection")
+
+    # Seconds for which project documents are reused
+    projects_ttl = 10.0
+
+    @classmethod
+    def projects_cache(cls, documents=None):
+        """Get or set cached project documents of current database"""
+        key = str(os.environ["AVALON_DB"])
+        if documents is not None:
+            cls._projects[key] = (time.time(), documents)
+            return documents
+
+        cached = cls._projects.get(key)
+        if cached is None or time.time() - cached[0] > cls.projects_ttl:
+            return None
+        return cached[1]
+
+    @classmethod
+    def invalidate_projects(cls):
+        cls._projects.clear()
+
+    @classmethod
+    def generation(cls, database_name, project_name):
+        """Return number of writes made to collection of project"""
+        return cls._generations.get((database_name, project_name), 0)
+
+    @classmethod
+    def bump_generation(cls, database_name, project_name):
+        key = (database_name, project_name)
+        with cls._generations_lock:
+            cls._generations[key] = cls._generations.get(key, 0) + 1
+
+    @classmethod
+    def register_database(cls, dbcon):
+        with cls._lock:
+            if dbcon.id in cls._databases:
+                return
+
+            cls._databases[dbcon.id] = weakref.ref(
+                dbcon, functools.partial(cls._forget, dbcon.id)
+            )
+
+    @classmethod
+    def _forget(cls, db_id, reference=None):
+        # Called on garbage collection, possibly while the lock is held
+        # by this very thread, hence no lock and only atomic operations
+        cls._databases.pop(db_id, None)
+        cls._installed.discard(db_id)
+
+    @classmethod
+    def database(cls):
+        return cls._mongo_client[str(os.environ["AVALON_DB"])]
+
+    @classmethod
+    def mongo_client(cls):
+        return cls._mongo_client
+
+    @classmethod
+    def install(cls, dbcon):
+        """Install `dbcon`, connecting unless already connected
+
+        Returns:
+            pymongo.database.Database: Database of `dbcon`
+
+        """
+        with cls._lock:
+            if cls._pid != os.getpid():
+                cls._after_fork()
+
+            if not cls._is_installed or cls._mongo_client is None:
+                cls._mongo_client = cls.create_connection()
+                cls._is_installed = True
+
+            cls.register_database(dbcon)
+            cls._installed.add(dbcon.id)
+            cls._forked.discard(dbcon.id)
+
+            return cls.database()
+
+    @classmethod
+    def is_installed(cls, dbcon):
+        if cls._pid != os.getpid():
+            cls._after_fork()
+        return dbcon.id in cls._installed
+
+    @classmethod
+    def installed_before_fork(cls, dbcon):
+        """Return whether `dbcon` was installed in the parent process"""
+        with cls._lock:
+            if dbcon.id not in cls._forked:
+                return False
+            cls._forked.discard(dbcon.id)
+            return True
+
+    @classmethod
+    def _after_fork(cls):
+        """Forget the client of the parent process, in the child process
+
+        A client must not be used, nor closed, by a child process, see
+        https://pymongo.readthedocs.io/en/stable/faq.html#is-pymongo-fork-safe
+        Objects installed in the parent are installed again on first use.
+
+        """
+        # Locks may have been held by other threads of the parent
+        cls._lock = threading.RLock()
+        cls._generations_lock = threading.Lock()
+
+        cls._pid = os.getpid()
+        cls._mongo_client = None
+        cls._is_installed = False
+        cls._forked.update(cls._installed)
+        cls._installed.clear()
+
+        for reference in list(cls._databases.values()):
+            obj = reference()
+            if obj is not None:
+                obj._after_fork()
+
+    @classmethod
+    def _uninstall(cls):
+        try:
+            cls._mongo_client.close()
+        except AttributeError:
+            pass
+        cls._is_installed = False
+        cls._mongo_client = None
+        cls._projects.clear()
+
+    @classmethod
+    def uninstall(cls, dbcon, force=False):
+        if force:
+            with cls._lock:
+                references = list(cls._databases.values())
+            for reference in references:
+                obj = reference()
+                if obj is not None:
+                    obj.uninstall()
+            cls._uninstall()
+            return
+
+        with cls._lock:
+            cls._installed.discard(dbcon.id)
+            cls._forked.discard(dbcon.id)
+            if not cls._installed:
+                cls._uninstall()
+
+    @classmethod
+    def check_db_existence(cls):
+        """Kept for backwards compatibility
+
+        Objects are forgotten as they are garbage collected.
+
+        """
+
+    @classmethod
+    def create_connection(cls):
+        """Connect to AVALON_MONGO, with options of `mongo_options()`
+
+        The client is created by the factory named by AVALON_MONGO_FACTORY,
+        see `client_factory()`. Both are read from the environment only,
+        as the client is shared by every AvalonMongoDB of a process.
+
+        """
+        factory = client_factory(os.environ.get("AVALON_MONGO_FACTORY"))
+        mongo_url = mongo_url_with_options(
+            os.environ["AVALON_MONGO"], mongo_options()
+        )
+
+        return factory(mongo_url)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=AvalonMongoConnection._after_fork)
+
+
+class AvalonMongoDB:
+    def __init__(self, session=None, auto_install=True):
+        self._id = uuid4()
+        self._database = None
+        self.auto_install = auto_install
+
+        # Reconnect-wrapped collection attributes of the active project,
+        # as (database, project name, attributes by name)
+        self._collection_attributes = (None, None, {})
+
+        # Opt-in, see `enable_document_cache()` and `enable_result_cache()`
+        self._document_cache = None
+        self._result_cache = None
+
+        # Opt-in, see `enable_batching()` and `batched()`
+        self._batcher = None
+
+        if session is None:
+            session = session_data_from_environment(context_keys=False)
+
+        self.Session = session
+
+        self.log = logging.getLogger(self.__class__.__name__)
+
+    def __getattr__(self, attr_name):
+        # Avoid recursion on attributes not yet set by __init__
+        try:
+            cached = self.__dict__["_collection_attributes"]
+        except KeyError:
+            raise AttributeError(attr_name)
+
+        database, project_name, attributes = cached
+        is_current = database is not None and database is self._database
+        if is_current and project_name == self.Session.get("AVALON_PROJECT"):
+            try:
+                return attributes[attr_name]
+            except KeyError:
+                pass
+
+        attr = self._collection_attribute(attr_name)
+
+        # Attributes are only valid for the collection they came from
+        project_name = self.Session["AVALON_PROJECT"]
+        if database is not self._database or cached[1] != project_name:
+            attributes = {}
+            self._collection_attributes = (
+                self._database, project_name, attributes
+            )
+        attributes[attr_name] = attr
+
+        return attr
+
+    def _collection_attribute(self, attr_name):
+        """Return attribute of collection of active project"""
+        attr = None
+        if not self.is_installed() and self.auto_install:
+            self.install()
+
+        if not self.is_installed():
+            raise IOError(
+                "'{}.{}()' requires to run install() first".format(
+                    self.__class__.__name__, attr_name
+                )
+            )
+
+        project_name = self.active_project()
+        if project_name is None:
+            raise ValueError(
+                "Value of 'Session[\"AVALON_PROJECT\"]' is not set."
+            )
+
+        collection = self._database[project_name]
+        not_set = object()
+        attr = getattr(collection, attr_name, not_set)
+
+        if attr is not_set:
+            # Raise attribute error
+            raise AttributeError(
+                "{} has no attribute '{}'.".format(
+                    collection.__class__.__name__, attr_name
+                )
+            )
+
+        # Decorate function
+        if callable(attr):
+            attr = auto_reconnect(attr)
+
+        if attr_name in _WRITE_METHODS:
+            attr = self._invalidating(
+                attr, project_name, attr_name.startswith("insert")
+            )
+
+        return attr
+
+    def _meta_attribute(self, attr_name):
+        """Return attribute of collection of counters and pointers
+
+        Counters of `reserve_versions()` and pointers of
+        `latest_version_ids()` are kept apart from documents of the
+        project, such that queries by parent never match them and
+        writes of them leave cached documents and results as is.
+
+        """
+        collection = self._database[self.active_project() + META_SUFFIX]
+        return auto_reconnect(getattr(collection, attr_name))
+
+    def _invalidating(self, func, project_name, inserted=False):
+        """Wrap write `func` to invalidate cached documents of project"""
+        @functools.wraps(func)
+        def decorated(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._on_write(project_name, inserted=inserted)
+        return decorated
+
+    def _on_write(self, project_name, query_filter=None, inserted=False):
+        """Forget cached documents and results possibly changed by a write
+
+        Arguments:
+            project_name (str): Name of written collection
+            query_filter (dict, optional): Filter of updated documents,
+                defaults to any document of the collection
+            inserted (bool, optional): Whether documents were only added
+
+        """
+        if self._database is not None:
+            AvalonMongoConnection.bump_generation(self._database.name,
+                                                  project_name)
+
+        # New documents never replace a cached one
+        if self._document_cache is not None and not inserted:
+            self._document_cache.invalidate(project_name, query_filter)
+
+        if self._batcher is not None and not inserted:
+            self._batcher.clear()
+
+        # Projects may have been deactivated, renamed or removed
+        if not inserted and _may_match_project(query_filter):
+            AvalonMongoConnection.invalidate_projects()
+
+    def enable_document_cache(self, max_bytes=64 * 1024 ** 2, ttl=300):
+        """Cache documents found by `_id` or by type, parent and name
+
+        Documents found with `find_one()` are kept in memory and returned
+        as copies on subsequent lookups. Updates, replacements and
+        deletions made through this object forget affected documents.
+
+        Arguments:
+            max_bytes (int, optional): Approximate memory budget, in BSON
+            ttl (float, optional): Seconds after which documents are
+                read anew, e.g. to pick up writes from other processes
+
+        """
+        self._document_cache = _DocumentCache(max_bytes, ttl)
+
+    def disable_document_cache(self):
+        self._document_cache = None
+
+    def document_cache_stats(self):
+        """Return "hits", "misses", "evictions", "entries" and "bytes"
+
+        Returns:
+            dict or None if the document cache is not enabled
+
+        """
+        if self._document_cache is None:
+            return None
+        return self._document_cache.stats()
+
+    def enable_result_cache(self, max_bytes=64 * 1024 ** 2, ttl=10):
+        """Cache results of `find_cached()`, `distinct()` and `aggregate()`
+
+        Results are reused for identical queries until any document of
+        the collection is written through an `AvalonMongoDB` of this
+        process, or until `ttl` seconds have passed, e.g. to pick up
+        writes from other processes.
+
+        `find()` is never cached, as it returns a cursor, whereas
+        `find_cached()` returns a list of documents.
+
+        Arguments:
+            max_bytes (int, optional): Approximate memory budget, in BSON
+            ttl (float, optional): Seconds for which results are reused
+
+        """
+        self._result_cache = _ResultCache(max_bytes, ttl)
+
+    def disable_result_cache(self):
+        self._result_cache = None
+
+    def result_cache_stats(self):
+        """Return "hits", "misses", "evictions", "entries" and "bytes"
+
+        Returns:
+            dict or None if the result cache is not enabled
+
+        """
+        if self._result_cache is None:
+            return None
+        return self._result_cache.stats()
+
+    def find_cached(self, filter=None, projection=None, sort=None):
+        """Return list of documents found, reused as per the result cache
+
+        Unlike `find()`, which always returns a cursor, documents are
+        returned as a list, whether or not the result cache is enabled.
+
+        """
+        key = (
+            "find",
+            _query_key(filter),
+            _query_key(projection),
+            _query_key(sort),
+        )
+        return list(self._cached_query(
+            "find", key, filter, projection=projection, sort=sort
+        ))
+
+    def distinct(self, key, filter=None, *args, **kwargs):
+        query_key = None
+        if not args and not kwargs:
+            query_key = ("distinct", key, _query_key(filter))
+        return self._cached_query(
+            "distinct", query_key, key, filter, *args, **kwargs
+        )
+
+    def aggregate(self, pipeline, *args, **kwargs):
+        target = _aggregation_target(pipeline)
+        if target is not None:
+            # Results are written, and repeated aggregations write anew
+            database_name, collection_name = target
+            try:
+                return self.__getattr__("aggregate")(
+                    pipeline, *args, **kwargs
+                )
+            finally:
+                if database_name in (None, self._database.name):
+                    self._on_write(collection_name)
+                else:
+                    AvalonMongoConnection.bump_generation(database_name,
+                                                          collection_name)
+
+        key = None
+        if not args and not kwargs:
+            key = ("aggregate", repr(pipeline))
+        return self._cached_query("aggregate", key, pipeline, *args, **kwargs)
+
+    def _cached_query(self, method, key, *args, **kwargs):
+        func = self.__getattr__(method)
+        cache = self._result_cache
+        if cache is None or key is None:
+            return func(*args, **kwargs)
+
+        # Generation is read first, such that results of a query
+        # overlapping with a write are not reused thereafter
+        project_name = self.active_project()
+        database_name = self._database.name
+        generation = AvalonMongoConnection.generation(
+            database_name, project_name
+        )
+
+        key = (database_name, project_name) + key
+        result = cache.get(key, generation)
+        if result is None:
+            result = list(func(*args, **kwargs))
+            cache.set(key, generation, result)
+
+        return result
+
+    def enable_batching(self, window=0.002):
+        """Merge `find_one()` by `_id` from concurrent threads
+
+        Lookups issued within `window` seconds of each other are found
+        with a single `$in` query, and lookups of a document already
+        being queried share that query. Each caller is handed its own
+        copy of the document.
+
+        Arguments:
+            window (float, optional): Seconds to wait for further lookups
+
+        """
+        self._batcher = _IdBatcher(window)
+
+    def disable_batching(self):
+        self._batcher = None
+
+    @contextlib.contextmanager
+    def batched(self, window=0.002):
+        """Batch and memoize `find_one()` by `_id` within this block
+
+        Lookups are merged as per `enable_batching()`, and documents found
+        are reused for repeated lookups until the block exits or a write
+        is made through this object.
+
+        Example:
+            >>> with dbcon.batched():  # doctest: +SKIP
+            ...     for representation in representations:
+            ...         version = dbcon.find_one({
+            ...             "_id": representation["parent"]
+            ...         })
+
+        """
+        previous = self._batcher
+        self._batcher = _IdBatcher(window, memoize=True)
+        try:
+            yield self._batcher
+        finally:
+            self._batcher = previous
+
+    def find_one(self, filter=None, *args, **kwargs):
+        cache = self._document_cache
+        batcher = self._batcher
+        if cache is None and batcher is None:
+            return self.__getattr__("find_one")(filter, *args, **kwargs)
+
+        # Only plain lookups, with an optional projection, are cached
+        projection = kwargs.get("projection", args[0] if args else None)
+        key = _DocumentCache.key(filter)
+        plain = all((
+            len(args) + len(kwargs) <= 1,
+            not set(kwargs) - {"projection"},
+            projection is None or _is_plain_projection(projection),
+        ))
+        if key is None or not plain:
+            return self.__getattr__("find_one")(filter, *args, **kwargs)
+
+        # Lookups by type, parent and name are not batched
+        by_id = not isinstance(key, tuple)
+        if cache is None and not by_id:
+            return self.__getattr__("find_one")(filter, *args, **kwargs)
+
+        project_name = self.active_project()
+        document = None
+        if cache is not None:
+            document = cache.get(project_name, key)
+
+        if document is None:
+            if batcher is not None and by_id:
+                document = batcher.load(
+                    project_name, key, self.__getattr__("find")
+                )
+            elif projection is not None:
+                return self.__getattr__("find_one")(filter, *args, **kwargs)
+            else:
+                document = self.__getattr__("find_one")(filter)
+
+            if document is None:
+                return None
+
+            if cache is not None:
+                cache.set(project_name, document)
+
+        if projection is not None:
+            document = _apply_projection(document, projection)
+
+        return document
+
+    @property
+    def mongo_client(self):
+        AvalonMongoConnection.mongo_client()
+
+    @property
+    def id(self):
+        return self._id
+
+    @property
+    def database(self):
+        if not self.is_installed() and self.auto_install:
+            self.install()
+
+        if self.is_installed():
+            return self._database
+
+        raise IOError(
+            "'{}.database' requires to run install() first".format(
+                self.__class__.__name__
+            )
+        )
+
+    def is_installed(self):
+        if AvalonMongoConnection.is_installed(self):
+            return True
+
+        # Installed in the parent process, connect anew in this one
+        if AvalonMongoConnection.installed_before_fork(self):
+            self.install()
+            return True
+
+        return False
+
+    def install(self):
+        """Establish a persistent connection to the database"""
+        if self.is_installed():
+            return
+
+        self._database = AvalonMongoConnection.install(self)
+
+        if self.Session.get("AVALON_VALIDATION"):
+            schema.set_policy(self.Session["AVALON_VALIDATION"])
+
+        set_retry_policy(**retry_policy_from_session(self.Session))
+
+    def _after_fork(self):
+        """Forget state of the parent process, see `AvalonMongoConnection`"""
+        self._database = None
+        self._collection_attributes = (None, None, {})
+
+        # Locks of caches may have been held by other threads of the parent
+        if self._document_cache is not None:
+            self.enable_document_cache(self._document_cache.max_bytes,
+                                       self._document_cache.ttl)
+        if self._result_cache is not None:
+            self.enable_result_cache(self._result_cache.max_bytes,
+                                     self._result_cache.ttl)
+        if self._batcher is not None:
+            self._batcher = _IdBatcher(self._batcher.window,
+                                       self._batcher.memoize)
+
+    def uninstall(self):
+        """Close any connection to the database"""
+        AvalonMongoConnection.uninstall(self)
+        self._database = None
+        self._collection_attributes = (None, None, {})
+
+    @requires_install
+    def active_project(self):
+        """Return the name of the active project"""
+        return self.Session["AVALON_PROJECT"]
+
+    @requires_install
+    @auto_reconnect
+    def projects(self, projection=None, only_active=True):
+        """Iter project documents
+
+        Documents are read from a catalog of all projects, shared by all
+        connections to the same database and refreshed after
+        `AvalonMongoConnection.projects_ttl` seconds or on
+        `invalidate_projects()`.
+
+        Args:
+            projection (optional): MongoDB query projection operation
+            only_active (optional): Skip inactive projects, default True.
+
+        Returns:
+            Project documents iterator
+
+        """
+        if projection is not None and not _is_plain_projection(projection):
+            query_filter = {"type": "project"}
+            if only_active:
+                query_filter.update({
+                    "$or": [
+                        {"data.active": {"$exists": 0}},
+                        {"data.active": True},
+                    ]
+                })
+            return iter(self._find_projects(query_filter, projection))
+
+        documents = list()
+        for document in self._project_catalog():
+            if only_active and not _is_active(document):
+                continue
+
+            if projection is None:
+                document = copy.deepcopy(document)
+            else:
+                document = _apply_projection(document, projection)
+            documents.append(document)
+
+        return iter(documents)
+
+    @requires_install
+    @auto_reconnect
+    def project_names(self, only_active=True):
+        """Return names of projects, see `projects()`"""
+        return [
+            document["name"]
+            for document in self._project_catalog()
+            if not only_active or _is_active(document)
+        ]
+
+    def invalidate_projects(self):
+        """Read project documents anew on next call to `projects()`"""
+        AvalonMongoConnection.invalidate_projects()
+
+    def _project_catalog(self):
+        cached = AvalonMongoConnection.projects_cache()
+        if cached is None:
+            cached = self._find_projects({"type": "project"})
+            AvalonMongoConnection.projects_cache(cached)
+        return cached
+
+    def _find_projects(self, query_filter, projection=None):
+        """Find project document of each collection, in parallel"""
+        project_names = [
+            name for name in self._database.list_collection_names()
+            if not name.startswith("system.")
+            if not name.endswith(META_SUFFIX)
+        ]
+        if not project_names:
+            return []
+
+        # Each collection will have exactly one project document
+        def find_project(project_name):
+            return self._database[project_name].find_one(
+                query_filter, projection=projection
+            )
+
+        pool = ThreadPool(min(len(project_names), PROJECTS_CONCURRENCY))
+        try:
+            documents = pool.map(find_project, project_names)
+        finally:
+            pool.close()
+            pool.join()
+
+        return [document for document in documents if document is not None]
+
+    @auto_reconnect
+    def insert_one(self, item, *args, **kwargs):
+        assert isinstance(item, dict), "item must be of type <dict>"
+        schema.check(item)
+        if item.get("type") == "project":
+            self.invalidate_projects()
+        project_name = self.active_project()
+        try:
+            result = self._database[project_name].insert_one(
+                item, *args, **kwargs
+            )
+        finally:
+            self._on_write(project_name, inserted=True)
+
+        self._versions_inserted([item])
+        return result
+
+    @auto_reconnect
+    def insert_many(self, items, *args, **kwargs):
+        # check if all items are valid
+        assert isinstance(items, list), "`items` must be of type <list>"
+        for item in items:
+            assert isinstance(item, dict), "`item` must be of type <dict>"
+
+        errors = schema.check_many(items)
+        if errors:
+            for index, error in errors:
+                self.log.debug("Item %d is invalid: %s", index, error.message)
+            self.log.warning(
+                "%d of %d items are invalid", len(errors), len(items)
+            )
+            raise errors[0][1]
+
+        if any(item.get("type") == "project" for item in items):
+            self.invalidate_projects()
+
+        project_name = self.active_project()
+        try:
+            result = self._database[project_name].insert_many(
+                items, *args, **kwargs
+            )
+        finally:
+            self._on_write(project_name, inserted=True)
+
+        self._versions_inserted(items)
+        return result
+
+    @requires_install
+    @auto_reconnect
+    def update_one(self, filter, update, *args, **kwargs):
+        """Update a document, validating `update` against its schema
+
+        The schema is taken from the `schema_name` keyword argument, e.g.
+        "version-3.0", the "schema" set by `update` or that of `filter`.
+        Otherwise, when `filter` names a "type", the schemas declared by
+        the matching documents are read from the database. Updates are
+        not validated when no schema is known.
+
+        """
+        self._validate_update(filter, update, kwargs.pop("schema_name", None))
+        project_name = self.active_project()
+        try:
+            return self._database[project_name].update_one(
+                filter, update, *args, **kwargs
+            )
+        finally:
+            self._on_write(project_name, filter)
+
+    @requires_install
+    @auto_reconnect
+    def update_many(self, filter, update, *args, **kwargs):
+        """Update documents, validating `update` like `update_one`"""
+        self._validate_update(filter, update, kwargs.pop("schema_name", None))
+        project_name = self.active_project()
+        try:
+            return self._database[project_name].update_many(
+                filter, update, *args, **kwargs
+            )
+        finally:
+            self._on_write(project_name, filter)
+
+    @requires_install
+    @auto_reconnect
+    def replace_one(self, filter, replacement, *args, **kwargs):
+        """Replace a document, validating `replacement` against its schema
+
+        Replacements without a "schema" key are given that of the
+        document they replace, and are rejected when there is none.
+
+        """
+        assert isinstance(replacement, dict), (
+            "replacement must be of type <dict>"
+        )
+        replacement = self._check_replacement(filter, replacement)
+        project_name = self.active_project()
+        try:
+            return self._database[project_name].replace_one(
+                filter, replacement, *args, **kwargs
+            )
+        finally:
+            self._on_write(project_name, filter)
+
+    def _check_replacement(self, query_filter, replacement):
+        if "schema" not in replacement:
+            document = self.find_one(query_filter, projection={"schema": 1})
+            if document is None or "schema" not in document:
+                raise schema.ValidationError(
+                    "Replacement has no \"schema\" and there is no "
+                    "document with one to replace"
+                )
+            replacement = dict(replacement, schema=document["schema"])
+
+        schema.check(replacement)
+        return replacement
+
+    def _validate_update(self, query_filter, update, schema_name=None):
+        # Aggregation pipelines are left to the server
+        if not isinstance(update, dict):
+            return
+
+        schemas = None
+        if schema_name is None:
+            value = query_filter.get("schema")
+            if isinstance(value, six.string_types):
+                schema_name = value
+
+            # Schemas of typed documents are read as and when validated
+            elif isinstance(query_filter.get("type"), six.string_types):
+                schemas = functools.partial(
+                    self.__getattr__("distinct"), "schema", query_filter
+                )
+
+        schema.check_update(update, schema_name, schemas)
+
+    @contextlib.contextmanager
+    def bulk(self, ordered=False, max_operations=1000,
+             max_bytes=8 * 1024 ** 2):
+        """Queue writes within this block, sent with `bulk_write()`
+
+        Inserts and replacements are validated as they are queued, like
+        those of `insert_one()` and `replace_one()`, and writes are sent in
+        batches of at most `max_operations` writes or `max_bytes` of BSON.
+        Remaining writes are sent as the block exits, unless by exception.
+
+        Errors of individual writes are reported in the "errors" of the
+        result, by index of the write in order of being queued, rather
+        than raised.
+
+        Arguments:
+            ordered (bool, optional): Stop at the first failed write
+            max_operations (int, optional): Maximum writes per batch
+            max_bytes (int, optional): Approximate maximum size per batch
+
+        Example:
+            >>> with dbcon.bulk() as bulk:  # doctest: +SKIP
+            ...     bulk.insert_one(version)
+            ...     bulk.update_one({"_id": subset["_id"]},
+            ...                     {"$set": {"data.families": families}})
+            >>> bulk.result["errors"]  # doctest: +SKIP
+            []
+
+        Yields:
+            BulkWriter: With "inserted", "matched", "modified", "deleted",
+                "upserted" and "skipped" counts, "upserted_ids" by index
+                and "errors" in its `result`
+
+        """
+        writer = BulkWriter(self, ordered, max_operations, max_bytes)
+        yield writer
+        writer.flush()
+
+        if writer.result["errors"]:
+            self.log.warning("%d of %d bulk writes failed",
+                             len(writer.result["errors"]), writer._count)
+
+    @requires_install
+    def publish_batch(self, asset_id, items):
+        """Get or create subsets, versions and representations of an asset
+
+        Existing documents are found in one query and missing ones are
+        created in one bulk write, with identifiers generated up front
+        such that children are linked to parents without reading them
+        back. Documents are matched by type, parent and name.
+
+        Documents of `items` are given their "_id" and "parent" in place,
+        the "_id" being that of the existing document where found, once
+        written. Nothing is written and documents are left as is when any
+        is invalid. Documents sharing a name, such as a subset given with
+        each of its versions, are given the same "_id".
+
+        Counters of `reserve_versions()` of existing subsets, and pointers
+        of `latest_version_ids()`, are updated in writes of their own when
+        enabled.
+
+        Arguments:
+            asset_id (ObjectId): Parent of subsets
+            items (list): Tuples of (subset, version, representations),
+                where subsets and versions may be shared by many items
+
+        Returns:
+            list: Identifiers of created documents
+
+        Raises:
+            ValidationError on the first invalid document to be created
+
+        Example:
+            >>> dbcon.publish_batch(asset["_id"], [  # doctest: +SKIP
+            ...     (subset, version, [exr, jpg]) for subset, version, ...
+            ... ])
+
+        """
+        subsets = collections.OrderedDict()
+        versions = collections.OrderedDict()
+        representations = collections.OrderedDict()
+        for subset, version, repres in items:
+            subsets.setdefault((subset["name"],), subset)
+            versions.setdefault((subset["name"], version["name"]), version)
+            for repre in repres:
+                representations.setdefault(
+                    (subset["name"], version["name"], repre["name"]), repre
+                )
+
+        existing = self._find_published(
+            asset_id,
+            [name for name, in subsets],
+            list(set(name for _, name in versions)),
+            list(set(name for _, _, name in representations)),
+        )
+
+        # Parents are resolved before children, as per insertion order,
+        # and documents to create are copies until written
+        ids = {(): asset_id}
+        documents = []
+        for key, document in itertools.chain(subsets.items(),
+                                             versions.items(),
+                                             representations.items()):
+            parent_id = ids[key[:-1]]
+            _id = existing.get((parent_id, document["type"], key[-1]))
+            if _id is None:
+                _id = bson.ObjectId()
+                documents.append(dict(document, _id=_id, parent=parent_id))
+            ids[key] = _id
+
+        errors = schema.check_many(documents)
+        if errors:
+            for index, error in errors:
+                self.log.debug("Document %d is invalid: %s",
+                               index, error.message)
+            raise errors[0][1]
+
+        created = []
+        if documents:
+            requests = [
+                pymongo.UpdateOne(
+                    {
+                        "type": document["type"],
+                        "parent": document["parent"],
+                        "name": document["name"],
+                    },
+                    {"$setOnInsert": document},
+                    upsert=True
+                )
+                for document in documents
+            ]
+            result = self.__getattr__("bulk_write")(requests, ordered=False)
+
+            # Documents created by another process in the meantime
+            # were matched rather than upserted with their given id
+            upserted = set(result.upserted_ids.values())
+            adopted = {}
+            for document in documents:
+                if document["_id"] in upserted:
+                    created.append(document["_id"])
+                else:
+                    _id = document["_id"]
+                    adopted[_id] = self._adopt_published(document)
+
+            for key, _id in ids.items():
+                ids[key] = adopted.get(_id, _id)
+
+            created_ids = set(created)
+            versions = [
+                dict(document, parent=adopted.get(document["parent"],
+                                                  document["parent"]))
+                for document in documents
+                if document["_id"] in created_ids
+                if document["type"] == "version"
+            ]
+
+            # Counters are never started for subsets created just now
+            self._advance_version_counters([
+                version for version in versions
+                if version["parent"] not in created_ids
+            ])
+            self._update_latest_pointers(versions)
+
+        for subset, version, repres in items:
+            key = (subset["name"],)
+            subset.update({"_id": ids[key], "parent": asset_id})
+            key += (version["name"],)
+            version.update({"_id": ids[key], "parent": ids[key[:1]]})
+            for repre in repres:
+                repre.update({
+                    "_id": ids[key + (repre["name"],)],
+                    "parent": ids[key],
+                })
+
+        return created
+
+    def _find_published(self, asset_id, subset_names, version_names,
+                        representation_names):
+        """Return ids of existing documents by (parent, type, name)"""
+        pipeline = [
+            {"$match": {
+                "type": "subset",
+                "parent": asset_id,
+                "name": {"$in": subset_names},
+            }},
+            {"$graphLookup": {
+                "from": self.active_project(),
+                "startWith": "$_id",
+                "connectFromField": "_id",
+                "connectToField": "parent",
+                "as": "_children",
+                "maxDepth": 1,
+                "restrictSearchWithMatch": {"$or": [
+                    {"type": "version", "name": {"$in": version_names}},
+                    {"type": "representation",
+                     "name": {"$in": representation_names}},
+                ]},
+            }},
+            {"$project": {
+                "type": 1,
+                "parent": 1,
+                "name": 1,
+                "_children._id": 1,
+                "_children.type": 1,
+                "_children.parent": 1,
+                "_children.name": 1,
+            }},
+        ]
+
+        existing = {}
+        for subset in self.__getattr__("aggregate")(pipeline):
+            for document in [subset] + subset.pop("_children", []):
+                key = (document["parent"], document["type"], document["name"])
+                existing[key] = document["_id"]
+
+        return existing
+
+    def _adopt_published(self, document):
+        """Link children of `document` to the one created by another process
+
+        The children themselves are not merged with any the other
+        process may have created.
+
+        """
+        existing = self.__getattr__("find_one")(
+            {
+                "type": document["type"],
+                "parent": document["parent"],
+                "name": document["name"],
+            },
+            projection={"_id": True}
+        )
+
+        self.log.warning("%s '%s' was created concurrently, adopting it",
+                         document["type"], document["name"])
+        self.__getattr__("update_many")(
+            {"parent": document["_id"]},
+            {"$set": {"parent": existing["_id"]}}
+        )
+        document["_id"] = existing["_id"]
+        return existing["_id"]
+
+    @requires_install
+    def latest_versions(self, subset_ids, projection=None):
+        """Return latest version of each subset, in a single aggregation
+
+        Arguments:
+            subset_ids (list): Identifiers of subsets
+            projection (dict, optional): Fields of versions to return,
+                along with their "_id"
+
+        Returns:
+            dict: Version document by subset id, for subsets with versions
+
+        """
+        pipeline = [
+            {"$match": {"type": "version", "parent": {"$in": subset_ids}}},
+            {"$sort": {"parent": 1, "name": -1}},
+            {"$group": {"_id": "$parent", "version": {"$first": "$$ROOT"}}},
+        ]
+
+        if projection is not None:
+            if isinstance(projection, (list, tuple)):
+                projection = dict((key, True) for key in projection)
+
+            # Versions are always returned with their id
+            projection = dict(projection)
+            if any(projection.values()):
+                projection["_id"] = True
+            else:
+                projection.pop("_id", None)
+
+        if projection:
+            pipeline.append({"$project": dict(
+                ("version." + key, value)
+                for key, value in projection.items()
+            )})
+
+        return dict(
+            (result["_id"], result["version"])
+            for result in self.__getattr__("aggregate")(pipeline)
+        )
+
+    @requires_install
+    def latest_version_ids(self, subset_ids):
+        """Return id of latest version of each subset
+
+        With AVALON_LATEST_POINTERS set, ids are looked up from pointers
+        maintained by inserts of versions through `AvalonMongoDB`, and
+        only subsets without a pointer fall back to `latest_versions()`.
+
+        Pointers are kept along with counters of `reserve_versions()`,
+        apart from documents of the project.
+
+        Pointers are not updated when versions are deleted or renamed,
+        in which case `update_latest_pointers()` is to be called.
+
+        Arguments:
+            subset_ids (list): Identifiers of subsets
+
+        Returns:
+            dict: Version id by subset id, for subsets with versions
+
+        """
+        found = {}
+        if self.Session.get("AVALON_LATEST_POINTERS"):
+            pointer_ids = [
+                _derived_id(subset_id, "latest_version")
+                for subset_id in subset_ids
+            ]
+            for pointer in self._meta_attribute("find")(
+                {"_id": {"$in": pointer_ids}},
+                projection={"parent": True, "version_id": True}
+            ):
+                found[pointer["parent"]] = pointer["version_id"]
+
+        missing = [
+            subset_id for subset_id in subset_ids if subset_id not in found
+        ]
+        if missing:
+            # Pointers set by concurrent writers of newer versions are kept
+            latest = self._latest_version_ids(missing, force=False)
+            for subset_id, version_id in latest.items():
+                found[subset_id] = version_id
+
+        return found
+
+    @requires_install
+    def update_latest_pointers(self, subset_ids):
+        """Point pointers of subsets at their latest version
+
+        Pointers are replaced, including those pointing at newer versions
+        than exist, e.g. after versions were deleted.
+
+        Returns:
+            dict: Version id by subset id, for subsets with versions
+
+        """
+        return self._latest_version_ids(subset_ids, force=True)
+
+    def _latest_version_ids(self, subset_ids, force):
+        latest = self.latest_versions(subset_ids, projection={
+            "_id": True, "type": True, "parent": True, "name": True
+        })
+        self._update_latest_pointers(latest.values(), force=force)
+        return dict(
+            (subset_id, version["_id"])
+            for subset_id, version in latest.items()
+        )
+
+    def _versions_inserted(self, documents):
+        """Advance counters and pointers of subsets of inserted versions"""
+        versions = [
+            document for document in documents
+            if document.get("type") == "version"
+        ]
+        if versions:
+            self._advance_version_counters(versions)
+            self._update_latest_pointers(versions)
+
+    def _advance_version_counters(self, versions):
+        """Keep counters of `reserve_versions()` ahead of `versions`"""
+        if not self.Session.get("AVALON_VERSION_COUNTERS"):
+            return
+
+        requests = self._version_counter_requests(versions)
+        if not requests:
+            return
+
+        try:
+            self._meta_attribute("bulk_write")(requests, ordered=False)
+        except pymongo.errors.PyMongoError as e:
+            self.log.warning("Could not advance version counters: %s", e)
+
+    def _version_counter_requests(self, documents):
+        latest = {}
+        for document in documents:
+            if document.get("type") != "version":
+                continue
+            if not isinstance(document.get("name"), numbers.Integral):
+                continue
+            subset_id = document["parent"]
+            latest[subset_id] = max(latest.get(subset_id, 0),
+                                    document["name"])
+
+        # Counters are left to be started by `reserve_versions()`
+        return [
+            pymongo.UpdateOne(
+                {"_id": _derived_id(subset_id, "version")},
+                {"$max": {"count": name}}
+            )
+            for subset_id, name in latest.items()
+        ]
+
+    def _update_latest_pointers(self, documents, force=False):
+        """Point subsets at those of `documents` newer than their latest"""
+        if not self.Session.get("AVALON_LATEST_POINTERS"):
+            return
+
+        latest = {}
+        for document in documents:
+            if document.get("type") != "version":
+                continue
+            current = latest.get(document["parent"])
+            if current is None or current["name"] < document["name"]:
+                latest[document["parent"]] = document
+
+        requests = []
+        for subset_id, version in latest.items():
+            pointer_id = _derived_id(subset_id, "latest_version")
+            query_filter = {"_id": pointer_id}
+            if not force:
+                # Leave pointers at newer versions as is
+                query_filter["version"] = {"$lt": version["name"]}
+
+            requests.append(pymongo.UpdateOne(query_filter, {"$set": {
+                "type": "latest_version",
+                "parent": subset_id,
+                "version": version["name"],
+                "version_id": version["_id"],
+            }}, upsert=True))
+
+        if not requests:
+            return
+
+        try:
+            self._meta_attribute("bulk_write")(requests, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            # Upserts of pointers at newer versions collide
+            errors = [
+                error for error in e.details["writeErrors"]
+                if error.get("code") != 11000
+            ]
+            if errors:
+                self.log.warning("Could not update latest versions: %s",
+                                 errors)
+        except pymongo.errors.PyMongoError as e:
+            self.log.warning("Could not update latest versions: %s", e)
+
+    @requires_install
+    def reserve_versions(self, subset_id, count=1):
+        """Return `count` consecutive version numbers, unique to the caller
+
+        Numbers are handed out by atomically incrementing a counter
+        document of the subset, kept in the collection of the project
+        suffixed with `META_SUFFIX`, such that concurrent publishes never
+        race for the same number. The counter starts from the latest
+        version of the subset, once first used.
+
+        With AVALON_VERSION_COUNTERS set, existing counters are also
+        advanced past versions inserted through `AvalonMongoDB` by other
+        means, e.g. `insert_one()`, at the cost of a write per insert.
+        It is to be set wherever versions of subsets numbered by this
+        method are inserted otherwise. Versions inserted by other clients
+        of the database are not accounted for.
+
+        Arguments:
+            subset_id (ObjectId): Subset of versions
+            count (int, optional): Number of versions to reserve
+
+        Returns:
+            list: Version numbers, in ascending order
+
+        """
+        assert count > 0, "count must be positive"
+        counter_id = _derived_id(subset_id, "version")
+        find_one_and_update = self._meta_attribute("find_one_and_update")
+
+        counter = find_one_and_update(
+            {"_id": counter_id},
+            {"$inc": {"count": count}},
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+
+        if counter is None:
+            latest = self.__getattr__("find_one")(
+                {"type": "version", "parent": subset_id},
+                projection={"name": True},
+                sort=[("name", -1)]
+            )
+            try:
+                self._meta_attribute("insert_one")({
+                    "_id": counter_id,
+                    "type": "counter",
+                    "parent": subset_id,
+                    "name": "version",
+                    "count": int(latest["name"]) if latest else 0,
+                })
+            except pymongo.errors.DuplicateKeyError:
+                # Started by another process in the meantime
+                pass
+
+            # Versions inserted before the counter existed were not
+            # counted by `_advance_version_counters()`
+            latest = self.__getattr__("find_one")(
+                {"type": "version", "parent": subset_id},
+                projection={"name": True},
+                sort=[("name", -1)]
+            )
+            if latest is not None:
+                self._meta_attribute("update_one")(
+                    {"_id": counter_id},
+                    {"$max": {"count": int(latest["name"])}}
+                )
+
+            counter = find_one_and_update(
+                {"_id": counter_id},
+                {"$inc": {"count": count}},
+                return_document=pymongo.ReturnDocument.AFTER
+            )
+
+        last = counter["count"]
+        return list(range(last - count + 1, last + 1))
+
+    def next_version(self, subset_id):
+        """Return next version number of subset, see `reserve_versions()`"""
+        return self.reserve_versions(subset_id)[0]
+
+    @requires_install
+    @auto_reconnect
+    def get_representation_contexts(self, representation_ids):
+        """Return context of each representation, as used by loaders
+
+        Each level of the hierarchy is fetched in one query for all
+        representations, and joined here, such that the number of queries
+        does not grow with the number of representations.
+
+        Hero versions carry the data of the version they point to.
+
+        Arguments:
+            representation_ids (list): Identifiers of representations
+
+        Returns:
+            dict: Context by representation id as given, for
+                representations found, with keys "project", "asset",
+                "subset", "version" and "representation".
+
+        """
+        # Ids as given by the caller, e.g. strings, by ObjectId
+        requested = {}
+        for _id in representation_ids:
+            given = requested.setdefault(bson.ObjectId(_id), [])
+            if _id not in given:
+                given.append(_id)
+
+        project_name = self.active_project()
+        collection = self._database[project_name]
+
+        def find_by_id(ids):
+            ids = list(set(ids))
+            if not ids:
+                return {}
+            return dict(
+                (document["_id"], document)
+                for document in collection.find({"_id": {"$in": ids}})
+            )
+
+        representations = find_by_id(requested)
+        versions = find_by_id(
+            repre["parent"] for repre in representations.values()
+        )
+        subsets = find_by_id(
+            version["parent"] for version in versions.values()
+        )
+        assets = find_by_id(
+            subset["parent"] for subset in subsets.values()
+        )
+
+        heroes = [
+            version for version in versions.values()
+            if version.get("type") == "hero_version"
+        ]
+        if heroes:
+            sources = find_by_id(hero["version_id"] for hero in heroes)
+            for hero in heroes:
+                source = sources.get(hero["version_id"])
+                if source is not None:
+                    hero["data"] = source["data"]
+
+        if not representations:
+            return {}
+
+        project = collection.find_one(
+            {"type": "project"}, projection={"data.code": True}
+        ) or {}
+        project = {
+            "name": project_name,
+            "code": project.get("data", {}).get("code", ""),
+        }
+
+        # Documents shared by representations get copies of their own
+        returned = set()
+
+        def own(document):
+            if document["_id"] in returned:
+                return copy.deepcopy(document)
+            returned.add(document["_id"])
+            return document
+
+        contexts = {}
+        for repre_id, representation in representations.items():
+            version = versions.get(representation["parent"])
+            subset = version and subsets.get(version["parent"])
+            asset = subset and assets.get(subset["parent"])
+            if asset is None:
+                continue
+
+            for _id in requested[repre_id]:
+                contexts[_id] = {
+                    "project": dict(project),
+                    "asset": own(asset),
+                    "subset": own(subset),
+                    "version": own(version),
+                    "representation": own(representation),
+                }
+
+        return contexts
+
+    def parenthood(self, document):
+        """Return parents of `document`, nearest first
+
+        Hero versions carry the data of the version they point to.
+
+        """
+        assert document is not None, "This is a bug"
+        return self.parenthoods([document])[0]
+
+    @requires_install
+    @auto_reconnect
+    def parenthoods(self, documents):
+        """Return parents of each of `documents`, see `parenthood()`
+
+        All ancestors are resolved on the server in a single aggregation.
+
+        Returns:
+            list: List of parents per document, in order of `documents`
+
+        """
+        parent_ids = list(set(
+            document["parent"] for document in documents
+            if document.get("parent") is not None
+        ))
+        if not parent_ids:
+            return [[] for _ in documents]
+
+        project_name = self.active_project()
+        pipeline = [
+            {"$match": {"_id": {"$in": parent_ids}}},
+            {"$graphLookup": {
+                "from": project_name,
+                "startWith": "$parent",
+                "connectFromField": "parent",
+                "connectToField": "_id",
+                "as": "_parenthood_ancestors",
+                "depthField": "_parenthood_depth",
+            }},
+
+            # Versions of hero versions, for their data
+            {"$lookup": {
+                "from": project_name,
+                "localField": "version_id",
+                "foreignField": "_id",
+                "as": "_parenthood_versions",
+            }},
+            {"$lookup": {
+                "from": project_name,
+                "localField": "_parenthood_ancestors.version_id",
+                "foreignField": "_id",
+                "as": "_parenthood_ancestor_versions",
+            }},
+        ]
+
+        parents_by_id = {}
+        for parent in self._database[project_name].aggregate(pipeline):
+            ancestors = sorted(
+                parent.pop("_parenthood_ancestors"),
+                key=lambda ancestor: ancestor.pop("_parenthood_depth")
+            )
+            versions = parent.pop("_parenthood_versions")
+            versions.extend(parent.pop("_parenthood_ancestor_versions"))
+            versions = dict((version["_id"], version) for version in versions)
+
+            parents = [parent] + ancestors
+            for ancestor in parents:
+                if ancestor.get("type") != "hero_version":
+                    continue
+                version = versions.get(ancestor.get("version_id"))
+                if version is not None:
+                    ancestor["data"] = version["data"]
+
+            parents_by_id[parents[0]["_id"]] = parents
+
+        # Documents sharing parents get copies of their own
+        result = []
+        returned = set()
+        for document in documents:
+            parent_id = document.get("parent")
+            parents = parents_by_id.get(parent_id, [])
+            if parent_id in returned:
+                parents = copy.deepcopy(parents)
+            returned.add(parent_id)
+            result.append(parents)
+
+        return result
+
+    @requires_install
+    def migrate(self, project_name=None, batch_size=1000, dry_run=False,
+                resume_after=None, callback=None):
+        """Upgrade documents to the latest version of their schema
+
+        Documents with a registered upgrade, see `schema.register_upgrade`,
+        are streamed in order of `_id` and written back in unordered bulk
+        batches. Each document is only replaced if its schema is unchanged
+        since it was read, and only if it validates after the upgrade.
+
+        Interrupted migrations are resumed by passing the "last_id" of
+        the most recent report to `resume_after`.
+
+        Arguments:
+            project_name (str, optional): Defaults to the active project
+            batch_size (int, optional): Documents per bulk write
+            dry_run (bool, optional): Upgrade and validate, write nothing
+            resume_after (ObjectId, optional): Skip documents up to this id
+            callback (callable, optional): Called with the report after
+                each batch, e.g. to store "last_id" for later.
+
+        Returns:
+            dict: Number of "scanned", "upgraded", "invalid" and "written"
+                documents, along with "last_id", "seconds" and "per_second"
+
+        """
+        report = {
+            "scanned": 0,
+            "upgraded": 0,
+            "invalid": 0,
+            "written": 0,
+            "last_id": resume_after,
+            "seconds": 0.0,
+            "per_second": 0.0,
+        }
+
+        names = schema.upgradable_schemas()
+        if not names:
+            return report
+
+        query_filter = {"schema": {"$regex": ":(?:{})$".format(
+            "|".join(re.escape(name) for name in names)
+        )}}
+        if resume_after is not None:
+            query_filter["_id"] = {"$gt": resume_after}
+
+        collection = self._database[project_name or self.active_project()]
+        cursor = collection.find(
+            query_filter, sort=[("_id", 1)], batch_size=batch_size
+        )
+
+        start = time.time()
+        batch = []
+        for document in cursor:
+            batch.append(document)
+            if len(batch) < batch_size:
+                continue
+
+            self._migrate_batch(collection, batch, dry_run, report, start)
+            batch = []
+            if callback is not None:
+                callback(report)
+
+        if batch:
+            self._migrate_batch(collection, batch, dry_run, report, start)
+            if callback is not None:
+                callback(report)
+
+        return report
+
+    def _migrate_batch(self, collection, batch, dry_run, report, start):
+        schemas = [document["schema"] for document in batch]
+        documents = [schema.upgrade(document) for document in batch]
+
+        invalid = set()
+        for index, error in schema.validate_many(documents):
+            self.log.warning("Document '%s' is invalid after upgrade: %s",
+                             documents[index]["_id"], error.message)
+            invalid.add(index)
+
+        requests = [
+            pymongo.ReplaceOne(
+                {"_id": document["_id"], "schema": schemas[index]},
+                document
+            )
+            for index, document in enumerate(documents)
+            if index not in invalid
+        ]
+
+        if requests and not dry_run:
+            try:
+                result = auto_reconnect(collection.bulk_write)(
+                    requests, ordered=False
+                )
+            finally:
+                self._on_write(collection.name)
+            report["written"] += result.modified_count
+
+        report["scanned"] += len(batch)
+        report["upgraded"] += len(requests)
+        report["invalid"] += len(invalid)
+        report["last_id"] = batch[-1]["_id"]
+        report["seconds"] = time.time() - start
+        report["per_second"] = report["scanned"] / (report["seconds"] or 1e-6)
+
+        self.log.info(
+            "Migrated %d documents, %d invalid (%.0f documents/s)",
+            report["upgraded"], report["invalid"], report["per_second"]
+        )
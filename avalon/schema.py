@@ -1,9 +1,16 @@
 """Wrapper around :mod:`jsonschema`
 
-Schemas are implicitly loaded from the /schema directory of this project.
+Schemas are implicitly loaded from the /schema directory of this project,
+or the directory in AVALON_SCHEMA, as they are first used.
 
 Attributes:
     _cache: Cache of previously loaded schemas
+    _index: Path to each available schema, by file name
+    _compiled: Validator class and checked schema per name in `_cache`
+    _generated: Generated check per name in `_cache`, see `generate_check`
+    _upgrades: Target schema and upgrade function per source schema name
+    _policy: How documents are validated by `check()`, see `set_policy`
+    _stats: Counters of documents validated by `check()`
 
 Resources:
     http://json-schema.org/
@@ -15,10 +22,16 @@ Resources:
 import os
 import re
 import json
+import time
+import random
 import logging
+import threading
+import numbers
+import multiprocessing
 
 import jsonschema
 import six
+from six.moves.urllib.parse import urldefrag, unquote
 
 log_ = logging.getLogger(__name__)
 
@@ -26,6 +39,35 @@ ValidationError = jsonschema.ValidationError
 SchemaError = jsonschema.SchemaError
 
 _CACHED = False
+_index = {}
+_loaded = set()
+_upgrades = {}
+
+# Batches larger than this are validated over a pool of processes,
+# disabled unless set, see `validate_many()`
+POOL_THRESHOLD = None
+if os.environ.get("AVALON_SCHEMA_POOL_THRESHOLD"):
+    POOL_THRESHOLD = int(os.environ["AVALON_SCHEMA_POOL_THRESHOLD"])
+
+_compiled = {}
+_generated = {}
+_compiled_lock = threading.Lock()
+_local = threading.local()
+
+_policy = {"mode": "strict", "rate": 1.0}
+_stats = {"validated": 0, "skipped": 0, "rejected": 0, "seconds": 0.0}
+_stats_lock = threading.Lock()
+
+
+def _reset_locks():
+    """Replace locks possibly held by other threads of a parent process"""
+    global _compiled_lock, _stats_lock
+    _compiled_lock = threading.Lock()
+    _stats_lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_locks)
 
 
 def get_schema_version(schema_name):
@@ -56,6 +98,60 @@ def get_schema_version(schema_name):
     return int(maj_version), int(min_version)
 
 
+def register_upgrade(source, target):
+    """Register a function upgrading documents from one schema to another
+
+    Example:
+        >>> @register_upgrade("_doctest-1.0", "_doctest-2.0")
+        ... def _doctest_1_to_2(document):
+        ...     document["key"] = document.pop("value")
+        ...     return document
+        >>> upgrade({"schema": "avalon-core:_doctest-1.0", "value": "a"})
+        {'schema': 'avalon-core:_doctest-2.0', 'key': 'a'}
+        >>> _upgrades.clear()
+
+    Arguments:
+        source (str): Name of schema upgraded from, e.g. "version-2.0"
+        target (str): Name of schema upgraded to, e.g. "version-3.0"
+
+    """
+    # Upgrading only ever to later versions rules out cycles
+    source_version = get_schema_version("avalon-core:" + source)
+    target_version = get_schema_version("avalon-core:" + target)
+    assert target_version > source_version, (
+        "Upgrade from '%s' must be to a later version" % source
+    )
+
+    def decorator(func):
+        _upgrades[source] = (target, func)
+        return func
+    return decorator
+
+
+def upgrade(document):
+    """Upgrade `document` to the latest version of its schema
+
+    Each registered upgrade is applied in turn, after which the "schema"
+    key is set to the schema upgraded to. Upgrades may modify `document`
+    in-place.
+
+    Returns:
+        dict: The upgraded document, or `document` if no upgrade applies
+
+    """
+    root, name = document["schema"].rsplit(":", 1)
+    while name in _upgrades:
+        name, func = _upgrades[name]
+        document = func(document)
+        document["schema"] = root + ":" + name
+    return document
+
+
+def upgradable_schemas():
+    """Return names of schemas with a registered upgrade"""
+    return sorted(_upgrades)
+
+
 def validate(data, schema=None):
     """Validate `data` with `schema`
 
@@ -67,9 +163,6 @@ def validate(data, schema=None):
         ValidationError on invalid schema
 
     """
-    if not _CACHED:
-        _precache()
-
     root, schema = data["schema"].rsplit(":", 1)
     # assert root in (
     #     "mindbender-core",  # Backwards compatiblity
@@ -77,20 +170,909 @@ def validate(data, schema=None):
     #     "pype"
     # )
 
-    if isinstance(schema, six.string_types):
-        schema = _cache[schema + ".json"]
+    # Only invalid documents need to be walked by jsonschema,
+    # which also makes for identical errors.
+    check = _generated.get(schema + ".json")
+    if check is not None and check(data):
+        return
+
+    validator = get_validator(schema)
+    error = jsonschema.exceptions.best_match(validator.iter_errors(data))
+    if error is not None:
+        raise error
+
+
+def validate_many(items, processes=None, threshold=None):
+    """Validate each of `items` and return all errors found
+
+    Items are grouped by their schema so that each group is validated
+    with a single validator, in this process unless a pool is asked for.
+
+    A pool of processes is only used when `processes` is given, or once
+    batches reach `threshold` or AVALON_SCHEMA_POOL_THRESHOLD. Pools
+    require the current interpreter to be able to start Python processes,
+    which is not the case within most hosts, where `sys.executable` is
+    the host itself. Where processes are spawned rather than forked, as
+    on Windows and macOS, the calling script must also guard its entry
+    point with `if __name__ == "__main__":`.
+
+    Arguments:
+        items (list): JSON-compatible documents, each with a "schema" key
+        processes (int, optional): Size of pool, defaults to CPU count
+        threshold (int, optional): Minimum number of items validated
+            in a pool, defaults to `POOL_THRESHOLD`
+
+    Returns:
+        list: Pairs of (index, ValidationError) sorted by index,
+            empty when every item is valid.
+
+    """
+    if not _CACHED:
+        _precache()
+
+    if threshold is None:
+        threshold = POOL_THRESHOLD
+
+    if threshold is None:
+        pooled = processes is not None
+    else:
+        pooled = len(items) >= threshold
+
+    errors = []
+    groups = {}
+    for index, item in enumerate(items):
+        try:
+            root, name = item["schema"].rsplit(":", 1)
+        except (KeyError, TypeError, AttributeError, ValueError):
+            errors.append((index, ValidationError(
+                "Missing or malformed 'schema' key"
+            )))
+            continue
+        groups.setdefault(name, []).append((index, item))
+
+    # Fail early on unknown schemas, like `validate()`
+    for name in groups:
+        get_validator(name)
+
+    if not pooled:
+        for name, group in groups.items():
+            errors.extend(_validate_group(name, group))
+
+    else:
+        processes = processes or multiprocessing.cpu_count()
+        tasks = list()
+        for name, group in groups.items():
+            size = max(1, -(-len(group) // processes))
+            for start in range(0, len(group), size):
+                tasks.append((name, group[start:start + size]))
+
+        pool = multiprocessing.Pool(processes,
+                                    initializer=_init_worker,
+                                    initargs=(_cache, _index))
+        try:
+            for result in pool.imap_unordered(_validate_task, tasks):
+                errors.extend(
+                    (index, ValidationError(**contents))
+                    for index, contents in result
+                )
+        finally:
+            pool.close()
+            pool.join()
+
+    return sorted(errors, key=lambda pair: pair[0])
+
+
+def validate_update(update, name):
+    """Validate MongoDB update operators against schema `name`
+
+    Values of $set and $setOnInsert, elements added by $push and
+    $addToSet and the targets of $inc, $mul, $unset and $rename are
+    checked against the part of the schema found at their path. This
+    validates an update without reading the document it applies to.
+
+    Arguments:
+        update (dict): Update document, e.g. {"$set": {"data.fps": 25}}
+        name (str): Name of schema, e.g. "version-3.0"
+
+    Raises:
+        ValidationError on invalid update, with the full path of the
+            offending value in `error.path`.
+
+    """
+    get_validator(name)
+    key = name + ".json"
+    root = _compiled[key][1]
+
+    for operator, fields in update.items():
+        if not isinstance(fields, dict):
+            continue
+
+        for path, value in fields.items():
+            parts = path.split(".")
+
+            if operator in ("$set", "$setOnInsert"):
+                _validate_path(key, root, parts, value)
 
-    resolver = jsonschema.RefResolver(
-        "",
-        None,
-        store=_cache,
-        cache_remote=True
+            elif operator in ("$push", "$addToSet"):
+                subschema, document = _schema_at(root, parts)
+                _require_type(subschema, "array", parts)
+                if isinstance(value, dict) and "$each" in value:
+                    values = value["$each"]
+                else:
+                    values = [value]
+                for value in values:
+                    _validate_path(key, root, parts + ["$"], value)
+
+            elif operator in ("$inc", "$mul"):
+                subschema, document = _schema_at(root, parts)
+                _require_type(subschema, "number", parts)
+
+            elif operator == "$unset":
+                _require_optional(root, parts)
+
+            elif operator == "$rename":
+                _require_optional(root, parts)
+                _schema_at(root, value.split("."))
+
+
+def _schema_at(root, parts):
+    """Return subschema at `parts` of a document path, and its document
+
+    Raises:
+        ValidationError if `parts` is not allowed by the schema
+
+    """
+    subschema, document = root, root
+    for index, part in enumerate(parts):
+        while isinstance(subschema, dict) and "$ref" in subschema:
+            subschema, document = _resolve(subschema["$ref"], document)
+
+        if not isinstance(subschema, dict):
+            break
+
+        is_array = "items" in subschema or subschema.get("type") == "array"
+        # Numeric and positional parts, e.g. "$" and "$[]", index arrays
+        if is_array and (part.startswith("$") or part.isdigit()):
+            subschema = subschema.get("items", True)
+            if isinstance(subschema, list):
+                return True, document
+            continue
+
+        properties = subschema.get("properties", {})
+        if part in properties:
+            subschema = properties[part]
+            continue
+
+        if "patternProperties" in subschema:
+            return True, document
+
+        subschema = subschema.get("additionalProperties", True)
+        if subschema is False:
+            raise ValidationError(
+                "Additional properties are not allowed "
+                "(%r was unexpected)" % part,
+                path=parts[:index]
+            )
+
+    while isinstance(subschema, dict) and "$ref" in subschema:
+        subschema, document = _resolve(subschema["$ref"], document)
+
+    return subschema, document
+
+
+def _validate_path(key, root, parts, value):
+    subschema, document = _schema_at(root, parts)
+    if subschema is True or subschema == {}:
+        return
+
+    # Positional and numeric parts share a validator
+    normalised = tuple(
+        "$" if part.startswith("$") or part.isdigit() else part
+        for part in parts
     )
 
-    jsonschema.validate(data,
-                        schema,
-                        types={"array": (list, tuple)},
-                        resolver=resolver)
+    validators = getattr(_local, "path_validators", None)
+    if validators is None:
+        validators = _local.path_validators = {}
+
+    compiled = _compiled[key]
+    token, validator = validators.get((key, normalised), (None, None))
+    if token is not compiled:
+        resolver = jsonschema.RefResolver(
+            "",
+            document,
+            store=_cache,
+            cache_remote=True,
+            handlers={"": _resolve_ref}
+        )
+        validator = compiled[0](subschema, resolver=resolver)
+        validators[(key, normalised)] = (compiled, validator)
+
+    error = jsonschema.exceptions.best_match(validator.iter_errors(value))
+    if error is not None:
+        error.path.extendleft(reversed(parts))
+        raise error
+
+
+def _require_type(subschema, type_, parts):
+    types = subschema.get("type") if isinstance(subschema, dict) else None
+    if types is None:
+        return
+
+    if isinstance(types, six.string_types):
+        types = [types]
+    if type_ == "number" and "integer" in types:
+        return
+    if type_ not in types:
+        raise ValidationError(
+            "%r is not of type %r" % (".".join(parts), type_),
+            path=parts
+        )
+
+
+def _require_optional(root, parts):
+    parent, document = _schema_at(root, parts[:-1])
+    if not isinstance(parent, dict):
+        return
+
+    if parts[-1] in parent.get("required", []):
+        raise ValidationError(
+            "%r is a required property" % parts[-1],
+            path=parts[:-1]
+        )
+
+
+def set_policy(policy):
+    """Set how documents written to the database are validated
+
+    Policies are one of "strict" to validate every document, "off" to
+    validate none, or "sample:<rate>" to validate a random fraction of
+    documents, e.g. "sample:0.05" for 5%. It applies to `check()`,
+    `check_many()` and `check_update()`, which are used when writing
+    through `AvalonMongoDB`. The policy is set per process, from the
+    AVALON_VALIDATION environment variable or Session key on install.
+
+    Example:
+        >>> set_policy("sample:0.05")
+        >>> get_policy()
+        'sample:0.05'
+        >>> set_policy("sample:2")
+        Traceback (most recent call last):
+        ...
+        ValueError: Invalid validation policy: 'sample:2'
+        >>> set_policy("strict")
+
+    """
+    mode, separator, rate = policy.strip().partition(":")
+    if mode in ("strict", "off") and not separator:
+        _policy.update({"mode": mode, "rate": 1.0 if mode == "strict" else 0})
+        return
+
+    try:
+        rate = float(rate) if mode == "sample" else None
+    except ValueError:
+        rate = None
+
+    if rate is None or not 0 <= rate <= 1:
+        raise ValueError("Invalid validation policy: %r" % policy)
+
+    _policy.update({"mode": mode, "rate": rate})
+
+
+def get_policy():
+    """Return current validation policy, see `set_policy`"""
+    if _policy["mode"] == "sample":
+        return "sample:%s" % _policy["rate"]
+    return _policy["mode"]
+
+
+def stats():
+    """Return counters of documents checked as per the validation policy
+
+    Returns:
+        dict: Number of documents "validated", "skipped" by the policy
+            and "rejected" as invalid, and "seconds" spent validating
+
+    """
+    with _stats_lock:
+        return dict(_stats)
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.update({"validated": 0, "skipped": 0, "rejected": 0})
+        _stats["seconds"] = 0.0
+
+
+def check(data):
+    """Validate `data` as per the validation policy
+
+    Raises:
+        ValidationError on invalid data
+
+    """
+    if not _sampled():
+        _count(skipped=1)
+        return
+
+    start = time.time()
+    try:
+        validate(data)
+    except ValidationError:
+        _count(validated=1, rejected=1, seconds=time.time() - start)
+        raise
+    _count(validated=1, seconds=time.time() - start)
+
+
+def check_many(items):
+    """Validate `items` as per the validation policy
+
+    Returns:
+        list: Pairs of (index, ValidationError), see `validate_many`
+
+    """
+    if _policy["mode"] == "strict":
+        indices = list(range(len(items)))
+    else:
+        indices = [index for index in range(len(items)) if _sampled()]
+
+    if not indices:
+        _count(skipped=len(items))
+        return []
+
+    start = time.time()
+    errors = validate_many([items[index] for index in indices])
+    _count(validated=len(indices),
+           skipped=len(items) - len(indices),
+           rejected=len(errors),
+           seconds=time.time() - start)
+
+    return [(indices[index], error) for index, error in errors]
+
+
+def check_update(update, name=None, schemas=None):
+    """Validate update operators as per the validation policy
+
+    Unless given by `name` or set by `update` itself, the schemas are
+    those declared by the updated documents, as returned by `schemas`,
+    which is only called once the policy calls for validating `update`.
+    Updates are not validated against unknown schemas, nor when no
+    schemas are available at all.
+
+    Arguments:
+        update (dict): Update document, e.g. {"$set": {"data.fps": 25}}
+        name (str, optional): Name of schema, e.g. "version-3.0"
+        schemas (callable, optional): Return "schema" of each updated
+            document, e.g. ["openpype:version-2.0"]
+
+    Raises:
+        ValidationError on invalid update, see `validate_update`
+
+    """
+    if not _sampled():
+        _count(skipped=1)
+        return
+
+    fields = update.get("$set")
+    if name is None and isinstance(fields, dict):
+        name = fields.get("schema")
+
+    if name is not None:
+        names = [name]
+    elif schemas is not None:
+        names = schemas()
+    else:
+        names = []
+
+    # Names are given with or without their prefix, e.g. "openpype:"
+    names = sorted(set(
+        name.rsplit(":", 1)[-1] for name in names
+        if isinstance(name, six.string_types)
+    ))
+
+    known = [name for name in names if _available(name)]
+    if not known:
+        log_.debug("Update not validated, no schema of %s", names)
+        return
+
+    start = time.time()
+    try:
+        for name in known:
+            validate_update(update, name)
+    except ValidationError:
+        _count(validated=1, rejected=1, seconds=time.time() - start)
+        raise
+    _count(validated=1, seconds=time.time() - start)
+
+
+def _available(name):
+    try:
+        if not _CACHED:
+            _precache()
+    except OSError as e:
+        log_.debug("No schemas available: %s", e)
+        return False
+
+    key = name + ".json"
+    return key in _index or key in _cache
+
+
+def _sampled():
+    if _policy["mode"] == "strict":
+        return True
+    if _policy["mode"] == "off":
+        return False
+    return random.random() < _policy["rate"]
+
+
+def _count(**counts):
+    with _stats_lock:
+        for key, value in counts.items():
+            _stats[key] += value
+
+
+def _validate_group(name, group):
+    validator = get_validator(name)
+    check = _generated.get(name + ".json")
+    for index, item in group:
+        if check is not None and check(item):
+            continue
+        error = jsonschema.exceptions.best_match(validator.iter_errors(item))
+        if error is not None:
+            yield index, error
+
+
+def _init_worker(cache, index):
+    global _CACHED
+    _cache.update(cache)
+    _index.update(index)
+    _CACHED = True
+
+
+def _validate_task(task):
+    # Exceptions lose their attributes when pickled, so
+    # they are passed back to the parent process as plain data
+    name, group = task
+    return [
+        (index, error._contents())
+        for index, error in _validate_group(name, group)
+    ]
+
+
+def get_validator(name):
+    """Return a ready-to-use validator for schema `name`
+
+    The schema is checked against its meta-schema and its validator class
+    is created only once per process. Validators hold a `RefResolver`
+    whose scope stack is not thread-safe, so each thread is handed its
+    own instance which then resolves each `$ref` only once.
+
+    Arguments:
+        name (str): Name of schema, e.g. "version-3.0"
+
+    Raises:
+        KeyError if no schema by that name is available
+
+    """
+    if not _CACHED:
+        _precache()
+
+    key = name + ".json"
+    compiled = _compiled.get(key)
+    if compiled is None:
+        compiled = _compile(key)
+
+    validators = getattr(_local, "validators", None)
+    if validators is None:
+        validators = _local.validators = {}
+
+    # Recompile for this thread if the schema was compiled anew
+    token, validator = validators.get(key, (None, None))
+    if token is not compiled:
+        cls, schema = compiled
+        resolver = jsonschema.RefResolver(
+            "",
+            schema,
+            store=_cache,
+            cache_remote=True,
+            handlers={"": _resolve_ref}
+        )
+        validator = cls(schema, resolver=resolver)
+        validators[key] = (compiled, validator)
+
+    return validator
+
+
+def _compile(key):
+    with _compiled_lock:
+        compiled = _compiled.get(key)
+        if compiled is not None:
+            return compiled
+
+        schema = _load(key)
+        cls = jsonschema.validators.validator_for(schema)
+        cls.check_schema(schema)
+
+        # Accept tuples wherever arrays are expected
+        type_checker = cls.TYPE_CHECKER.redefine(
+            "array",
+            lambda checker, instance: isinstance(instance, (list, tuple))
+        )
+        cls = jsonschema.validators.extend(cls, type_checker=type_checker)
+
+        names = os.environ.get("AVALON_SCHEMA_GENERATED") or ""
+        names = [name.strip() for name in names.split(",")]
+        if "*" in names or key[:-len(".json")] in names:
+            check = _generate(key, schema, cls)
+            if check is not None:
+                _generated[key] = check
+
+        compiled = (cls, schema)
+        _compiled[key] = compiled
+        return compiled
+
+
+def generate_check(name):
+    """Return a generated function checking documents against `name`
+
+    Required keys, types, enumerations, patterns and additional properties
+    are written out as plain Python, which is many times faster than
+    walking the schema for each document. Subschemas using any other
+    keyword are checked by jsonschema from within the function. The
+    function returns True for valid documents and False otherwise; use
+    `validate()` for the actual error.
+
+    Set AVALON_SCHEMA_GENERATED to a comma-separated list of schema names,
+    or "*", for `validate()` and `validate_many()` to use these functions.
+
+    Arguments:
+        name (str): Name of schema, e.g. "version-3.0"
+
+    Returns:
+        function or None if the schema itself uses keywords not supported
+            by generated checks, in which case only jsonschema applies.
+
+    """
+    key = name + ".json"
+    if key not in _generated:
+        get_validator(name)
+        cls, schema = _compiled[key]
+        check = _generate(key, schema, cls)
+        if check is None:
+            return None
+        _generated[key] = check
+    return _generated[key]
+
+
+# Keywords written out by generated checks
+_GENERATED_KEYWORDS = set([
+    "type",
+    "enum",
+    "required",
+    "properties",
+    "additionalProperties",
+    "patternProperties",
+    "pattern",
+    "items",
+])
+
+# Keywords with no effect on validation
+_ANNOTATION_KEYWORDS = set([
+    "$schema",
+    "$comment",
+    "title",
+    "description",
+    "example",
+    "examples",
+    "default",
+    "definitions",
+])
+
+_TYPE_EXPRESSIONS = {
+    "object": "isinstance({0}, dict)",
+    "array": "isinstance({0}, (list, tuple))",
+    "string": "isinstance({0}, string_types)",
+    "number": "(isinstance({0}, Number) and not isinstance({0}, bool))",
+    "integer": "(isinstance({0}, integer_types)"
+               " and not isinstance({0}, bool))",
+    "boolean": "isinstance({0}, bool)",
+    "null": "{0} is None",
+}
+
+
+class _Unsupported(Exception):
+    pass
+
+
+class _Fallback(object):
+    """Check of a subschema not written out, made with jsonschema
+
+    Validators are not thread-safe, see `get_validator()`, so each
+    thread is handed its own.
+
+    """
+
+    def __init__(self, cls, schema, document):
+        self.cls = cls
+        self.schema = schema
+        self.document = document
+        self._local = threading.local()
+
+    def __call__(self, instance):
+        validator = getattr(self._local, "validator", None)
+        if validator is None:
+            resolver = jsonschema.RefResolver(
+                "",
+                self.document,
+                store=_cache,
+                cache_remote=True,
+                handlers={"": _resolve_ref}
+            )
+            validator = self.cls(self.schema, resolver=resolver)
+            self._local.validator = validator
+        return validator.is_valid(instance)
+
+
+class _Generator(object):
+    """Write out a schema as the body of a Python function"""
+
+    def __init__(self, cls):
+        self.namespace = {
+            "Number": numbers.Number,
+            "string_types": six.string_types,
+            "integer_types": six.integer_types,
+        }
+        self.cls = cls
+        self.count = 0
+        self.parents = []
+
+        # Draft 6 and onwards consider 1.0 an integer
+        self.types = dict(_TYPE_EXPRESSIONS)
+        if cls.TYPE_CHECKER.is_type(1.0, "integer"):
+            self.types["integer"] = (
+                "(" + self.types["integer"] + " or isinstance({0}, float)"
+                " and {0}.is_integer())"
+            )
+
+    def name(self, prefix):
+        self.count += 1
+        return "%s%d" % (prefix, self.count)
+
+    def constant(self, value):
+        name = self.name("_c")
+        self.namespace[name] = value
+        return name
+
+    def generate(self, schema, var, indent, document):
+        """Return lines of code returning False if `var` is invalid
+
+        Subschemas which cannot be written out are checked by jsonschema.
+
+        """
+        try:
+            return self.write(schema, var, indent, document)
+        except _Unsupported:
+            check = self.constant(_Fallback(self.cls, schema, document))
+            return [
+                indent + "if not %s(%s):" % (check, var),
+                indent + "    return False",
+            ]
+
+    def write(self, schema, var, indent, document):
+        """Return lines of code returning False if `var` is invalid
+
+        Raises:
+            _Unsupported if `schema` uses keywords not written out
+
+        """
+        if schema is True:
+            return []
+        if schema is False:
+            return [indent + "return False"]
+        if not isinstance(schema, dict):
+            raise _Unsupported(schema)
+
+        # Like jsonschema, ignore any keywords next to a $ref
+        if "$ref" in schema:
+            try:
+                resolved, document = _resolve(schema["$ref"], document)
+            except jsonschema.RefResolutionError as e:
+                raise _Unsupported(e)
+            if any(resolved is parent for parent in self.parents):
+                raise _Unsupported("recursive $ref")
+
+            self.parents.append(resolved)
+            try:
+                return self.write(resolved, var, indent, document)
+            finally:
+                self.parents.pop()
+
+        unknown = set(schema) - _GENERATED_KEYWORDS - _ANNOTATION_KEYWORDS
+        if unknown:
+            raise _Unsupported(", ".join(sorted(unknown)))
+
+        lines = []
+
+        types = schema.get("type")
+        if types is not None:
+            if isinstance(types, six.string_types):
+                types = [types]
+            try:
+                expressions = [self.types[type_].format(var)
+                               for type_ in types]
+            except (KeyError, TypeError):
+                raise _Unsupported(types)
+            lines.append(indent + "if not (%s):" % " or ".join(expressions))
+            lines.append(indent + "    return False")
+
+        if "enum" in schema:
+            enum = schema["enum"]
+            if not all(isinstance(value, six.string_types) for value in enum):
+                raise _Unsupported("enum")
+            expression = "%s in %s" % (var, self.constant(frozenset(enum)))
+            if types != ["string"]:
+                expression = "%s and %s" % (
+                    self.types["string"].format(var), expression
+                )
+            lines.append(indent + "if not (%s):" % expression)
+            lines.append(indent + "    return False")
+
+        if "pattern" in schema:
+            try:
+                pattern = re.compile(schema["pattern"])
+            except (re.error, TypeError):
+                raise _Unsupported("pattern")
+            expression = "%s.search(%s)" % (self.constant(pattern), var)
+            if types != ["string"]:
+                expression = "not %s or %s" % (
+                    self.types["string"].format(var), expression
+                )
+            lines.append(indent + "if not (%s):" % expression)
+            lines.append(indent + "    return False")
+
+        # Keywords for objects and arrays only apply to values of that
+        # type, which is already known when the type is enforced above.
+        if types == ["object"]:
+            lines.extend(self.generate_object(schema, var, indent, document))
+        else:
+            body = self.generate_object(
+                schema, var, indent + "    ", document
+            )
+            if body:
+                lines.append(indent + "if isinstance(%s, dict):" % var)
+                lines.extend(body)
+
+        items = schema.get("items", True)
+        if isinstance(items, list):
+            raise _Unsupported("items")
+        item = self.name("v")
+        if types == ["array"]:
+            body = self.generate(items, item, indent + "    ", document)
+            if body:
+                lines.append(indent + "for %s in %s:" % (item, var))
+                lines.extend(body)
+        else:
+            body = self.generate(
+                items, item, indent + "        ", document
+            )
+            if body:
+                lines.append(
+                    indent + "if isinstance(%s, (list, tuple)):" % var
+                )
+                lines.append(indent + "    for %s in %s:" % (item, var))
+                lines.extend(body)
+
+        return lines
+
+    def generate_object(self, schema, var, indent, document):
+        lines = []
+
+        required = schema.get("required", [])
+        if not isinstance(required, list):
+            raise _Unsupported("required")
+        if required:
+            lines.append(indent + "if not %s.issubset(%s):" % (
+                self.constant(frozenset(required)), var
+            ))
+            lines.append(indent + "    return False")
+
+        properties = schema.get("properties", {})
+        for key, subschema in sorted(properties.items()):
+            value = self.name("v")
+            body = self.generate(
+                subschema, value, indent + "    ", document
+            )
+            if body:
+                lines.append(indent + "if %r in %s:" % (key, var))
+                lines.append(indent + "    %s = %s[%r]" % (value, var, key))
+                lines.extend(body)
+
+        patterns = []
+        for pattern, subschema in sorted(
+            schema.get("patternProperties", {}).items()
+        ):
+            try:
+                pattern = self.constant(re.compile(pattern))
+            except (re.error, TypeError):
+                raise _Unsupported("patternProperties")
+            patterns.append(pattern)
+
+            key, value = self.name("k"), self.name("v")
+            body = self.generate(
+                subschema, value, indent + "        ", document
+            )
+            if body:
+                lines.append(indent + "for %s, %s in %s.items():" % (
+                    key, value, var
+                ))
+                lines.append(indent + "    if %s.search(%s):" % (
+                    pattern, key
+                ))
+                lines.extend(body)
+
+        additional = schema.get("additionalProperties", True)
+        known = self.constant(frozenset(properties))
+        if additional is False and not patterns:
+            lines.append(indent + "if not %s.issuperset(%s):" % (known, var))
+            lines.append(indent + "    return False")
+
+        else:
+            key, value = self.name("k"), self.name("v")
+            if additional is False:
+                body = [indent + "    return False"]
+            else:
+                body = self.generate(
+                    additional, value, indent + "    ", document
+                )
+            if body:
+                lines.append(indent + "for %s, %s in %s.items():" % (
+                    key, value, var
+                ))
+                lines.append(indent + "    if %s in %s:" % (key, known))
+                lines.append(indent + "        continue")
+                for pattern in patterns:
+                    lines.append(indent + "    if %s.search(%s):" % (
+                        pattern, key
+                    ))
+                    lines.append(indent + "        continue")
+                lines.extend(body)
+
+        return lines
+
+
+def _resolve(ref, document):
+    """Return schema referenced by `ref` along with its document"""
+    url, fragment = urldefrag(ref)
+    if url:
+        try:
+            document = _load(url)
+        except KeyError:
+            raise jsonschema.RefResolutionError("Unresolvable: %s" % ref)
+
+    resolved = document
+    for part in fragment.lstrip("/").split("/") if fragment else []:
+        part = unquote(part).replace("~1", "/").replace("~0", "~")
+        try:
+            if isinstance(resolved, list):
+                part = int(part)
+            resolved = resolved[part]
+        except (KeyError, IndexError, ValueError, TypeError):
+            raise jsonschema.RefResolutionError("Unresolvable: %s" % ref)
+
+    return resolved, document
+
+
+def _generate(key, schema, cls):
+    generator = _Generator(cls)
+    try:
+        body = generator.write(schema, "v0", "    ", schema)
+    except _Unsupported as e:
+        log_.debug("Schema '%s' not generated, unsupported: %s" % (key, e))
+        return None
+
+    source = "\n".join(["def check(v0):"] + body + ["    return True", ""])
+    exec(compile(source, "<schema %s>" % key, "exec"), generator.namespace)
+    return generator.namespace["check"]
 
 
 _cache = {
@@ -118,6 +1100,7 @@ _cache = {
 
 
 def _precache():
+    """Index available schemas by name, for them to be loaded on first use"""
     global _CACHED
 
     if os.environ.get('AVALON_SCHEMA'):
@@ -126,7 +1109,7 @@ def _precache():
         current_dir = os.path.dirname(os.path.abspath(__file__))
         schema_dir = os.path.join(current_dir, "schema")
 
-    """Store available schemas in-memory for reduced disk access"""
+    index = {}
     for schema in os.listdir(schema_dir):
         if schema.startswith(("_", ".")):
             continue
@@ -134,7 +1117,43 @@ def _precache():
             continue
         if not os.path.isfile(os.path.join(schema_dir, schema)):
             continue
-        with open(os.path.join(schema_dir, schema)) as f:
-            log_.debug("Installing schema '%s'.." % schema)
-            _cache[schema] = json.load(f)
+        index[schema] = os.path.join(schema_dir, schema)
+
+    _index.clear()
+    _index.update(index)
+
+    # Forget previously loaded schemas, except those registered in-memory
+    for key in list(_cache):
+        if key in _loaded:
+            _cache.pop(key)
+    _loaded.clear()
+    _compiled.clear()
+    _generated.clear()
+
     _CACHED = True
+
+
+def _load(key):
+    """Return schema by file name, reading it from disk on first use"""
+    try:
+        return _cache[key]
+    except KeyError:
+        pass
+
+    with open(_index[key]) as f:
+        log_.debug("Installing schema '%s'.." % key)
+        schema = json.load(f)
+
+    _loaded.add(key)
+    return _cache.setdefault(key, schema)
+
+
+def _resolve_ref(uri):
+    # Called by RefResolver for relative $refs not already in its store
+    if not _CACHED:
+        _precache()
+    return _load(uri)
+
+
+if os.environ.get("AVALON_VALIDATION"):
+    set_policy(os.environ["AVALON_VALIDATION"])
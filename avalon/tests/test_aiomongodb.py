@@ -0,0 +1,150 @@
+"""Test aiomongodb.py without a database
+
+Requires Python 3.7 or above, and is ignored by the test runners
+under Python 2.
+
+"""
+
+import sys
+import threading
+
+from nose.tools import (
+    assert_equals,
+)
+
+
+class Cursor(object):
+    """Stand-in for a cursor recording documents fetched"""
+
+    def __init__(self, count):
+        self.documents = iter({"name": str(index)} for index in range(count))
+        self.fetched = 0
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        document = next(self.documents)
+        self.fetched += 1
+        return document
+
+    def close(self):
+        self.closed = True
+
+
+class Database(object):
+    """Stand-in for AvalonMongoDB recording threads of calls"""
+
+    def __init__(self, count=250):
+        self.Session = {"AVALON_PROJECT": "hulk"}
+        self.threads = set()
+        self.cursors = []
+        self.count = count
+
+    def find(self, filter=None, batch_size=None):
+        self.threads.add(threading.current_thread())
+        self.cursors.append(Cursor(self.count))
+        return self.cursors[-1]
+
+    def find_one(self, filter):
+        self.threads.add(threading.current_thread())
+        return {"name": filter["name"]}
+
+
+def test_async():
+    """Calls are awaitable and made in threads of their own"""
+    if sys.version_info < (3, 7):
+        return
+
+    import asyncio
+    from avalon.aiomongodb import AsyncAvalonMongoDB
+
+    dbcon = Database()
+    async_dbcon = AsyncAvalonMongoDB(dbcon=dbcon, concurrency=2)
+
+    async def main():
+        names = []
+        async for document in async_dbcon.find({}, batch_size=100):
+            names.append(document["name"])
+
+        documents = await asyncio.gather(*(
+            async_dbcon.find_one({"name": str(index)})
+            for index in range(10)
+        ))
+        return names, documents
+
+    try:
+        names, documents = asyncio.run(main())
+    finally:
+        async_dbcon.close()
+
+    assert_equals(names, [str(index) for index in range(250)])
+    assert_equals([document["name"] for document in documents],
+                  [str(index) for index in range(10)])
+    assert threading.current_thread() not in dbcon.threads
+    assert len(dbcon.threads) <= 2
+    assert_equals(async_dbcon.Session, dbcon.Session)
+
+
+def test_cursor_batches():
+    """Results are fetched a batch at a time, one batch ahead"""
+    if sys.version_info < (3, 7):
+        return
+
+    import asyncio
+    from avalon.aiomongodb import AsyncAvalonMongoDB
+
+    dbcon = Database(count=25)
+    async_dbcon = AsyncAvalonMongoDB(dbcon=dbcon)
+
+    async def main():
+        cursor = async_dbcon.find({}, batch_size=10)
+        first = await cursor.__anext__()
+
+        # At most the first batch and the one fetched in the background
+        await asyncio.sleep(0.05)
+        fetched = dbcon.cursors[0].fetched
+
+        rest = await cursor.to_list()
+        return first, fetched, rest, await cursor.to_list(5)
+
+    try:
+        first, fetched, rest, after = asyncio.run(main())
+    finally:
+        async_dbcon.close()
+
+    assert_equals(first, {"name": "0"})
+    assert_equals(fetched, 20)
+    assert_equals([document["name"] for document in rest],
+                  [str(index) for index in range(1, 25)])
+    assert_equals(after, [])
+    assert_equals(len(dbcon.cursors), 1)
+
+
+def test_cursor_close():
+    """Closed cursors stop fetching and close the cursor of the server"""
+    if sys.version_info < (3, 7):
+        return
+
+    import asyncio
+    from avalon.aiomongodb import AsyncAvalonMongoDB
+
+    dbcon = Database()
+    async_dbcon = AsyncAvalonMongoDB(dbcon=dbcon)
+
+    async def main():
+        cursor = async_dbcon.find({}, batch_size=10)
+        first = await cursor.to_list(3)
+        await cursor.close()
+        return first, await cursor.to_list()
+
+    try:
+        first, after = asyncio.run(main())
+    finally:
+        async_dbcon.close()
+
+    assert_equals(len(first), 3)
+    assert_equals(after, [])
+    assert dbcon.cursors[0].closed
+    assert dbcon.cursors[0].fetched <= 20
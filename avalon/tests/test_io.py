@@ -0,0 +1,246 @@
+"""Test io.py against an in-memory database
+
+..note: These tests depend on global state and are therefore not reentrant.
+
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import tempfile
+
+import mongomock
+
+from avalon import io, mongodb, schema
+
+from nose.tools import (
+    assert_equals,
+)
+
+self = sys.modules[__name__]
+self._tempdir = None
+self._environ = None
+self._create_connection = None
+
+SCHEMAS = {
+    "session-2.0": {"type": "object"},
+    "test-1.0": {
+        "type": "object",
+        "required": ["schema", "type", "name"],
+    },
+}
+
+PATHS = [
+    ["hulk"],
+    ["hulk", "Bruce"],
+    ["hulk", "Bruce", "modelDefault"],
+    ["hulk", "Bruce", "modelDefault", 1],
+    ["hulk", "Bruce", "modelDefault", 2, "ma"],
+    ["hulk", "Bruce", "modelDefault", None, "abc"],
+    ["hulk", "Bruce", "modelDefault", -1, "ma"],
+    ["hulk", "Bruce", "rigDefault", -1],
+    ["hulk", "Betty", "modelDefault", 1, "ma"],
+    ["hulk", "Betty", "modelDefault", -1, "ma"],
+    ["hulk", "Betty", "modelDefault", 3],
+    ["hulk", "Missing", "modelDefault", 1, "ma"],
+    ["hulk", "Bruce", "modelDefault", 1, "missing"],
+    ["other", "Bruce"],
+]
+
+
+def setup_module():
+    self._environ = dict(os.environ)
+    self._tempdir = tempfile.mkdtemp()
+    for name, document in SCHEMAS.items():
+        with open(os.path.join(self._tempdir, name + ".json"), "w") as f:
+            json.dump(document, f)
+
+    os.environ["AVALON_SCHEMA"] = self._tempdir
+    os.environ["AVALON_DB"] = "avalon"
+    os.environ["AVALON_PROJECT"] = "hulk"
+    schema._CACHED = False
+
+    self._create_connection = mongodb.AvalonMongoConnection.create_connection
+    mongodb.AvalonMongoConnection.create_connection = classmethod(
+        lambda cls: mongomock.MongoClient()
+    )
+
+
+def teardown_module():
+    io.uninstall()
+    mongodb.AvalonMongoConnection.create_connection = self._create_connection
+    mongodb.AvalonMongoConnection.uninstall(None, force=True)
+
+    os.environ.clear()
+    os.environ.update(self._environ)
+    schema._CACHED = False
+    shutil.rmtree(self._tempdir)
+
+
+def setup_function(function):
+    io.install()
+    io.drop()
+    io.invalidate_locate()
+
+    # Bruce has versions 1 and 2, Betty has version 1 only
+    project = insert("project", "hulk", None)
+    for asset_name, versions in (("Bruce", (1, 2)), ("Betty", (1,))):
+        asset = insert("asset", asset_name, project)
+        subset = insert("subset", "modelDefault", asset)
+        for version_name in versions:
+            version = insert("version", version_name, subset)
+            for representation_name in ("ma", "abc"):
+                insert("representation", representation_name, version)
+
+
+def insert(type_, name, parent):
+    return io.insert_one({
+        "schema": "avalon-core:test-1.0",
+        "type": type_,
+        "name": name,
+        "parent": parent,
+    }).inserted_id
+
+
+def locate_per_level(path):
+    """Traverse a hierarchy one query per level, as `locate()` once did"""
+    parent = None
+    for type_, name in zip(io.HIERARCHY, path):
+        if type_ == "version" and name in (None, -1):
+            document = io.find_one(
+                {"type": type_, "parent": parent},
+                projection={"_id": 1},
+                sort=[("name", -1)]
+            )
+        else:
+            document = io.find_one(
+                {"type": type_, "name": name, "parent": parent},
+                projection={"_id": 1},
+            )
+
+        if document is None:
+            return None
+        parent = document["_id"]
+
+    return parent
+
+
+def test_locate():
+    """Paths are resolved like one level at a time"""
+    expected = [locate_per_level(path) for path in PATHS]
+    assert_equals(len([_id for _id in expected if _id is not None]), 9)
+
+    assert_equals([io.locate(path) for path in PATHS], expected)
+    assert_equals(io.locate_many(PATHS), expected)
+
+    # Once cached, and resolved anew
+    assert_equals(io.locate_many(PATHS), expected)
+    io.invalidate_locate()
+    assert_equals(io.locate_many(list(reversed(PATHS))),
+                  list(reversed(expected)))
+    io.invalidate_locate()
+    assert_equals([io.locate(path) for path in PATHS], expected)
+
+
+def test_locate_latest():
+    """Paths to latest versions follow versions as they are published"""
+    path = ["hulk", "Betty", "modelDefault", -1]
+    missing = ["hulk", "Betty", "modelDefault", 2]
+    first = io.locate(path)
+    assert_equals(io.locate(missing), None)
+
+    subset = io.locate(path[:3])
+    second = insert("version", 2, subset)
+    assert first != second
+    assert_equals(io.locate(path), second)
+    assert_equals(io.locate(missing), second)
+    assert_equals(io.locate_many([path, path[:-1] + [None]]),
+                  [second, second])
+
+
+def test_locate_invalidated():
+    """Writes through io are not hidden by the cache"""
+    path = ["hulk", "Bruce", "modelDefault", 1, "ma"]
+    renamed = ["hulk", "Bruce", "modelMain", 1, "ma"]
+    representation = io.locate(path)
+    assert representation is not None
+    assert_equals(io.locate(renamed), None)
+
+    # Only writes through io are known to it
+    collection = io._database[io.active_project()]
+    collection.delete_one({"_id": representation})
+    assert_equals(io.locate(path), representation)
+    collection.insert_one({"_id": representation, "type": "representation",
+                           "name": "ma",
+                           "parent": io.locate(path[:4])})
+
+    io.update_one({"type": "subset", "name": "modelDefault",
+                   "parent": io.locate(path[:2])},
+                  {"$set": {"name": "modelMain"}})
+    assert_equals(io.locate(path), None)
+    assert_equals(io.locate(renamed), representation)
+
+    io.delete_many({"_id": representation})
+    assert_equals(io.locate(renamed), None)
+    assert_equals(io.locate_many([renamed]), [None])
+
+
+def test_locate_expired():
+    """Publishes of other processes show up once remembered paths expire"""
+    path = ["hulk", "Betty", "modelDefault", -1]
+    missing = ["hulk", "Betty", "modelDefault", 2]
+    ttl, io.LOCATE_TTL = io.LOCATE_TTL, 0.1
+    try:
+        first = io.locate(path)
+        assert_equals(io.locate(missing), None)
+        subset = io.locate(path[:3])
+
+        collection = io._database[io.active_project()]
+        second = collection.insert_one({"type": "version", "name": 2,
+                                        "parent": subset}).inserted_id
+        assert_equals(io.locate(path), first)
+        assert_equals(io.locate(missing), None)
+
+        time.sleep(0.2)
+        assert_equals(io.locate(path), second)
+        assert_equals(io.locate(missing), second)
+        assert_equals(io.locate(path[:3]), subset)
+    finally:
+        io.LOCATE_TTL = ttl
+
+
+def test_locate_empty():
+    """Empty paths locate nothing"""
+    assert_equals(io.locate([]), None)
+    assert_equals(io.locate_many([[]]), [None])
+
+
+def test_fork():
+    """The cache of a child process is not locked by other threads"""
+    if not hasattr(os, "register_at_fork"):
+        return
+
+    with io._locate_lock:
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                io.invalidate_locate()
+                code = 0
+            finally:
+                os._exit(code)
+
+    for _ in range(100):
+        finished, status = os.waitpid(pid, os.WNOHANG)
+        if finished:
+            break
+        time.sleep(0.1)
+    else:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+    assert finished, "Child process deadlocked"
+    assert_equals(status, 0)
@@ -0,0 +1,1690 @@
+"""Test mongodb.py without a database
+
+..note: These tests depend on global state and are therefore not reentrant.
+
+"""
+
+import os
+import gc
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+import threading
+
+import bson
+import pymongo
+import mongomock
+
+from avalon import mongodb, schema
+
+from nose.tools import (
+    assert_equals,
+    assert_raises,
+)
+
+
+def setup_function(function):
+    mongodb.set_retry_policy(attempts=3, backoff=0, deadline=10,
+                             breaker_threshold=2, breaker_reset=60)
+    mongodb._breaker.success()
+    mongodb.reset_reconnect_stats()
+
+
+def teardown_module():
+    mongodb.set_retry_policy(attempts=10, backoff=0.1, deadline=30.0,
+                             breaker_threshold=3, breaker_reset=30.0)
+    mongodb._breaker.success()
+    mongodb.reset_reconnect_stats()
+
+
+class Collection(object):
+    """Stand-in for a collection losing connection `failures` times"""
+
+    def __init__(self, failures, error=pymongo.errors.AutoReconnect):
+        self.failures = failures
+        self.error = error
+        self.calls = 0
+
+    def find_one(self, filter=None):
+        return self._call()
+
+    def update_one(self, filter, update, upsert=False):
+        return self._call()
+
+    def update_many(self, filter, update, upsert=False):
+        return self._call()
+
+    def insert_one(self, document):
+        return self._call()
+
+    def delete_one(self, filter):
+        return self._call()
+
+    def _call(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.error("connection lost")
+        return self.calls
+
+
+def test_retry():
+    """Operations are retried until out of attempts"""
+    collection = Collection(failures=2)
+    assert_equals(mongodb.auto_reconnect(collection.find_one)({}), 3)
+
+    collection = Collection(failures=3)
+    assert_raises(pymongo.errors.AutoReconnect,
+                  mongodb.auto_reconnect(collection.find_one), {})
+    assert_equals(collection.calls, 3)
+
+    stats = mongodb.reconnect_stats()
+    assert_equals(stats["retries"], 4)
+    assert_equals(stats["recovered"], 1)
+    assert_equals(stats["failed"], 1)
+
+
+def test_retry_writes():
+    """Writes are only retried when harmless to repeat"""
+    collection = Collection(failures=1)
+    update_one = mongodb.auto_reconnect(collection.update_one)
+    assert_equals(update_one({"_id": 1}, {"$set": {"name": "a"}}), 2)
+
+    # Updates which may match or insert another document when repeated
+    for update, args, kwargs in (
+        (collection.update_one, ({"_id": 1}, {"$inc": {"name": 1}}), {}),
+        (collection.update_one, ({"name": "a"}, {"$set": {"name": "b"}}), {}),
+        (collection.update_one, ({"_id": 1}, {"$set": {"name": "a"}}),
+         {"upsert": True}),
+        (collection.update_many, ({"type": "asset"}, {"$set": {"a": 1}}),
+         {}),
+    ):
+        collection.calls = 0
+        mongodb._breaker.success()
+        assert_raises(pymongo.errors.AutoReconnect,
+                      mongodb.auto_reconnect(update), *args, **kwargs)
+        assert_equals(collection.calls, 1)
+
+    # Deleting by _id twice deletes the same document
+    collection = Collection(failures=1)
+    delete_one = mongodb.auto_reconnect(collection.delete_one)
+    assert_equals(delete_one({"_id": 1}), 2)
+    assert_equals(delete_one({"_id": {"$eq": 1}}), 3)
+
+    collection = Collection(failures=1)
+    delete_one = mongodb.auto_reconnect(collection.delete_one)
+    assert_raises(pymongo.errors.AutoReconnect,
+                  delete_one, {"type": "representation", "parent": 1})
+    assert_equals(collection.calls, 1)
+
+    # Nothing was sent to the server
+    collection = Collection(
+        failures=1, error=pymongo.errors.ServerSelectionTimeoutError
+    )
+    insert_one = mongodb.auto_reconnect(collection.insert_one)
+    assert_equals(insert_one({}), 2)
+
+    assert_equals(mongodb.reconnect_stats()["unsafe"], 5)
+
+
+def test_circuit_breaker():
+    """Operations fail fast once the circuit is open"""
+    for _ in range(2):
+        collection = Collection(failures=3)
+        assert_raises(pymongo.errors.AutoReconnect,
+                      mongodb.auto_reconnect(collection.find_one), {})
+
+    collection = Collection(failures=0)
+    assert_raises(mongodb.CircuitOpenError,
+                  mongodb.auto_reconnect(collection.find_one), {})
+    assert_equals(collection.calls, 0)
+    assert_equals(mongodb.reconnect_stats()["state"], "open")
+
+    # A single trial closes the circuit again
+    mongodb.set_retry_policy(breaker_reset=0)
+    assert_equals(mongodb.auto_reconnect(collection.find_one)({}), 1)
+
+    stats = mongodb.reconnect_stats()
+    assert_equals(stats["state"], "closed")
+    assert_equals(stats["rejected"], 1)
+    assert_equals(stats["opened"], 1)
+    assert_equals(stats["closed"], 1)
+
+
+def connect(function):
+    """Run `function` with a client which connects on first operation"""
+    def decorated():
+        environ = os.environ.get("AVALON_DB")
+        os.environ["AVALON_DB"] = "avalon"
+        clients = []
+
+        def create_connection(cls):
+            clients.append(pymongo.MongoClient(connect=False))
+            return clients[-1]
+
+        original = mongodb.AvalonMongoConnection.create_connection
+        mongodb.AvalonMongoConnection.create_connection = classmethod(
+            create_connection
+        )
+
+        try:
+            function(clients)
+        finally:
+            mongodb.AvalonMongoConnection.create_connection = original
+            mongodb.AvalonMongoConnection.uninstall(None, force=True)
+            if environ is None:
+                os.environ.pop("AVALON_DB")
+            else:
+                os.environ["AVALON_DB"] = environ
+
+    decorated.__name__ = function.__name__
+    decorated.__doc__ = function.__doc__
+    return decorated
+
+
+@connect
+def test_registry(clients):
+    """Objects are forgotten once garbage collected"""
+    # E.g. that of avalon.io
+    existing = set(mongodb.AvalonMongoConnection._databases)
+
+    kept = mongodb.AvalonMongoDB({})
+    kept.install()
+    for _ in range(10):
+        mongodb.AvalonMongoDB({}).install()
+    gc.collect()
+
+    assert_equals(set(mongodb.AvalonMongoConnection._databases) - existing,
+                  set([kept.id]))
+    assert kept.is_installed()
+
+    kept.uninstall()
+    assert not kept.is_installed()
+    assert_equals(mongodb.AvalonMongoConnection.mongo_client(), None)
+
+
+@connect
+def test_install_threads(clients):
+    """Concurrent installs share one client"""
+    objects = [mongodb.AvalonMongoDB({}) for _ in range(8)]
+    threads = [threading.Thread(target=obj.install) for obj in objects]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert_equals(len(clients), 1)
+    assert all(obj.database.client is clients[0] for obj in objects)
+
+
+@connect
+def test_install_fork(clients):
+    """A child process connects anew on first use"""
+    if not hasattr(os, "fork"):
+        return
+
+    dbcon = mongodb.AvalonMongoDB({}, auto_install=False)
+    dbcon.install()
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            code = 1
+            if dbcon._database is None and dbcon.is_installed():
+                if dbcon.database.client is clients[-1] is not clients[0]:
+                    code = 0
+        finally:
+            os._exit(code)
+
+    assert_equals(os.waitpid(pid, 0)[1], 0)
+    assert dbcon.database.client is clients[0]
+
+
+def test_mongo_options():
+    """Connection options are read from the environment into the URL"""
+    options = mongodb.mongo_options({
+        "AVALON_TIMEOUT": "1000",
+        "AVALON_MONGO_MAX_POOL_SIZE": "20",
+        "AVALON_MONGO_COMPRESSORS": "zlib",
+        "AVALON_MONGO_READ_PREFERENCE": "nearest",
+        "AVALON_MONGO_SOCKET_TIMEOUT": "",
+    })
+    assert_equals(options, {
+        "serverSelectionTimeoutMS": 1000,
+        "maxPoolSize": 20,
+        "compressors": "zlib",
+        "readPreference": "nearest",
+    })
+
+    url = mongodb.mongo_url_with_options(
+        "mongodb://host1:27017,host2:27017?replicaSet=rs&maxPoolSize=5",
+        options
+    )
+    client = pymongo.MongoClient(url, connect=False)
+    assert_equals(client.options.pool_options.max_pool_size, 20)
+    assert_equals(client.options.replica_set_name, "rs")
+    assert_equals(client.read_preference.mongos_mode, "nearest")
+
+    # Other options are passed through untouched
+    url = mongodb.mongo_url_with_options(
+        "mongodb://host/?readPreferenceTags=dc:ny&readPreferenceTags=dc:sf"
+        "&authMechanism=GSSAPI&authMechanismProperties=SERVICE_NAME:foo"
+        "&maxpoolsize=5",
+        {"maxPoolSize": 10}
+    )
+    options = pymongo.uri_parser.parse_uri(url)["options"]
+    assert_equals(options["readPreferenceTags"],
+                  [{"dc": "ny"}, {"dc": "sf"}])
+    assert_equals(options["authMechanismProperties"],
+                  {"SERVICE_NAME": "foo"})
+    assert_equals(options["maxPoolSize"], 10)
+
+    assert_raises(ValueError, mongodb.mongo_options,
+                  {"AVALON_MONGO_MAX_POOL_SIZE": "many"})
+
+
+def test_client_factory():
+    """Clients are created by the named factory"""
+    assert mongodb.client_factory() is mongodb._create_openpype_client
+    assert mongodb.client_factory("pymongo") is mongodb.create_client
+    assert mongodb.client_factory("os.path:join") is os.path.join
+    assert_raises(KeyError, mongodb.client_factory, "missing")
+
+    environ = dict(os.environ)
+    os.environ["AVALON_MONGO"] = "mongodb://localhost:27017"
+    os.environ["AVALON_MONGO_FACTORY"] = "test"
+    os.environ["AVALON_MONGO_MAX_POOL_SIZE"] = "2"
+    mongodb.register_client_factory("test", lambda url: url)
+
+    try:
+        assert_equals(mongodb.AvalonMongoConnection.create_connection(),
+                      "mongodb://localhost:27017/?maxPoolSize=2")
+    finally:
+        mongodb._client_factories.pop("test")
+        os.environ.clear()
+        os.environ.update(environ)
+
+
+def test_import_pymongo4():
+    """The module imports without errors removed from pymongo 4"""
+    script = "\n".join([
+        "import pymongo.errors",
+        "del pymongo.errors.NotMasterError",
+        "from avalon import mongodb",
+        "assert pymongo.errors.NotPrimaryError in mongodb._UNSENT_ERRORS",
+    ])
+    assert_equals(subprocess.call([sys.executable, "-c", script]), 0)
+
+
+class BulkDatabase(object):
+    """Stand-in for AvalonMongoDB recording batches of bulk writes"""
+
+    def __init__(self):
+        self.batches = []
+
+    def __getattr__(self, attr_name):
+        assert attr_name == "bulk_write"
+        return self.bulk_write
+
+    def _validate_update(self, query_filter, update, schema_name=None):
+        pass
+
+    def bulk_write(self, requests, ordered=True):
+        self.batches.append(requests)
+        details = {"nInserted": 0, "writeErrors": []}
+        for index, request in enumerate(requests):
+            if request._doc.get("name") == "invalid":
+                details["writeErrors"].append(
+                    {"index": index, "code": 11000, "errmsg": "duplicate"}
+                )
+                if ordered:
+                    break
+            else:
+                details["nInserted"] += 1
+
+        if details["writeErrors"]:
+            raise pymongo.errors.BulkWriteError(details)
+        return pymongo.results.BulkWriteResult(details, True)
+
+
+def test_bulk():
+    """Writes are sent in batches, with errors by index of write"""
+    from avalon import schema
+    schema.set_policy("off")
+
+    try:
+        for ordered, inserted, skipped in ((False, 6, 0), (True, 2, 4)):
+            dbcon = BulkDatabase()
+            writer = mongodb.BulkWriter(dbcon, ordered, max_operations=3)
+            for name in ("a", "b", "invalid", "c", "d", "e", "f"):
+                writer.insert_one({"name": name})
+            result = writer.flush()
+
+            assert_equals(result["inserted"], inserted)
+            assert_equals(result["skipped"], skipped)
+            assert_equals([error["index"] for error in result["errors"]],
+                          [2])
+
+        assert_equals([len(batch) for batch in dbcon.batches], [3])
+
+        dbcon = BulkDatabase()
+        writer = mongodb.BulkWriter(dbcon, max_bytes=120)
+        for name in "abcd":
+            writer.insert_one({"name": name, "data": "x" * 30})
+        writer.flush()
+        assert_equals([len(batch) for batch in dbcon.batches], [2, 2])
+
+    finally:
+        schema.set_policy("strict")
+
+
+def test_bulk_connection_error():
+    """Writes remain queued when sending them fails"""
+    from avalon import schema
+    schema.set_policy("off")
+
+    class FailingDatabase(BulkDatabase):
+        def bulk_write(self, requests, ordered=True):
+            if not self.batches:
+                self.batches.append(None)
+                raise pymongo.errors.ConnectionFailure("x")
+            return super(FailingDatabase, self).bulk_write(requests, ordered)
+
+    try:
+        dbcon = FailingDatabase()
+        writer = mongodb.BulkWriter(dbcon)
+        for name in "ab":
+            writer.insert_one({"name": name})
+
+        assert_raises(pymongo.errors.ConnectionFailure, writer.flush)
+        assert_equals(writer.flush()["inserted"], 2)
+        assert_equals(writer.flush()["inserted"], 2)
+        assert_equals([len(batch) for batch in dbcon.batches[1:]], [2])
+
+    finally:
+        schema.set_policy("strict")
+
+
+class StandInCollection(object):
+    """Thread-safe stand-in for the few collection methods of publishing
+
+    Each operation is atomic, as in MongoDB, whereas operations made
+    by many threads interleave.
+
+    """
+
+    def __init__(self, documents=()):
+        self.documents = dict((doc["_id"], doc) for doc in documents)
+        self.lock = threading.Lock()
+        self.queries = 0
+
+    def find(self, filter, projection=None):
+        self.queries += 1
+        ids = filter["_id"]["$in"]
+        with self.lock:
+            return [
+                dict(self.documents[_id]) for _id in ids
+                if _id in self.documents
+            ]
+
+    def find_one(self, filter, projection=None, sort=None):
+        self.queries += 1
+        with self.lock:
+            documents = [
+                dict(doc) for doc in self.documents.values()
+                if all(doc.get(key) == value for key, value in filter.items())
+            ]
+
+        for key, direction in reversed(sort or []):
+            documents.sort(key=lambda doc: doc[key], reverse=direction < 0)
+        return documents[0] if documents else None
+
+    def insert_one(self, document):
+        time.sleep(0.0001)
+        with self.lock:
+            if document["_id"] in self.documents:
+                raise pymongo.errors.DuplicateKeyError("duplicate")
+            self.documents[document["_id"]] = dict(document)
+
+    def find_one_and_update(self, filter, update, return_document=False):
+        time.sleep(0.0001)
+        with self.lock:
+            document = self.documents.get(filter["_id"])
+            if document is None:
+                return None
+            for key, value in update["$inc"].items():
+                document[key] = document.get(key, 0) + value
+            return dict(document)
+
+    def update_one(self, filter, update):
+        with self.lock:
+            document = self.documents.get(filter["_id"])
+            if document is None:
+                return
+            for key, value in update["$max"].items():
+                document[key] = max(document.get(key, value), value)
+
+
+class StandInDatabase(dict):
+    name = "avalon"
+
+    def __missing__(self, key):
+        return self.setdefault(key, StandInCollection())
+
+
+@connect
+def test_reserve_versions(clients):
+    """Concurrent publishers are handed unique, consecutive versions"""
+    subset_id = bson.ObjectId()
+    database = StandInDatabase()
+    database["hulk"] = StandInCollection([
+        {"_id": bson.ObjectId(), "type": "version", "parent": subset_id,
+         "name": 3},
+    ])
+    original = mongodb.AvalonMongoConnection.__dict__["database"]
+    mongodb.AvalonMongoConnection.database = classmethod(
+        lambda cls: database
+    )
+
+    reserved = []
+    errors = []
+
+    def publisher():
+        dbcon = mongodb.AvalonMongoDB({"AVALON_PROJECT": "hulk"})
+        try:
+            for index in range(20):
+                if index % 5:
+                    reserved.append(dbcon.next_version(subset_id))
+                else:
+                    reserved.extend(dbcon.reserve_versions(subset_id, 3))
+        except Exception as e:
+            errors.append(e)
+
+    try:
+        threads = [threading.Thread(target=publisher) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        mongodb.AvalonMongoConnection.database = original
+
+    assert_equals(errors, [])
+    assert_equals(sorted(reserved), list(range(4, 4 + 16 * 28)))
+    assert_equals(
+        len([doc for doc in database["hulk.meta"].documents.values()
+             if doc["type"] == "counter"]),
+        1
+    )
+
+
+@connect
+def test_representation_contexts(clients):
+    """Contexts of many representations take one query per level"""
+    project = {"_id": bson.ObjectId(), "type": "project", "name": "hulk",
+               "data": {"code": "hlk"}}
+    documents = [project]
+    representation_ids = []
+    for asset_name in ("Bruce", "Betty"):
+        asset = {"_id": bson.ObjectId(), "type": "asset",
+                 "parent": project["_id"], "name": asset_name}
+        subset = {"_id": bson.ObjectId(), "type": "subset",
+                  "parent": asset["_id"], "name": "modelDefault"}
+        version = {"_id": bson.ObjectId(), "type": "version",
+                   "parent": subset["_id"], "name": 1,
+                   "data": {"comment": asset_name}}
+        hero = {"_id": bson.ObjectId(), "type": "hero_version",
+                "parent": subset["_id"], "version_id": version["_id"]}
+        documents += [asset, subset, version, hero]
+        for parent in (version, hero):
+            for name in ("ma", "abc"):
+                representation = {"_id": bson.ObjectId(),
+                                  "type": "representation",
+                                  "parent": parent["_id"], "name": name}
+                documents.append(representation)
+                representation_ids.append(representation["_id"])
+
+    database = StandInDatabase()
+    database["hulk"] = StandInCollection(documents)
+    original = mongodb.AvalonMongoConnection.__dict__["database"]
+    mongodb.AvalonMongoConnection.database = classmethod(
+        lambda cls: database
+    )
+
+    try:
+        dbcon = mongodb.AvalonMongoDB({"AVALON_PROJECT": "hulk"})
+        missing = bson.ObjectId()
+
+        # Ids are given as strings, ObjectIds or both
+        given = [str(_id) for _id in representation_ids[:4]]
+        given += representation_ids[3:]
+        contexts = dbcon.get_representation_contexts(given + [missing])
+    finally:
+        mongodb.AvalonMongoConnection.database = original
+
+    # Representations, versions, hero sources, subsets, assets and project
+    assert_equals(database["hulk"].queries, 6)
+    assert_equals(sorted(contexts, key=str), sorted(given, key=str))
+
+    for repre_id, context in contexts.items():
+        assert_equals(context["representation"]["_id"],
+                      bson.ObjectId(repre_id))
+        assert_equals(context["project"], {"name": "hulk", "code": "hlk"})
+        assert_equals(context["version"]["data"]["comment"],
+                      context["asset"]["name"])
+        assert_equals(context["subset"]["parent"], context["asset"]["_id"])
+
+    # Shared documents are not shared between contexts
+    first, second = [contexts[_id] for _id in given[:2]]
+    assert first["version"] is not second["version"]
+    first, second = contexts[given[3]], contexts[given[4]]
+    assert first["representation"] is not second["representation"]
+
+
+# Schema of documents of `mock_database()`
+TEST_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "title": "avalon-core:test-1.0",
+    "type": "object",
+    "required": ["schema", "type", "name"],
+    "properties": {
+        "name": {"type": ["string", "number"]},
+        "data": {"type": "object"},
+    }
+}
+
+# Collection methods counted by `mock_database()`
+COUNTED_METHODS = (
+    "find",
+    "find_one",
+    "aggregate",
+    "distinct",
+    "insert_one",
+    "insert_many",
+    "update_one",
+    "update_many",
+    "replace_one",
+    "delete_one",
+    "delete_many",
+    "bulk_write",
+    "find_one_and_update",
+)
+
+
+def mock_database(function):
+    """Run `function` with an AvalonMongoDB of an in-memory database
+
+    The function is passed the AvalonMongoDB of project "hulk" and the
+    number of calls made to each collection method, by name.
+
+    """
+    def decorated():
+        environ = dict(os.environ)
+        tempdir = tempfile.mkdtemp()
+        with open(os.path.join(tempdir, "test-1.0.json"), "w") as f:
+            json.dump(TEST_SCHEMA, f)
+
+        os.environ["AVALON_DB"] = "avalon"
+        os.environ["AVALON_SCHEMA"] = tempdir
+        schema._CACHED = False
+
+        client = mongomock.MongoClient()
+        original = mongodb.AvalonMongoConnection.create_connection
+        mongodb.AvalonMongoConnection.create_connection = classmethod(
+            lambda cls: client
+        )
+
+        # Calls made by other methods, e.g. of bulk_write, are not counted
+        calls = {}
+        local = threading.local()
+        methods = {}
+
+        def counted(name, method):
+            def wrapper(*args, **kwargs):
+                if getattr(local, "calling", False):
+                    return method(*args, **kwargs)
+                calls[name] = calls.get(name, 0) + 1
+                local.calling = True
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    local.calling = False
+            return wrapper
+
+        for name in COUNTED_METHODS:
+            methods[name] = getattr(mongomock.collection.Collection, name)
+            setattr(mongomock.collection.Collection, name,
+                    counted(name, methods[name]))
+
+        dbcon = mongodb.AvalonMongoDB({"AVALON_PROJECT": "hulk"})
+        try:
+            function(dbcon, calls)
+        finally:
+            for name, method in methods.items():
+                setattr(mongomock.collection.Collection, name, method)
+
+            dbcon.uninstall()
+            mongodb.AvalonMongoConnection.create_connection = original
+            mongodb.AvalonMongoConnection.uninstall(None, force=True)
+            mongodb.AvalonMongoConnection.invalidate_projects()
+
+            os.environ.clear()
+            os.environ.update(environ)
+            schema._CACHED = False
+            shutil.rmtree(tempdir)
+
+    decorated.__name__ = function.__name__
+    decorated.__doc__ = function.__doc__
+    return decorated
+
+
+def document(type_, name, parent=None, **kwargs):
+    """Return document of `mock_database()`"""
+    kwargs.update({
+        "schema": "avalon-core:test-1.0",
+        "type": type_,
+        "name": name,
+        "parent": parent,
+    })
+    return kwargs
+
+
+def raw_insert(dbcon, documents):
+    """Insert `documents` directly into the collection, bypassing dbcon"""
+    dbcon.install()
+    dbcon.database[dbcon.active_project()].insert_many(documents)
+
+
+@mock_database
+def test_collection_attributes(dbcon, calls):
+    """Collection attributes are wrapped once per project and install"""
+    raw_insert(dbcon, [document("asset", "Bruce")])
+    count_documents = dbcon.count_documents
+    assert dbcon.count_documents is count_documents
+    assert_equals(count_documents({}), 1)
+
+    # Attributes of the collection of another project
+    dbcon.Session["AVALON_PROJECT"] = "betty"
+    assert dbcon.count_documents is not count_documents
+    assert_equals(dbcon.count_documents({}), 0)
+
+    dbcon.Session["AVALON_PROJECT"] = "hulk"
+    count_documents = dbcon.count_documents
+    dbcon.uninstall()
+    dbcon.install()
+    assert dbcon.count_documents is not count_documents
+    assert_equals(dbcon.count_documents({}), 1)
+
+
+@mock_database
+def test_latest_versions(dbcon, calls):
+    """Latest versions of many subsets are found in one aggregation"""
+    first, second, empty = [bson.ObjectId() for _ in range(3)]
+    raw_insert(dbcon, [
+        document("version", name, first, data={"comment": str(name)})
+        for name in (1, 3, 2)
+    ] + [document("version", 1, second)])
+    calls.clear()
+
+    latest = dbcon.latest_versions([first, second, empty])
+    assert_equals(sorted(latest), sorted([first, second]))
+    assert_equals(latest[first]["name"], 3)
+    assert_equals(latest[first]["data"], {"comment": "3"})
+    assert_equals(latest[second]["name"], 1)
+
+    latest = dbcon.latest_versions([first, second], projection=["name"])
+    assert_equals(sorted(latest[first]), ["_id", "name"])
+    assert_equals(latest[first]["name"], 3)
+
+    latest = dbcon.latest_versions([first], projection={"data": False})
+    assert "data" not in latest[first]
+    assert_equals(latest[first]["parent"], first)
+
+    assert_equals(calls, {"aggregate": 3})
+
+
+@mock_database
+def test_latest_pointers(dbcon, calls):
+    """Inserts of versions through AvalonMongoDB maintain pointers"""
+    dbcon.Session["AVALON_LATEST_POINTERS"] = "1"
+    asset_id = bson.ObjectId()
+
+    subset = document("subset", "modelDefault")
+    version = document("version", 1)
+    dbcon.publish_batch(asset_id, [(subset, version, [])])
+    subset_id = subset["_id"]
+    assert_equals(dbcon.latest_version_ids([subset_id]),
+                  {subset_id: version["_id"]})
+
+    version = document("version", 2, subset_id)
+    dbcon.insert_one(version)
+    assert_equals(dbcon.latest_version_ids([subset_id]),
+                  {subset_id: version["_id"]})
+
+    versions = [document("version", name, subset_id) for name in (4, 3)]
+    dbcon.insert_many(versions)
+    assert_equals(dbcon.latest_version_ids([subset_id]),
+                  {subset_id: versions[0]["_id"]})
+
+    with dbcon.bulk(max_operations=2) as writer:
+        for name in (5, 7, 6):
+            version = document("version", name, subset_id)
+            writer.insert_one(version)
+            if name == 7:
+                latest = version
+    assert_equals(dbcon.latest_version_ids([subset_id]),
+                  {subset_id: latest["_id"]})
+
+    # Pointers are looked up by id
+    calls.clear()
+    dbcon.latest_version_ids([subset_id])
+    assert_equals(calls, {"find": 1})
+
+
+@mock_database
+def test_latest_pointers_fallback(dbcon, calls):
+    """Subsets without pointers fall back to, and seed, the aggregation"""
+    dbcon.Session["AVALON_LATEST_POINTERS"] = "1"
+    subset_id = bson.ObjectId()
+    versions = [document("version", name, subset_id) for name in (1, 2)]
+    raw_insert(dbcon, versions)
+    calls.clear()
+
+    expected = {subset_id: versions[1]["_id"]}
+    assert_equals(dbcon.latest_version_ids([subset_id]), expected)
+    assert_equals(calls["aggregate"], 1)
+
+    calls.clear()
+    assert_equals(dbcon.latest_version_ids([subset_id]), expected)
+    assert_equals(calls, {"find": 1})
+
+    # Pointers of versions inserted whilst seeding are kept
+    other = bson.ObjectId()
+    newer = document("version", 2, other)
+    latest_versions = dbcon.latest_versions
+
+    def concurrently(*args, **kwargs):
+        result = latest_versions(*args, **kwargs)
+        dbcon.insert_one(newer)
+        return result
+
+    raw_insert(dbcon, [document("version", 1, other)])
+    dbcon.latest_versions = concurrently
+    dbcon.latest_version_ids([other])
+    del dbcon.latest_versions
+    assert_equals(dbcon.latest_version_ids([other]),
+                  {other: newer["_id"]})
+
+    # Pointers at newer versions than exist are replaced explicitly
+    pointer_id = mongodb._derived_id(subset_id, "latest_version")
+    dbcon.database["hulk.meta"].update_one(
+        {"_id": pointer_id}, {"$set": {"version": 3, "version_id": other}}
+    )
+    assert_equals(dbcon.latest_version_ids([subset_id]), {subset_id: other})
+    assert_equals(dbcon.update_latest_pointers([subset_id]), expected)
+    assert_equals(dbcon.latest_version_ids([subset_id]), expected)
+
+    # Without pointers, every lookup is an aggregation
+    dbcon.Session.pop("AVALON_LATEST_POINTERS")
+    calls.clear()
+    assert_equals(dbcon.latest_version_ids([subset_id]), expected)
+    assert_equals(calls, {"aggregate": 1})
+
+
+class Finder(object):
+    """Stand-in for `find()` of a collection, recording queried ids"""
+
+    def __init__(self, documents, error=None, latency=0):
+        self.documents = dict((doc["_id"], doc) for doc in documents)
+        self.error = error
+        self.latency = latency
+        self.queries = []
+
+    def __call__(self, filter):
+        self.queries.append(filter["_id"]["$in"])
+        time.sleep(self.latency)
+        if self.error is not None:
+            raise self.error
+        return [
+            dict(self.documents[_id]) for _id in filter["_id"]["$in"]
+            if _id in self.documents
+        ]
+
+
+def test_batcher_threads():
+    """Lookups of concurrent threads are merged into few queries"""
+    documents = [{"_id": index} for index in range(16)]
+    find = Finder(documents, latency=0.01)
+    batcher = mongodb._IdBatcher(window=0.05)
+    start = threading.Event()
+    results = {}
+
+    def lookup(_id):
+        start.wait()
+        results[_id] = batcher.load("hulk", _id, find)
+
+    threads = [
+        threading.Thread(target=lookup, args=(doc["_id"],))
+        for doc in documents
+    ]
+    for thread in threads:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join()
+
+    assert_equals(results, dict((doc["_id"], doc) for doc in documents))
+    assert len(find.queries) <= 3, find.queries
+    assert_equals(sorted(sum(find.queries, [])), list(range(16)))
+
+
+def test_batcher_alone():
+    """Lookups of a single thread are not delayed by the window"""
+    find = Finder([{"_id": index} for index in range(20)])
+    batcher = mongodb._IdBatcher(window=0.5, memoize=True)
+
+    start = time.time()
+    for _id in range(20):
+        assert_equals(batcher.load("hulk", _id, find), {"_id": _id})
+    assert time.time() - start < 0.5
+
+    # Memoized until cleared, and handed out as copies
+    document = batcher.load("hulk", 0, find)
+    document["name"] = "changed"
+    assert_equals(batcher.load("hulk", 0, find), {"_id": 0})
+    assert_equals(len(find.queries), 20)
+
+    batcher.clear()
+    batcher.load("hulk", 0, find)
+    assert_equals(len(find.queries), 21)
+    assert_equals(batcher.load("hulk", 99, find), None)
+    assert_equals(batcher.stats(), {"lookups": 24, "queries": 22})
+
+    # Misses are not memoized
+    assert_equals(batcher.load("hulk", 99, find), None)
+    assert_equals(len(find.queries), 23)
+
+
+def test_batcher_error():
+    """Errors of a query are raised to every thread waiting for it"""
+    find = Finder([{"_id": 1}], error=pymongo.errors.OperationFailure("x"),
+                  latency=0.01)
+    batcher = mongodb._IdBatcher(window=0.05, memoize=True)
+    start = threading.Event()
+    errors = []
+
+    def lookup():
+        start.wait()
+        try:
+            batcher.load("hulk", 1, find)
+        except pymongo.errors.OperationFailure as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=lookup) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join()
+
+    assert_equals(len(errors), 4)
+    assert_equals(len(find.queries), 1)
+
+    # Failed lookups are not memoized
+    find.error = None
+    assert_equals(batcher.load("hulk", 1, find), {"_id": 1})
+
+
+@mock_database
+def test_batched(dbcon, calls):
+    """Documents found within `batched()` are reused until written"""
+    asset = document("asset", "Bruce")
+    dbcon.insert_one(asset)
+    calls.clear()
+
+    with dbcon.batched():
+        for _ in range(3):
+            assert_equals(dbcon.find_one({"_id": asset["_id"]})["name"],
+                          "Bruce")
+        assert_equals(calls, {"find": 1})
+
+        dbcon.update_one({"_id": asset["_id"]}, {"$set": {"name": "Hulk"}})
+        assert_equals(dbcon.find_one({"_id": asset["_id"]})["name"],
+                      "Hulk")
+        assert_equals(calls, {"find": 2, "update_one": 1})
+
+    dbcon.find_one({"_id": asset["_id"]})
+    assert_equals(calls, {"find": 2, "update_one": 1, "find_one": 1})
+
+
+@mock_database
+def test_batched_insert(dbcon, calls):
+    """Documents missing within `batched()` are found once inserted"""
+    asset = document("asset", "Bruce", _id=bson.ObjectId())
+
+    with dbcon.batched():
+        assert_equals(dbcon.find_one({"_id": asset["_id"]}), None)
+        dbcon.insert_one(asset)
+        assert_equals(dbcon.find_one({"_id": asset["_id"]})["name"],
+                      "Bruce")
+
+
+@mock_database
+def test_replace_schema(dbcon, calls):
+    """Replacements without a schema are validated against the stored one"""
+    asset = document("asset", "Bruce")
+    dbcon.insert_one(asset)
+
+    replacement = {"type": "asset", "name": "Hulk"}
+    dbcon.replace_one({"_id": asset["_id"]}, replacement)
+    assert_equals(dbcon.find_one({"_id": asset["_id"]})["schema"],
+                  asset["schema"])
+
+    for writer in (dbcon, mongodb.BulkWriter(dbcon)):
+        assert_raises(schema.ValidationError, writer.replace_one,
+                      {"_id": asset["_id"]}, {"type": "asset"})
+        assert_raises(schema.ValidationError, writer.replace_one,
+                      {"name": "Betty"}, replacement, upsert=True)
+
+    with dbcon.bulk() as writer:
+        writer.replace_one({"_id": asset["_id"]},
+                           dict(replacement, name="Banner"))
+    assert_equals(writer.result["modified"], 1)
+    assert_equals(dbcon.find_one({"_id": asset["_id"]})["name"], "Banner")
+
+
+@mock_database
+def test_update_stored_schema(dbcon, calls):
+    """Updates are validated against the schemas of stored documents"""
+    raw_insert(dbcon, [
+        dict(document("asset", "Bruce"), schema="avalon-core:test-0.9"),
+        document("asset", "Betty"),
+    ])
+    calls.clear()
+
+    # Not validated against schemas unknown to this process
+    invalid = {"$set": {"name": {"first": "Bruce"}}}
+    dbcon.update_one({"type": "asset", "name": "Bruce"}, invalid)
+    assert_raises(schema.ValidationError, dbcon.update_one,
+                  {"type": "asset", "name": "Betty"}, invalid)
+    assert_raises(schema.ValidationError, dbcon.update_many,
+                  {"type": "asset"}, invalid)
+    assert_equals(calls, {"distinct": 3, "update_one": 1})
+
+    # Schemas named by the filter are not read
+    assert_raises(schema.ValidationError, dbcon.update_one,
+                  {"type": "asset", "schema": "avalon-core:test-1.0"},
+                  invalid)
+    assert_equals(calls, {"distinct": 3, "update_one": 1})
+
+
+@mock_database
+def test_reserve_versions_mixed(dbcon, calls):
+    """Versions inserted otherwise are not handed out by counters"""
+    dbcon.Session["AVALON_VERSION_COUNTERS"] = "1"
+    subset_id = bson.ObjectId()
+    assert_equals(dbcon.reserve_versions(subset_id, 2), [1, 2])
+
+    dbcon.insert_one(document("version", 3, subset_id))
+    assert_equals(dbcon.next_version(subset_id), 4)
+
+    dbcon.insert_many([document("version", name, subset_id)
+                       for name in (6, 5)])
+    assert_equals(dbcon.next_version(subset_id), 7)
+
+    with dbcon.bulk() as writer:
+        writer.insert_one(document("version", 8, subset_id))
+    assert_equals(dbcon.next_version(subset_id), 9)
+
+    subset = document("subset", "modelDefault")
+    dbcon.publish_batch(bson.ObjectId(), [
+        (subset, document("version", 1), [])
+    ])
+    dbcon.insert_one(document("version", 2, subset["_id"]))
+    assert_equals(dbcon.next_version(subset["_id"]), 3)
+
+    # Counters start from versions inserted before their first use
+    subset = document("subset", "rigDefault")
+    dbcon.publish_batch(bson.ObjectId(), [
+        (subset, document("version", 4), [])
+    ])
+    assert_equals(dbcon.next_version(subset["_id"]), 5)
+
+    # Unless enabled, inserts of versions write nothing else
+    dbcon.Session.pop("AVALON_VERSION_COUNTERS")
+    calls.clear()
+    dbcon.insert_one(document("version", 9, subset_id))
+    with dbcon.bulk() as writer:
+        writer.insert_one(document("version", 10, subset_id))
+    assert_equals(calls, {"insert_one": 1, "bulk_write": 1})
+
+
+@mock_database
+def test_version_counters_apart(dbcon, calls):
+    """Counters and pointers are kept apart from documents of the project"""
+    dbcon.Session["AVALON_LATEST_POINTERS"] = "1"
+    dbcon.Session["AVALON_VERSION_COUNTERS"] = "1"
+    dbcon.enable_document_cache()
+    subset = document("subset", "modelDefault")
+    dbcon.insert_one(subset)
+    assert_equals(dbcon.reserve_versions(subset["_id"]), [1])
+
+    dbcon.find_one({"_id": subset["_id"]})
+    entries = dbcon.document_cache_stats()["entries"]
+    version = document("version", 2, subset["_id"])
+    dbcon.insert_one(version)
+    assert_equals(dbcon.latest_version_ids([subset["_id"]]),
+                  {subset["_id"]: version["_id"]})
+
+    # Writes of counters and pointers forget no cached document
+    assert_equals(dbcon.document_cache_stats()["entries"], entries)
+    assert_equals(dbcon.next_version(subset["_id"]), 3)
+    assert_equals([doc["type"] for doc in dbcon.find(
+        {"parent": subset["_id"]})], ["version"])
+    assert "hulk.meta" not in dbcon.projects()
+
+
+def publish_items(names=("ma", "abc")):
+    """Return items of `publish_batch()`, sharing subset and version"""
+    subset = document("subset", "modelDefault")
+    version = document("version", 1)
+    return [
+        (subset, version, [document("representation", name)])
+        for name in names
+    ]
+
+
+def find_published(dbcon):
+    return dict(
+        ((doc["type"], doc["name"]), doc)
+        for doc in dbcon.find({"type": {"$in": [
+            "subset", "version", "representation"
+        ]}})
+    )
+
+
+@mock_database
+def test_publish_batch(dbcon, calls):
+    """Missing documents are created, existing ones reused"""
+    asset_id = bson.ObjectId()
+    items = publish_items()
+    dbcon.install()
+    calls.clear()
+
+    created = dbcon.publish_batch(asset_id, items)
+
+    # One query for existing documents, one write for missing ones
+    assert_equals(calls, {"aggregate": 1, "bulk_write": 1})
+    assert_equals(len(created), 4)
+
+    published = find_published(dbcon)
+    subset, version, _ = items[0]
+    assert_equals(sorted(created), sorted(doc["_id"] for doc in
+                                          published.values()))
+    assert_equals(published[("subset", "modelDefault")]["parent"], asset_id)
+    assert_equals(subset["_id"], published[("subset", "modelDefault")]["_id"])
+    assert_equals(version["parent"], subset["_id"])
+    for _, _, repres in items:
+        assert_equals(repres[0]["parent"], version["_id"])
+        assert_equals(
+            published[("representation", repres[0]["name"])]["parent"],
+            version["_id"]
+        )
+
+    # Existing documents are given to new dicts of the same names
+    again = publish_items(("ma", "abc", "usd"))
+    calls.clear()
+    created = dbcon.publish_batch(asset_id, again)
+    assert_equals(calls, {"aggregate": 1, "bulk_write": 1})
+    usd = again[2][2][0]
+    assert_equals(created, [usd["_id"]])
+    assert_equals(again[0][0]["_id"], subset["_id"])
+    assert_equals(again[1][1]["_id"], version["_id"])
+    assert_equals(usd["parent"], version["_id"])
+
+    calls.clear()
+    assert_equals(dbcon.publish_batch(asset_id, publish_items()), [])
+    assert_equals(calls, {"aggregate": 1})
+
+
+@mock_database
+def test_publish_batch_duplicates(dbcon, calls):
+    """Dicts sharing a name are given the same identifiers"""
+    items = publish_items()
+    duplicate = (dict(items[0][0]), dict(items[0][1]),
+                 [document("representation", "ma")])
+    items.append(duplicate)
+
+    created = dbcon.publish_batch(bson.ObjectId(), items)
+    assert_equals(len(created), 4)
+    assert_equals(duplicate[0]["_id"], items[0][0]["_id"])
+    assert_equals(duplicate[1]["_id"], items[0][1]["_id"])
+    assert_equals(duplicate[1]["parent"], items[0][0]["_id"])
+    assert_equals(duplicate[2][0]["_id"], items[0][2][0]["_id"])
+
+
+@mock_database
+def test_publish_batch_adopt(dbcon, calls):
+    """Documents created concurrently are adopted along with children"""
+    asset_id = bson.ObjectId()
+    other = document("subset", "modelDefault", asset_id)
+    dbcon.insert_one(other)
+
+    # As though created after existing documents were looked up
+    dbcon._find_published = lambda *args: {}
+    items = publish_items()
+    created = dbcon.publish_batch(asset_id, items)
+
+    subset, version, _ = items[0]
+    assert_equals(len(created), 3)
+    assert other["_id"] not in created
+    assert_equals(subset["_id"], other["_id"])
+    assert_equals(version["parent"], other["_id"])
+
+    published = find_published(dbcon)
+    assert_equals(published[("subset", "modelDefault")]["_id"],
+                  other["_id"])
+    assert_equals(published[("version", 1)]["parent"], other["_id"])
+    assert_equals(dbcon.count_documents({"type": "subset"}), 1)
+
+
+@mock_database
+def test_publish_batch_invalid(dbcon, calls):
+    """Nothing is written, nor dicts changed, when any is invalid"""
+    items = publish_items()
+    items[1][2][0]["data"] = "invalid"
+    dbcon.install()
+    calls.clear()
+
+    assert_raises(schema.ValidationError,
+                  dbcon.publish_batch, bson.ObjectId(), items)
+    assert_equals(calls, {"aggregate": 1})
+    for subset, version, repres in items:
+        for doc in [subset, version] + repres:
+            assert "_id" not in doc
+            assert_equals(doc["parent"], None)
+
+
+@mock_database
+def test_migrate(dbcon, calls):
+    """Documents are upgraded in batches, resumed after the last written"""
+    assets = [document("asset", name, _id=bson.ObjectId())
+              for name in ("Bruce", "Betty", "Rick", "Jen", "Thaddeus")]
+    raw_insert(dbcon, assets)
+    upgraded = []
+
+    def upgrade(document):
+        upgraded.append(document["name"])
+        if document["name"] == "Rick":
+            document["data"] = "invalid"
+        else:
+            document["data"] = {"upgraded": True}
+        return document
+
+    with open(os.path.join(os.environ["AVALON_SCHEMA"],
+                           "test-2.0.json"), "w") as f:
+        json.dump(dict(TEST_SCHEMA, title="avalon-core:test-2.0"), f)
+    schema._CACHED = False
+    schema.register_upgrade("test-1.0", "test-2.0")(upgrade)
+
+    reports = []
+
+    def interrupt(report):
+        reports.append(dict(report))
+        raise RuntimeError("interrupted")
+
+    try:
+        assert_raises(RuntimeError, dbcon.migrate,
+                      batch_size=2, callback=interrupt)
+        assert_equals(upgraded, ["Bruce", "Betty"])
+        assert_equals(reports[0]["written"], 2)
+        assert_equals(reports[0]["last_id"], assets[1]["_id"])
+
+        # Documents up to the last id are not read again
+        del upgraded[:]
+        report = dbcon.migrate(batch_size=2,
+                               resume_after=reports[0]["last_id"])
+        assert_equals(upgraded, ["Rick", "Jen", "Thaddeus"])
+        assert_equals(report["scanned"], 3)
+        assert_equals(report["upgraded"], 2)
+        assert_equals(report["invalid"], 1)
+        assert_equals(report["written"], 2)
+        assert_equals(report["last_id"], assets[-1]["_id"])
+    finally:
+        schema._upgrades.clear()
+
+    # Invalid documents are left as they were
+    migrated = dict(
+        (doc["name"], doc) for doc in dbcon.find({"type": "asset"})
+    )
+    for name, doc in migrated.items():
+        if name == "Rick":
+            assert_equals(doc["schema"], "avalon-core:test-1.0")
+            assert "data" not in doc
+        else:
+            assert_equals(doc["schema"], "avalon-core:test-2.0")
+            assert_equals(doc["data"], {"upgraded": True})
+
+
+def insert_projects(dbcon):
+    """Insert a project document into each of a few collections"""
+    dbcon.install()
+    projects = {
+        "hulk": {"data": {"code": "hlk", "fps": 25}},
+        "thor": {"data": {"code": "thr", "active": True}},
+        "loki": {"data": {"code": "lok", "active": False}},
+        "odin": {"config": {"tasks": [{"name": "model"}, {"name": "rig"}]}},
+    }
+    for name, fields in projects.items():
+        fields.update(document("project", name))
+        dbcon.database[name].insert_one(fields)
+
+
+@mock_database
+def test_projects(dbcon, calls):
+    """Projects are read once, and projected as the server would"""
+    insert_projects(dbcon)
+    calls.clear()
+
+    assert_equals(sorted(dbcon.project_names()), ["hulk", "odin", "thor"])
+    assert_equals(sorted(dbcon.project_names(only_active=False)),
+                  ["hulk", "loki", "odin", "thor"])
+    assert_equals(calls, {"find_one": 4})
+
+    def key(doc):
+        return json.dumps(doc, sort_keys=True, default=str)
+
+    for projection in (None,
+                       {"name": 1},
+                       {"name": True, "_id": False},
+                       {"_id": 0},
+                       {"data": 0},
+                       {"data.code": 1},
+                       {"data.active": 0, "schema": 0},
+                       {"config.tasks.name": 1},
+                       ["name", "data"]):
+        expected = []
+        for name in ("hulk", "loki", "odin", "thor"):
+            expected.extend(dbcon.database[name].find(
+                {"type": "project"}, projection=projection
+            ))
+
+        projects = dbcon.projects(projection, only_active=False)
+        assert_equals(sorted(projects, key=key), sorted(expected, key=key))
+
+    # Copies are returned
+    project = next(dbcon.projects())
+    project["data"] = None
+    assert next(dbcon.projects())["data"] is not None
+    assert_equals(calls["find_one"], 4)
+
+
+@mock_database
+def test_projects_invalidated(dbcon, calls):
+    """Writes which may change a project are seen by the catalog"""
+    insert_projects(dbcon)
+    assert "hulk" in dbcon.project_names()
+
+    dbcon.update_one({"type": "asset"}, {"$set": {"name": "Bruce"}})
+    dbcon.project_names()
+    assert_equals(calls["find_one"], 4)
+
+    dbcon.update_one({"type": "project"},
+                     {"$set": {"data.active": False}})
+    assert "hulk" not in dbcon.project_names()
+
+    dbcon.update_one({"type": "project"}, {"$set": {"data.active": True}})
+    assert "hulk" in dbcon.project_names()
+
+    dbcon.delete_many({})
+    assert "hulk" not in dbcon.project_names(only_active=False)
+
+    dbcon.insert_one(document("project", "hulk"))
+    assert "hulk" in dbcon.project_names()
+
+    dbcon.drop()
+    assert "hulk" not in dbcon.project_names(only_active=False)
+
+
+def parenthood_per_level(dbcon, document):
+    """Return parents of `document` one query at a time, as once done"""
+    parents = list()
+
+    while document.get("parent") is not None:
+        document = dbcon.find_one({"_id": document["parent"]})
+        if document is None:
+            break
+
+        if document.get("type") == "hero_version":
+            _document = dbcon.find_one({"_id": document["version_id"]})
+            document["data"] = _document["data"]
+
+        parents.append(document)
+
+    return parents
+
+
+@mock_database
+def test_parenthoods(dbcon, calls):
+    """Parents are identical to those found one level at a time"""
+    project = document("project", "hulk", _id=bson.ObjectId())
+    asset = document("asset", "Bruce", project["_id"], _id=bson.ObjectId())
+    subset = document("subset", "modelDefault", asset["_id"],
+                      _id=bson.ObjectId())
+    version = document("version", 1, subset["_id"], _id=bson.ObjectId(),
+                       data={"comment": "first"})
+    hero = document("hero_version", None, subset["_id"], data={},
+                    version_id=version["_id"])
+    missing = bson.ObjectId()
+    orphan = document("version", 2, missing, data={})
+    raw_insert(dbcon, [project, asset, subset, version, hero, orphan])
+
+    documents = [
+        document("representation", "ma", version["_id"]),
+        document("representation", "abc", version["_id"]),
+        document("representation", "ma", hero["_id"]),
+        document("representation", "ma", orphan["_id"]),
+        document("representation", "ma", missing),
+        document("representation", "ma", None),
+        version,
+        project,
+    ]
+    expected = [parenthood_per_level(dbcon, doc) for doc in documents]
+    assert_equals([len(parents) for parents in expected],
+                  [4, 4, 4, 1, 0, 0, 3, 0])
+    assert_equals(expected[2][0]["data"], {"comment": "first"})
+
+    calls.clear()
+    parents = dbcon.parenthoods(documents)
+    assert_equals(calls, {"aggregate": 1})
+    assert_equals(parents, expected)
+    assert_equals([dbcon.parenthood(doc) for doc in documents], expected)
+
+    # Documents sharing parents get copies of their own
+    assert parents[0][0] is not parents[1][0]
+    parents[0][0]["data"]["comment"] = "changed"
+    assert_equals(parents[1][0]["data"], {"comment": "first"})
+
+
+def test_document_cache():
+    """Documents are evicted by age and size, and returned as copies"""
+    first, second, third = [
+        document("asset", name, _id=bson.ObjectId(), data={"index": index})
+        for index, name in enumerate(("Bruce", "Betty", "Jenny"))
+    ]
+    size = len(bson.BSON.encode(first))
+
+    key = mongodb._DocumentCache.key
+    assert_equals(key({"_id": first["_id"]}), first["_id"])
+    assert_equals(key({"type": "asset", "parent": None, "name": "Bruce"}),
+                  ("asset", None, "Bruce"))
+    assert_equals(key({"_id": {"$in": [first["_id"]]}}), None)
+    assert_equals(key({"type": "asset", "name": "Bruce"}), None)
+    assert_equals(key(None), None)
+
+    # Copies are handed out, and taken in
+    cache = mongodb._DocumentCache(size * 2.5, 60)
+    cache.set("hulk", first)
+    first["data"]["index"] = -1
+    cached = cache.get("hulk", first["_id"])
+    assert_equals(cached["data"], {"index": 0})
+    cached["data"]["index"] = -2
+    assert_equals(cache.get("hulk", first["_id"])["data"], {"index": 0})
+    assert_equals(cache.get("hulk", ("asset", None, "Bruce"))["_id"],
+                  first["_id"])
+    assert_equals(cache.get("other", first["_id"]), None)
+
+    # Least recently used are evicted once over budget
+    cache.set("hulk", second)
+    cache.get("hulk", first["_id"])
+    cache.set("hulk", third)
+    assert_equals(cache.get("hulk", second["_id"]), None)
+    assert_equals(cache.get("hulk", ("asset", None, "Betty")), None)
+    assert cache.get("hulk", first["_id"]) is not None
+    assert cache.get("hulk", third["_id"]) is not None
+
+    stats = cache.stats()
+    assert_equals(stats["evictions"], 1)
+    assert_equals(stats["entries"], 2)
+    assert_equals(stats["bytes"], size * 2)
+
+    # Documents larger than the budget are not cached at all
+    cache.set("hulk", dict(second, data={"blob": "x" * size * 3}))
+    assert_equals(cache.get("hulk", second["_id"]), None)
+    assert_equals(cache.stats()["entries"], 2)
+
+    # Expired entries are misses, and forgotten
+    cache = mongodb._DocumentCache(size * 10, -1)
+    cache.set("hulk", first)
+    assert_equals(cache.get("hulk", first["_id"]), None)
+    assert_equals(cache.get("hulk", ("asset", None, "Bruce")), None)
+    assert_equals(cache.stats()["entries"], 0)
+    assert_equals(cache.stats()["bytes"], 0)
+
+
+@mock_database
+def test_document_cache_renamed(dbcon, calls):
+    """Documents renamed through dbcon are not found by their former name"""
+    project = bson.ObjectId()
+    asset = document("asset", "Bruce", project, _id=bson.ObjectId(),
+                     tags=["a", "b"])
+    raw_insert(dbcon, [asset])
+    dbcon.enable_document_cache()
+    calls.clear()
+
+    by_id = {"_id": asset["_id"]}
+    former = {"type": "asset", "parent": project, "name": "Bruce"}
+    renamed = {"type": "asset", "parent": project, "name": "Betty"}
+
+    assert_equals(dbcon.find_one(former)["_id"], asset["_id"])
+    assert_equals(dbcon.find_one(by_id)["name"], "Bruce")
+    assert_equals(dbcon.find_one(former, projection={"name": 1}),
+                  {"_id": asset["_id"], "name": "Bruce"})
+    assert_equals(calls, {"find_one": 1})
+
+    # Renamed by _id
+    dbcon.update_one(by_id, {"$set": {"name": "Betty"}})
+    calls.clear()
+    assert_equals(dbcon.find_one(former), None)
+    assert_equals(dbcon.find_one(renamed)["_id"], asset["_id"])
+    assert_equals(dbcon.find_one(by_id)["name"], "Betty")
+    assert_equals(calls, {"find_one": 2})
+
+    # Renamed by name, through methods of the collection
+    dbcon.replace_one(renamed, dict(asset, name="Rick"))
+    dbcon.find_one_and_update({"_id": asset["_id"]},
+                              {"$set": {"data": {"index": 1}}})
+    calls.clear()
+    assert_equals(dbcon.find_one(renamed), None)
+    assert_equals(dbcon.find_one(by_id)["data"], {"index": 1})
+    assert_equals(calls, {"find_one": 2})
+
+    # Other lookups are left to the database
+    calls.clear()
+    assert_equals(dbcon.find_one(by_id, skip=1), None)
+    dbcon.find_one(by_id, sort=[("name", 1)])
+    assert_equals(dbcon.find_one(by_id, {"tags": {"$slice": 1}})["tags"],
+                  ["a"])
+    dbcon.find_one({"_id": {"$in": [asset["_id"]]}})
+    assert_equals(calls, {"find_one": 4})
+
+    stats = dbcon.document_cache_stats()
+    assert_equals(stats["entries"], 1)
+    dbcon.delete_many(by_id)
+    calls.clear()
+    assert_equals(dbcon.find_one(by_id), None)
+    assert_equals(calls, {"find_one": 1})
+    assert_equals(dbcon.document_cache_stats()["entries"], 0)
+
+
+def test_result_cache():
+    """Results are evicted by generation, age and size, and decoded anew"""
+    result = [{"name": "Bruce", "data": {"index": 0}}]
+    size = len(bson.BSON.encode({"result": result}))
+
+    cache = mongodb._ResultCache(size * 2.5, 60)
+    assert_equals(cache.get("first", 0), None)
+    cache.set("first", 0, result)
+    result[0]["data"]["index"] = -1
+    cached = cache.get("first", 0)
+    assert_equals(cached, [{"name": "Bruce", "data": {"index": 0}}])
+    cached[0]["data"]["index"] = -2
+    assert_equals(cache.get("first", 0)[0]["data"], {"index": 0})
+
+    # Results of former generations are misses, and forgotten
+    assert_equals(cache.get("first", 1), None)
+    assert_equals(cache.get("first", 0), None)
+    assert_equals(cache.stats()["bytes"], 0)
+
+    # Least recently used are evicted once over budget
+    for key in ("first", "second"):
+        cache.set(key, 1, result)
+    cache.get("first", 1)
+    cache.set("third", 1, result)
+    assert_equals(cache.get("second", 1), None)
+    assert cache.get("first", 1) is not None
+    assert cache.get("third", 1) is not None
+
+    stats = cache.stats()
+    assert_equals(stats["evictions"], 1)
+    assert_equals(stats["entries"], 2)
+    assert_equals(stats["bytes"], size * 2)
+
+    # Results larger than the budget are not cached at all
+    cache.set("fourth", 1, [{"blob": "x" * size * 3}])
+    assert_equals(cache.get("fourth", 1), None)
+
+    # Expired entries are misses
+    cache = mongodb._ResultCache(size * 10, -1)
+    cache.set("first", 0, result)
+    assert_equals(cache.get("first", 0), None)
+    assert_equals(cache.stats()["entries"], 0)
+
+
+@mock_database
+def test_result_cache_writes(dbcon, calls):
+    """Results are found anew after any write to their collection"""
+    assets = [document("asset", name, _id=bson.ObjectId())
+              for name in ("Bruce", "Betty")]
+    raw_insert(dbcon, assets)
+    dbcon.enable_result_cache()
+    other = mongodb.AvalonMongoDB({"AVALON_PROJECT": "hulk"})
+
+    def upgrade(document):
+        document["data"] = {"upgraded": True}
+        return document
+
+    with open(os.path.join(os.environ["AVALON_SCHEMA"],
+                           "test-2.0.json"), "w") as f:
+        json.dump(dict(TEST_SCHEMA, title="avalon-core:test-2.0"), f)
+    schema._CACHED = False
+    schema.register_upgrade("test-1.0", "test-2.0")(upgrade)
+
+    def bulk(dbcon):
+        with dbcon.bulk() as writer:
+            writer.update_one({"name": "Bruce"},
+                              {"$set": {"data": {"b": 1}}})
+
+    writes = [
+        lambda: dbcon.insert_one(document("asset", "Rick")),
+        lambda: dbcon.insert_many([document("asset", "Jen")]),
+        lambda: dbcon.update_one({"name": "Rick"}, {"$set": {"data": {}}}),
+        lambda: dbcon.update_many({}, {"$set": {"data": {}}}),
+        lambda: dbcon.replace_one({"name": "Jen"}, document("asset", "Jen")),
+        lambda: dbcon.delete_one({"name": "Jen"}),
+        lambda: dbcon.delete_many({"name": "Rick"}),
+        lambda: dbcon.find_one_and_update({"name": "Betty"},
+                                          {"$set": {"data": {"a": 1}}}),
+        lambda: dbcon.bulk_write([
+            pymongo.UpdateOne({"name": "Betty"}, {"$set": {"data": {}}})
+        ]),
+        lambda: bulk(dbcon),
+        lambda: dbcon.migrate(),
+        lambda: other.insert_one(document("asset", "Thaddeus")),
+        lambda: dbcon.drop(),
+    ]
+
+    def query():
+        return [
+            dbcon.find_cached({"type": "asset"}, sort=[("name", 1)]),
+            dbcon.find_cached({"type": "asset"}, {"data": 0}),
+            dbcon.distinct("name", {"type": "asset"}),
+            dbcon.aggregate([{"$match": {"type": "asset"}},
+                             {"$sort": {"name": -1}}]),
+        ]
+
+    try:
+        results = query()
+        for write in writes:
+            calls.clear()
+            assert_equals(query(), results)
+            assert_equals(calls, {})
+
+            # Each write changes what is found
+            write()
+            calls.clear()
+            former, results = results, query()
+            assert_equals(calls, {"find": 2, "distinct": 1, "aggregate": 1})
+            assert results != former
+
+        assert_equals(results, [[], [], [], []])
+        assert_equals(dbcon.result_cache_stats()["misses"],
+                      len(writes) * 4 + 4)
+
+    finally:
+        schema._upgrades.clear()
+        other.uninstall()
+
+
+@mock_database
+def test_result_cache_out(dbcon, calls):
+    """Aggregations writing their results are run anew each time"""
+    raw_insert(dbcon, [document("asset", name) for name in ("Bruce", "Betty")])
+    dbcon.enable_result_cache()
+    pipeline = [{"$match": {"type": "asset"}}, {"$out": "thor"}]
+    dbcon.aggregate(pipeline)
+
+    other = mongodb.AvalonMongoDB({"AVALON_PROJECT": "thor"})
+    other.enable_result_cache()
+    try:
+        assert_equals(len(other.find_cached({"type": "asset"})), 2)
+        dbcon.database["thor"].delete_many({})
+        calls.clear()
+
+        # Cached results of the target collection are forgotten
+        dbcon.aggregate(pipeline)
+        assert_equals(calls, {"aggregate": 1})
+        assert_equals(len(other.find_cached({"type": "asset"})), 2)
+        assert_equals(calls, {"aggregate": 1, "find": 1})
+    finally:
+        other.uninstall()
+
+
+@mock_database
+def test_result_cache_uncached(dbcon, calls):
+    """Cursors and queries with options other than the usual are not cached"""
+    raw_insert(dbcon, [document("asset", name) for name in ("Bruce", "Betty")])
+    dbcon.enable_result_cache()
+    calls.clear()
+    query_filter = {"type": "asset"}
+
+    for _ in range(2):
+        assert_equals(len(list(dbcon.find(query_filter, limit=1))), 1)
+        assert_equals(dbcon.find(query_filter).sort("name").limit(1)[0]
+                      ["name"], "Betty")
+        dbcon.distinct("name", query_filter, session=None)
+        dbcon.aggregate([{"$match": query_filter}], allowDiskUse=True)
+    assert_equals(calls, {"find": 4, "distinct": 2, "aggregate": 2})
+
+    # Cached ones are lists, whether or not cached
+    assert_equals(dbcon.find_cached(query_filter, ["name"]),
+                  dbcon.find_cached(query_filter, projection=["name"]))
+    assert_equals(calls["find"], 5)
+    assert_equals(dbcon.result_cache_stats()["hits"], 1)
+
+    dbcon.disable_result_cache()
+    assert isinstance(dbcon.find_cached(query_filter), list)
+    assert_equals(calls["find"], 6)
+    assert_equals(dbcon.result_cache_stats(), None)
@@ -0,0 +1,468 @@
+"""Test schema.py
+
+..note: These tests depend on global state and are therefore not reentrant.
+
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import tempfile
+import threading
+
+from avalon import schema
+
+from nose.tools import (
+    assert_equals,
+    assert_raises,
+)
+
+self = sys.modules[__name__]
+self._tempdir = None
+self._environ = None
+
+VERSION_SCHEMA = {
+    "$schema": "http://json-schema.org/draft-04/schema#",
+    "title": "openpype:version-3.0",
+    "type": "object",
+    "additionalProperties": True,
+    "required": ["schema", "type", "parent", "name", "data"],
+    "properties": {
+        "schema": {"type": "string"},
+        "type": {"type": "string", "enum": ["version"]},
+        "parent": {},
+        "name": {"type": "number"},
+        "locations": {"type": "array", "items": {"type": "string"}},
+        "data": {"$ref": "_data-1.0.json"},
+    }
+}
+
+DATA_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "families": {"type": "array", "items": {"type": "string"}},
+    }
+}
+
+
+def setup_module():
+    self._tempdir = tempfile.mkdtemp()
+    self._environ = os.environ.get("AVALON_SCHEMA")
+    with open(os.path.join(self._tempdir, "version-3.0.json"), "w") as f:
+        json.dump(VERSION_SCHEMA, f)
+
+    os.environ["AVALON_SCHEMA"] = self._tempdir
+
+
+def teardown_module():
+    shutil.rmtree(self._tempdir)
+    if self._environ is None:
+        os.environ.pop("AVALON_SCHEMA", None)
+    else:
+        os.environ["AVALON_SCHEMA"] = self._environ
+
+
+def setup_function(function):
+    schema._CACHED = False
+    schema._compiled.clear()
+
+    # Schemas prefixed with underscore are never read from disk
+    schema._cache["_data-1.0.json"] = DATA_SCHEMA
+
+
+def version(**kwargs):
+    document = {
+        "schema": "openpype:version-3.0",
+        "type": "version",
+        "parent": None,
+        "name": 1,
+        "locations": ("a", "b"),
+        "data": {"families": ["model"]},
+    }
+    document.update(kwargs)
+    return document
+
+
+def test_validate():
+    """Valid documents pass, tuples count as arrays and $refs resolve"""
+    schema.validate(version())
+
+    assert_raises(schema.ValidationError,
+                  schema.validate, version(name="1"))
+    assert_raises(schema.ValidationError,
+                  schema.validate, version(data={"families": "model"}))
+
+
+def test_validator_compiled_once():
+    """Validators are compiled once and reused within a thread"""
+    validator = schema.get_validator("version-3.0")
+    assert validator is schema.get_validator("version-3.0")
+    assert_equals(list(schema._compiled), ["version-3.0.json"])
+
+    assert_raises(KeyError, schema.get_validator, "missing-1.0")
+
+
+def test_validator_per_thread():
+    """Each thread is handed its own validator for the same schema"""
+    validators = []
+    errors = []
+
+    def worker():
+        try:
+            for index in range(50):
+                schema.validate(version(name=index))
+        except Exception as e:
+            errors.append(e)
+        validators.append(schema.get_validator("version-3.0"))
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert_equals(errors, [])
+    assert_equals(len(set(id(v) for v in validators)), 4)
+    assert_equals(len(schema._compiled), 1)
+
+
+def test_validate_many():
+    """All invalid items are reported by index, in and out of process"""
+    items = [
+        version(),
+        version(name="2"),
+        {"type": "version"},
+        version(),
+        version(data={"families": "model"}),
+    ]
+
+    for threshold in (len(items) + 1, 0):
+        errors = schema.validate_many(items, processes=2, threshold=threshold)
+        assert_equals([index for index, error in errors], [1, 2, 4])
+        assert_equals(list(errors[0][1].path), ["name"])
+        assert_equals(list(errors[2][1].path), ["data", "families"])
+
+    assert_equals(schema.validate_many([version(), version()]), [])
+    assert_raises(KeyError, schema.validate_many,
+                  [{"schema": "openpype:missing-1.0"}])
+
+
+def test_validate_many_in_process():
+    """Large batches are validated in process unless a pool is asked for"""
+    def pool(*args, **kwargs):
+        raise AssertionError("Pool started by default")
+
+    original = schema.multiprocessing.Pool
+    schema.multiprocessing.Pool = pool
+    try:
+        items = [version() for _ in range(6000)]
+        assert_equals(schema.validate_many(items), [])
+    finally:
+        schema.multiprocessing.Pool = original
+
+
+def test_lazy_loading():
+    """Schemas are only read from disk once they are used"""
+    schema._precache()
+    assert_equals(list(schema._index), ["version-3.0.json"])
+    assert "version-3.0.json" not in schema._cache
+
+    schema.validate(version())
+    assert "version-3.0.json" in schema._cache
+
+
+CONFORMANCE_SCHEMAS = [
+    {},
+    {"type": "object"},
+    {"type": "array"},
+    {"type": "string"},
+    {"type": "number"},
+    {"type": "integer"},
+    {"type": "boolean"},
+    {"type": "null"},
+    {"type": ["string", "null"]},
+    {"type": "integer", "description": "annotations are ignored"},
+    {"enum": ["a", "b"]},
+    {"type": "string", "enum": ["a"]},
+    {"required": ["a", "b"]},
+    {"type": "object", "required": ["a"], "additionalProperties": False,
+     "properties": {"a": {"type": "integer"}, "b": {}}},
+    {"properties": {"a": {"type": "object", "properties": {
+        "b": {"type": "array", "items": {"type": "number"}}}}}},
+    {"additionalProperties": {"type": "string"},
+     "properties": {"a": {"type": "integer"}}},
+    {"items": {"type": "object", "required": ["a"]}},
+    {"type": "array", "items": {"enum": ["a"]}},
+    {"definitions": {"a": {"type": "integer"}},
+     "properties": {"a": {"$ref": "#/definitions/a"}}},
+    {"items": {"$ref": "_data-1.0.json#/properties/families"}},
+    {"pattern": "^[ab]"},
+    {"type": "string", "pattern": "b$"},
+    {"patternProperties": {"^a": {"type": "integer"}}},
+    {"patternProperties": {"^a": {"type": "integer"}, "^c": {}},
+     "additionalProperties": False},
+    {"patternProperties": {"^c": {"type": "string"}},
+     "additionalProperties": {"type": "integer"}},
+    {"properties": {"a": {"minimum": 1}, "b": {"type": "integer"}}},
+    {"items": {"uniqueItems": True, "type": "array"}},
+    {"properties": {"a": {"$ref": "#"}}},
+]
+
+CONFORMANCE_INSTANCES = [
+    None, True, False, 0, 1, 1.0, 1.5, -2, "", "a", "b", "c",
+    [], ["a"], ("a",), [1, 2.5], [True], [{"a": 1}], [{}],
+    {}, {"a": 1}, {"a": 1.0}, {"a": True}, {"a": "1"}, {"b": 1},
+    {"a": 1, "b": 2}, {"a": 1, "c": "x"}, {"a": 1, "c": 2},
+    {"a": {"b": [1, 2.5]}}, {"a": {"b": [1, "2"]}}, {"a": {"b": 1}},
+]
+
+
+def test_generated_conformance():
+    """Generated checks agree with jsonschema on supported keywords"""
+    for draft in ("http://json-schema.org/draft-04/schema#",
+                  "http://json-schema.org/draft-07/schema#"):
+        for index, subschema in enumerate(CONFORMANCE_SCHEMAS):
+            subschema = dict(subschema, **{"$schema": draft})
+            schema._cache["_conformance-%d.json" % index] = subschema
+            schema._compiled.pop("_conformance-%d.json" % index, None)
+            schema._generated.pop("_conformance-%d.json" % index, None)
+
+            name = "_conformance-%d" % index
+            validator = schema.get_validator(name)
+            check = schema.generate_check(name)
+            assert check is not None, subschema
+
+            for instance in CONFORMANCE_INSTANCES:
+                assert_equals(
+                    check(instance), validator.is_valid(instance),
+                    "%r with %r" % (instance, subschema)
+                )
+
+
+def test_generated_unsupported():
+    """Schemas with unsupported keywords are left to jsonschema"""
+    for subschema in ({"minItems": 1},
+                      {"$ref": "#"},
+                      {"$ref": "_missing-1.0.json"},
+                      {"items": [{"type": "string"}]},
+                      {"enum": [1, True]},
+                      {"uniqueItems": True}):
+        schema._cache["_unsupported.json"] = subschema
+        schema._compiled.pop("_unsupported.json", None)
+        assert_equals(schema.generate_check("_unsupported"), None)
+
+
+def test_generated_validate():
+    """Generated checks raise the same errors as jsonschema"""
+    invalid = [
+        version(name="1"),
+        version(data={"families": [1]}),
+        version(locations="a"),
+        {"schema": "openpype:version-3.0"},
+    ]
+
+    expected = []
+    for document in invalid:
+        with assert_raises(schema.ValidationError) as context:
+            schema.validate(document)
+        expected.append(context.exception.message)
+
+    os.environ["AVALON_SCHEMA_GENERATED"] = "version-3.0"
+    try:
+        schema._precache()
+        schema.validate(version())
+        assert "version-3.0.json" in schema._generated
+
+        for document, message in zip(invalid, expected):
+            with assert_raises(schema.ValidationError) as context:
+                schema.validate(document)
+            assert_equals(context.exception.message, message)
+
+        errors = schema.validate_many(invalid + [version()])
+        assert_equals([error.message for index, error in errors], expected)
+
+    finally:
+        os.environ.pop("AVALON_SCHEMA_GENERATED")
+
+
+def test_upgrade():
+    """Registered upgrades are applied in order of version"""
+    @schema.register_upgrade("version-1.0", "version-2.0")
+    def _version_1_to_2(document):
+        document["data"] = {}
+        return document
+
+    @schema.register_upgrade("version-2.0", "version-3.0")
+    def _version_2_to_3(document):
+        document["locations"] = []
+        return document
+
+    try:
+        document = schema.upgrade({"schema": "pype:version-1.0"})
+        assert_equals(document, {
+            "schema": "pype:version-3.0",
+            "data": {},
+            "locations": [],
+        })
+        assert_equals(schema.upgradable_schemas(),
+                      ["version-1.0", "version-2.0"])
+
+        document = version()
+        assert schema.upgrade(document) is document
+
+        assert_raises(AssertionError,
+                      schema.register_upgrade, "version-3.0", "version-2.0")
+
+    finally:
+        schema._upgrades.clear()
+
+
+def test_validate_update():
+    """Update operators are validated at their path"""
+    valid = [
+        {"$set": {"name": 2, "data.families": ["a"]}},
+        {"$set": {"data.families.0": "a", "data.other": 1}},
+        {"$push": {"data.families": {"$each": ["a", "b"]}}},
+        {"$addToSet": {"locations": "a"}},
+        {"$inc": {"name": 1}},
+        {"$unset": {"locations": ""}},
+        {"$rename": {"locations": "sites"}},
+    ]
+    for update in valid:
+        schema.validate_update(update, "version-3.0")
+
+    invalid = [
+        ({"$set": {"name": "2"}}, ["name"]),
+        ({"$set": {"data.families": [1]}}, ["data", "families", 0]),
+        ({"$set": {"data.families.$": 1}}, ["data", "families", "$"]),
+        ({"$push": {"data.families": 1}}, ["data", "families", "$"]),
+        ({"$push": {"name": 1}}, ["name"]),
+        ({"$inc": {"type": 1}}, ["type"]),
+        ({"$unset": {"data": ""}}, []),
+        ({"$rename": {"name": "label"}}, []),
+    ]
+    for update, path in invalid:
+        with assert_raises(schema.ValidationError) as context:
+            schema.validate_update(update, "version-3.0")
+        assert_equals(list(context.exception.path), path)
+
+    # Additional properties
+    schema.validate_update({"$set": {"key": "a"}}, "_doctest")
+    assert_raises(schema.ValidationError,
+                  schema.validate_update, {"$set": {"other": 1}}, "_doctest")
+
+
+def test_check_update_schemas():
+    """Schemas of updated documents are read only when validating"""
+    update = {"$set": {"name": "1"}}
+    reads = []
+
+    def stored(*names):
+        def schemas():
+            reads.append(names)
+            return list(names)
+        return schemas
+
+    assert_raises(schema.ValidationError, schema.check_update,
+                  update, schemas=stored("openpype:version-3.0"))
+
+    # Documents of unknown schemas, e.g. older versions, are not validated
+    schema.check_update(update, schemas=stored("openpype:version-2.0"))
+    schema.check_update(update, schemas=stored())
+    assert_raises(schema.ValidationError, schema.check_update, update,
+                  schemas=stored("openpype:version-2.0",
+                                 "openpype:version-3.0"))
+    assert_equals(len(reads), 4)
+
+    # Schemas set by the update are validated against instead
+    upgrade = {"$set": {"schema": "openpype:version-3.0", "name": "1"}}
+    assert_raises(schema.ValidationError, schema.check_update,
+                  upgrade, schemas=stored("openpype:version-2.0"))
+    assert_equals(len(reads), 4)
+
+    schema.set_policy("off")
+    try:
+        schema.check_update(update, schemas=stored("openpype:version-3.0"))
+    finally:
+        schema.set_policy("strict")
+    assert_equals(len(reads), 4)
+
+    environ = os.environ["AVALON_SCHEMA"]
+    os.environ["AVALON_SCHEMA"] = os.path.join(self._tempdir, "missing")
+    schema._CACHED = False
+    try:
+        schema.check_update(update, "version-3.0")
+    finally:
+        os.environ["AVALON_SCHEMA"] = environ
+        schema._precache()
+
+
+def test_policy():
+    """Documents are validated and counted as per the policy"""
+    invalid = version(name="1")
+    schema.reset_stats()
+
+    try:
+        schema.set_policy("off")
+        schema.check(invalid)
+        schema.check_update({"$set": {"name": "1"}}, "version-3.0")
+        assert_equals(schema.check_many([invalid, invalid]), [])
+
+        schema.set_policy("sample:0")
+        schema.check(invalid)
+
+        schema.set_policy("sample:1")
+        assert_raises(schema.ValidationError, schema.check, invalid)
+
+        schema.set_policy("strict")
+        schema.check(version())
+        errors = schema.check_many([version(), invalid])
+        assert_equals([index for index, error in errors], [1])
+
+        stats = schema.stats()
+        assert stats.pop("seconds") > 0
+        assert_equals(stats, {"validated": 4, "skipped": 5, "rejected": 2})
+
+        assert_raises(ValueError, schema.set_policy, "sometimes")
+        assert_raises(ValueError, schema.set_policy, "strict:0.5")
+        assert_raises(ValueError, schema.set_policy, "off:")
+        assert_raises(ValueError, schema.set_policy, "sample:")
+        assert_equals(schema.get_policy(), "strict")
+
+    finally:
+        schema.set_policy("strict")
+        schema.reset_stats()
+
+
+def test_fork():
+    """Locks held by other threads are not held in a child process"""
+    if not hasattr(os, "register_at_fork"):
+        return
+
+    # As though other threads were validating
+    with schema._stats_lock, schema._compiled_lock:
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                schema._compiled.clear()
+                schema.check(version())
+                code = 0
+            finally:
+                os._exit(code)
+
+    # Deadlocked children are killed
+    for _ in range(100):
+        finished, status = os.waitpid(pid, os.WNOHANG)
+        if finished:
+            break
+        time.sleep(0.1)
+    else:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+    assert finished, "Child process deadlocked"
+    assert_equals(status, 0)
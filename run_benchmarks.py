@@ -0,0 +1,403 @@
+"""Measure the throughput of performance sensitive code paths
+
+Usage:
+    $ python run_benchmarks.py
+
+Each benchmark prints the number of operations per second for the
+original approach next to the one currently in use.
+
+"""
+
+import io
+import os
+import sys
+import json
+import shutil
+import timeit
+import tarfile
+import subprocess
+import tempfile
+import warnings
+
+import jsonschema
+
+warnings.filterwarnings("ignore", category=DeprecationWarning)
+
+self = sys.modules[__name__]
+self._tempdir = None
+
+# Revision of avalon.io measured against, prior to optimising its startup
+BASELINE = "4e98e0a"
+
+# Representative schemas, modelled on those published with
+# avalon-core and used by every publish. Set AVALON_SCHEMA to a
+# directory of schemas to measure those instead.
+SCHEMAS = {
+    "subset-3.0": {
+        "$schema": "http://json-schema.org/draft-04/schema#",
+        "title": "openpype:subset-3.0",
+        "description": "A container of instances",
+        "type": "object",
+        "additionalProperties": True,
+        "required": ["schema", "type", "parent", "name", "data"],
+        "properties": {
+            "schema": {
+                "type": "string",
+                "enum": ["openpype:subset-3.0"]
+            },
+            "type": {"type": "string", "enum": ["subset"]},
+            "parent": {"description": "Unique identifier to parent"},
+            "name": {
+                "type": "string",
+                "pattern": "^[a-zA-Z0-9_.]*$"
+            },
+            "data": {
+                "type": "object",
+                "required": ["families"],
+                "properties": {
+                    "families": {
+                        "type": "array",
+                        "items": {"type": "string"}
+                    }
+                }
+            }
+        }
+    },
+    "version-3.0": {
+        "$schema": "http://json-schema.org/draft-04/schema#",
+        "title": "openpype:version-3.0",
+        "description": "An individual version",
+        "type": "object",
+        "additionalProperties": True,
+        "required": ["schema", "type", "parent", "name", "data"],
+        "properties": {
+            "schema": {
+                "type": "string",
+                "enum": ["openpype:version-3.0"]
+            },
+            "type": {"type": "string", "enum": ["version"]},
+            "parent": {"description": "Unique identifier to parent"},
+            "name": {"type": "number"},
+            "locations": {
+                "type": "array",
+                "items": {"type": "string"}
+            },
+            "data": {
+                "type": "object",
+                "properties": {
+                    "families": {
+                        "type": "array",
+                        "items": {"type": "string"}
+                    },
+                    "author": {"type": "string"},
+                    "source": {"type": "string"},
+                    "comment": {"type": "string"},
+                    "machine": {"type": "string"},
+                    "time": {"type": "string"}
+                }
+            }
+        }
+    },
+    "representation-2.0": {
+        "$schema": "http://json-schema.org/draft-04/schema#",
+        "title": "openpype:representation-2.0",
+        "description": "The inverse of an instance",
+        "type": "object",
+        "additionalProperties": True,
+        "required": ["schema", "type", "parent", "name", "data"],
+        "properties": {
+            "schema": {
+                "type": "string",
+                "enum": ["openpype:representation-2.0"]
+            },
+            "type": {"type": "string", "enum": ["representation"]},
+            "parent": {"description": "Unique identifier to parent"},
+            "name": {
+                "type": "string",
+                "pattern": "^[a-zA-Z0-9_.]*$"
+            },
+            "data": {"type": "object"},
+            "dependencies": {
+                "type": "array",
+                "items": {"type": "string"}
+            },
+            "context": {
+                "type": "object",
+                "additionalProperties": True,
+                "required": ["project", "asset", "subset", "version"],
+                "properties": {
+                    "project": {
+                        "type": "object",
+                        "required": ["name", "code"],
+                        "properties": {
+                            "name": {"type": "string"},
+                            "code": {"type": "string"}
+                        }
+                    },
+                    "asset": {"type": "string"},
+                    "subset": {"type": "string"},
+                    "version": {"type": "number"},
+                    "representation": {"type": "string"}
+                }
+            }
+        }
+    }
+}
+
+DOCUMENTS = [
+    {
+        "schema": "openpype:subset-3.0",
+        "type": "subset",
+        "parent": "592c33475f8c1b064c4d1695",
+        "name": "modelDefault",
+        "data": {"families": ["model"]}
+    },
+    {
+        "schema": "openpype:version-3.0",
+        "type": "version",
+        "parent": "592c33475f8c1b064c4d1696",
+        "name": 12,
+        "locations": [],
+        "data": {
+            "families": ["model"],
+            "author": "marcus",
+            "source": "{root}/hulk/work/modelling/scenes/model_v012.ma",
+            "comment": "Fixed the eyes",
+            "machine": "workstation-12",
+            "time": "20170615T161528Z"
+        }
+    },
+    {
+        "schema": "openpype:representation-2.0",
+        "type": "representation",
+        "parent": "592c33475f8c1b064c4d1697",
+        "name": "ma",
+        "data": {"path": "{root}/hulk/publish/model/v012/model.ma"},
+        "dependencies": [],
+        "context": {
+            "project": {"name": "hulk", "code": "hlk"},
+            "asset": "Bruce",
+            "subset": "modelDefault",
+            "version": 12,
+            "representation": "ma"
+        }
+    }
+]
+
+
+def setup():
+    self._tempdir = tempfile.mkdtemp()
+
+    # Schemas of a deployment, copied for fillers not to be mixed in
+    schema_dir = os.environ.get("AVALON_SCHEMA")
+    if schema_dir:
+        for fname in os.listdir(schema_dir):
+            if fname.endswith(".json"):
+                shutil.copy(os.path.join(schema_dir, fname), self._tempdir)
+        os.environ["AVALON_SCHEMA"] = self._tempdir
+        return
+
+    for name, schema in SCHEMAS.items():
+        fname = os.path.join(self._tempdir, name + ".json")
+        with open(fname, "w") as f:
+            json.dump(schema, f)
+
+    # Pad the directory to the number of schemas found in production
+    for index in range(40):
+        fname = os.path.join(self._tempdir, "filler%d-1.0.json" % index)
+        with open(fname, "w") as f:
+            json.dump(SCHEMAS["representation-2.0"], f)
+
+    os.environ["AVALON_SCHEMA"] = self._tempdir
+
+
+def teardown():
+    shutil.rmtree(self._tempdir)
+
+
+def report(title, results, number):
+    print(title)
+    for label, seconds in results:
+        print("  %-32s %12.0f ops/s" % (label, number / seconds))
+
+
+def benchmark_validate(number=5000):
+    """Validations per second of version and representation documents"""
+    from avalon import schema
+
+    schema._precache()
+    names = set(
+        document["schema"].rsplit(":", 1)[-1] for document in DOCUMENTS
+    )
+    for name in names:
+        schema._load(name + ".json")
+
+    def original():
+        for document in DOCUMENTS:
+            name = document["schema"].rsplit(":", 1)[-1]
+            resolver = jsonschema.RefResolver(
+                "",
+                None,
+                store=schema._cache,
+                cache_remote=True
+            )
+            jsonschema.validate(document,
+                                schema._cache[name + ".json"],
+                                types={"array": (list, tuple)},
+                                resolver=resolver)
+
+    def current():
+        for document in DOCUMENTS:
+            schema.validate(document)
+
+    results = [
+        ("original", timeit.timeit(original, number=number)),
+        ("compiled", timeit.timeit(current, number=number)),
+    ]
+
+    generated = [name for name in sorted(names)
+                 if schema.generate_check(name) is not None]
+    results.append((
+        "generated (%d of %d schemas)" % (len(generated), len(names)),
+        timeit.timeit(current, number=number)
+    ))
+    schema._generated.clear()
+
+    report("schema.validate (%d documents)" % len(DOCUMENTS),
+           results, number * len(DOCUMENTS))
+
+
+def benchmark_startup(number=200):
+    """Schema loading up until the first validated document"""
+    from avalon import schema
+
+    def original():
+        schema._precache()
+        for key in list(schema._index):
+            schema._load(key)
+        schema.validate(DOCUMENTS[0])
+
+    def lazy():
+        schema._precache()
+        schema.validate(DOCUMENTS[0])
+
+    results = [
+        ("load all", timeit.timeit(original, number=number)),
+        ("lazy", timeit.timeit(lazy, number=number)),
+    ]
+    report("schema startup (%d schemas)" % len(schema._index),
+           results, number)
+
+
+def benchmark_getattr(number=200000):
+    """Per-call overhead of collection methods on AvalonMongoDB"""
+    import pymongo
+    from avalon import mongodb
+
+    # No server required, the client connects on first operation
+    os.environ.setdefault("AVALON_DB", "avalon")
+    create_connection = mongodb.AvalonMongoConnection.create_connection
+    mongodb.AvalonMongoConnection.create_connection = classmethod(
+        lambda cls: pymongo.MongoClient(connect=False)
+    )
+
+    dbcon = mongodb.AvalonMongoDB({"AVALON_PROJECT": "hulk"})
+    try:
+        dbcon.install()
+
+        def original():
+            dbcon._collection_attribute("count_documents")
+
+        def current():
+            dbcon.count_documents
+
+        report("AvalonMongoDB.count_documents lookup", [
+            ("original", timeit.timeit(original, number=number)),
+            ("cached", timeit.timeit(current, number=number)),
+        ], number)
+
+    finally:
+        dbcon.uninstall()
+        mongodb.AvalonMongoConnection.create_connection = create_connection
+
+
+def benchmark_io_startup(number=10):
+    """Fresh processes importing and installing avalon.io
+
+    Measured against avalon.io of revision AVALON_BENCHMARK_BASELINE,
+    whose install requires openpype. Includes a first query when
+    AVALON_MONGO is set, such that the client connects, otherwise the
+    client only connects on first use.
+
+    """
+    imports = "from avalon import io"
+    install = imports + "; io.install()"
+    if os.environ.get("AVALON_MONGO"):
+        install += "; io.find_one({'type': 'project'})"
+
+    environ = dict(os.environ, AVALON_PROJECT="benchmark")
+    environ.setdefault("AVALON_DB", "avalon")
+    environ.setdefault("AVALON_MONGO", "mongodb://localhost:27017")
+
+    # Validated on install
+    fname = os.path.join(self._tempdir, "session-2.0.json")
+    with open(fname, "w") as f:
+        json.dump({"title": "openpype:session-2.0", "type": "object"}, f)
+
+    root = os.path.dirname(os.path.abspath(__file__))
+    revision = os.environ.get("AVALON_BENCHMARK_BASELINE", BASELINE)
+    baseline = os.path.join(self._tempdir, "baseline")
+    archive = subprocess.check_output(
+        ["git", "archive", revision, "avalon"], cwd=root
+    )
+    with tarfile.open(fileobj=io.BytesIO(archive)) as f:
+        f.extractall(baseline)
+
+    def run(script, path, **kwargs):
+        env = dict(environ, PYTHONPATH=path, **kwargs)
+
+        def startup():
+            # Outside of the repository, which would be imported first
+            subprocess.check_call([sys.executable, "-c", script],
+                                  env=env, cwd=self._tempdir)
+        return startup
+
+    cases = [
+        ("baseline %s" % revision, run(imports, baseline)),
+        ("current", run(imports, root)),
+    ]
+
+    if _importable("openpype"):
+        cases += [
+            ("baseline %s, install" % revision, run(install, baseline)),
+            ("current, install", run(install, root)),
+        ]
+    else:
+        print("  Install of the baseline requires openpype, skipping")
+
+    cases.append(("current, install with pymongo",
+                  run(install, root, AVALON_MONGO_FACTORY="pymongo")))
+
+    print("io startup")
+    for label, startup in cases:
+        seconds = timeit.timeit(startup, number=number)
+        print("  %-32s %12.0f ms" % (label, 1000.0 * seconds / number))
+
+
+def _importable(name):
+    try:
+        __import__(name)
+    except ImportError:
+        return False
+    return True
+
+
+if __name__ == "__main__":
+    setup()
+    try:
+        benchmark_validate()
+        benchmark_startup()
+        benchmark_getattr()
+        benchmark_io_startup()
+    finally:
+        teardown()